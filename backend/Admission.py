@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from fastapi import Request, HTTPException
+from backend.Auth import AuthenticatedUser
+from backend.Utility import TTLCache
+
+# The maximal number of users tracked by each rate limit (an evicted user starts over with a full bucket)
+RATE_LIMIT_USERS = int(os.getenv('RATE_LIMIT_USERS', 10000))
+
+
+class TokenBucket:
+    """
+    A token bucket, refilled continuously at a fixed rate up to its capacity.
+    A request takes one token, and may reserve a future token (driving the bucket negative) and wait for it,
+    so waiting requests are admitted in the order they arrived.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """
+        :param rate: the refill rate, in tokens per second
+        :param burst: the capacity of the bucket
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self, max_wait: float) -> tuple[bool, float]:
+        """
+        Takes a token, reserving a future one if the bucket is empty and it will be refilled within the max wait.
+
+        :param max_wait: the longest the request may wait for its token, in seconds
+        :return: whether a token was taken, and the time to wait for it (or until one is available, if not taken)
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0.0
+        wait = (1 - self.tokens) / self.rate
+        if wait > max_wait:
+            return False, wait
+        self.tokens -= 1
+        return True, wait
+
+
+class UserRateLimit:
+    """
+    A dependency that authenticates the request and admits it by a per-user token bucket, returning the username.
+    A user over the limit waits for the next token if it is close enough, and is rejected with a 429 otherwise,
+    so a few heavy users can't take the model provider's quota from everyone else.
+    Each limit is configured by the RATE_LIMIT_<NAME>_PER_MINUTE, RATE_LIMIT_<NAME>_BURST and
+    RATE_LIMIT_<NAME>_MAX_WAIT environment variables. A limit of 0 requests per minute is unlimited.
+    """
+
+    def __init__(self, name: str, authenticate: AuthenticatedUser, per_minute: float, burst: int, max_wait: float):
+        """
+        :param name: the name of the limit, used for its configuration and statistics
+        :param authenticate: the dependency authenticating the request's user
+        :param per_minute: the default number of requests per minute a user is allowed on average
+        :param burst: the default number of requests a user is allowed at once
+        :param max_wait: the default longest time a request waits for admission, in seconds
+        """
+        prefix = f"RATE_LIMIT_{name.upper()}_"
+        self.name = name
+        self.authenticate = authenticate
+        self.rate = float(os.getenv(prefix + "PER_MINUTE", per_minute)) / 60
+        self.burst = int(os.getenv(prefix + "BURST", burst))
+        self.max_wait = float(os.getenv(prefix + "MAX_WAIT", max_wait))
+        if self.rate < 0:
+            raise ValueError(f"{prefix}PER_MINUTE must be positive, or 0 for unlimited: {self.rate * 60}")
+        if self.rate and self.burst < 1:
+            raise ValueError(f"{prefix}BURST must be at least 1 to admit any request: {self.burst}")
+        self.buckets = TTLCache(RATE_LIMIT_USERS, self.burst / self.rate if self.rate else 0)
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0}
+
+    async def __call__(self, request: Request) -> str:
+        """
+        Authenticate the request and admit it, waiting for admission if needed.
+
+        :param request: The request object.
+        :return: The authenticated username.
+        """
+        username = await self.authenticate(request)
+        if not self.rate:
+            with self._lock:
+                self._stats["admitted"] += 1
+            return username
+        with self._lock:
+            bucket = self.buckets.get(username)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+            admitted, wait = bucket.reserve(self.max_wait)
+            # Kept until the bucket would be full again, after which a new bucket is the same
+            self.buckets.put(username, bucket, (self.burst - bucket.tokens) / self.rate + 1)
+            self._stats["admitted" if admitted and not wait else "queued" if admitted else "rejected"] += 1
+
+        if not admitted:
+            logging.warning(f"Rate limited {username} on {self.name}, retry in {wait:.1f}s")
+            raise HTTPException(status_code=429, detail="Too many requests, try again later.",
+                                headers={"Retry-After": str(math.ceil(wait))})
+        if wait:
+            logging.info(f"Queued {username} on {self.name} for {wait:.1f}s")
+            await asyncio.sleep(wait)
+        return username
+
+    def stats(self) -> dict:
+        """
+        Returns the limit's configuration and admission counters.
+        """
+        with self._lock:
+            return {"per_minute": self.rate * 60, "burst": self.burst, "max_wait": self.max_wait,
+                    "users": len(self.buckets), **self._stats}
@@ -1,16 +1,22 @@
 import os
+import threading
 import time
 from typing import Dict
 import jwt
-import bcrypt
 from fastapi import Request, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field
-from backend.Utility import CustomException
+from backend.Database.conn.Locks import FileLock
+from backend.PasswordHashing import PasswordHasher, HashingQueueFull
+from backend.Utility import CustomException, TTLCache, run_blocking
 from tinydb import TinyDB, Query
 
 JWT_SECRET = os.getenv('AUTH_SECRET')
 JWT_ALGORITHM = "HS256"
+TOKEN_LIFETIME = 86400
+# Bounds of the cache of recently verified tokens
+VERIFIED_TOKENS_CACHE_SIZE = int(os.getenv('VERIFIED_TOKENS_CACHE_SIZE', 4096))
+VERIFIED_TOKENS_CACHE_TTL = float(os.getenv('VERIFIED_TOKENS_CACHE_TTL', 300))
 
 
 def sign_jwt(user_id: str) -> str:
@@ -40,62 +46,13 @@ def decode_jwt(token: str) -> dict:
 
         now = time.time()
         # check if now is less than 1 day from the token generation time
-        if now - decoded_token["generated"] > 86400:
+        if now - decoded_token["generated"] > TOKEN_LIFETIME:
             raise jwt.ExpiredSignatureError
         return decoded_token
     except jwt.ExpiredSignatureError:
         return {}
 
 
-class JWTBearer(HTTPBearer):
-    """
-    A custom Bearer token class that verifies the token using the sign_jwt function.
-    """
-
-    def __init__(self, auto_error: bool = True):
-        """
-        Initialize the JWTBearer class.
-
-        :param auto_error: Whether to raise an error if the token is invalid or expired.
-        """
-        super(JWTBearer, self).__init__(auto_error=auto_error)
-
-    async def __call__(self, request: Request):
-        """
-        Verify the token and return the token if it is valid.
-
-        :param request: The request object.
-        :return: The token if it is valid.
-        """
-        credentials: HTTPAuthorizationCredentials = await super(JWTBearer, self).__call__(request)
-        if credentials:
-            if not credentials.scheme == "Bearer":
-                raise HTTPException(status_code=403, detail="Invalid authentication scheme.")
-            if not self.verify_jwt(credentials.credentials):
-                raise HTTPException(status_code=403, detail="Invalid token or expired token.")
-            return credentials.credentials
-        else:
-            raise HTTPException(status_code=403, detail="Invalid authorization code.")
-
-    def verify_jwt(self, jwtoken: str) -> bool:
-        """
-        Verify the token and return whether it is valid.
-
-        :param jwtoken: The token to be verified.
-        :return: Whether the token is valid.
-        """
-        isTokenValid: bool = False
-
-        try:
-            payload = decode_jwt(jwtoken)
-        except:
-            payload = None
-        if payload:
-            isTokenValid = True
-
-        return isTokenValid
-
-
 class UserSchema(BaseModel):
     """
     A Pydantic model for the user schema.
@@ -121,6 +78,33 @@ class AuthDatabase:
     """
     # Initialize the TinyDB database and the 'users' table.
     users = TinyDB('./backend/authDB.json').table('users')
+    # Guards the database's writes, which can come from several server processes
+    users_lock = FileLock('./backend/authDB.lock')
+    # In-memory index of the users' password hashes by username, loaded on first use
+    user_index: dict[str, str] = None
+    index_lock = threading.Lock()
+    # Password hashing runs in its own process pool, off the event loop
+    hasher = PasswordHasher()
+
+    def get_password_hash(self, username: str) -> str | None:
+        """
+        Get a user's password hash from the in-memory index.
+        On a miss, the user is looked up in the database once, in case another process registered it.
+
+        :param username: The username of the user.
+        :return: The user's password hash, or None if the user does not exist.
+        """
+        with self.index_lock:
+            if AuthDatabase.user_index is None:
+                AuthDatabase.user_index = {user["username"]: user["password"] for user in self.users.all()}
+            if username in self.user_index:
+                return self.user_index[username]
+        user = self.users.get(Query().username == username)
+        if not user:
+            return None
+        with self.index_lock:
+            self.user_index[username] = user["password"]
+        return user["password"]
 
     def user_exists(self, username: str) -> bool:
         """
@@ -129,21 +113,47 @@ class AuthDatabase:
         :param username: The username of the user.
         :return: Whether the user exists.
         """
-        return bool(self.users.search(Query().username == username))
+        return self.get_password_hash(username) is not None
 
-    def authenticate_user(self, user_data: UserSchema) -> str:
+    def insert_user(self, user: 'UserSchema') -> None:
+        """
+        Add a new user to the database, unless another request (possibly in another process) already added it.
+
+        :param user: The user to be added, with the password hashed.
+        """
+        with self.users_lock:
+            if self.users.contains(Query().username == user.username):
+                raise CustomException("User already exists.")
+            self.users.insert(user.dict())
+        with self.index_lock:
+            if self.user_index is not None:
+                self.user_index[user.username] = user.password
+
+    async def run_hasher(self, hashing_call) -> any:
+        """
+        Await a call to the password hasher, rejecting the request with a 503 if the hashing queue is full.
+
+        :param hashing_call: The awaitable hasher call.
+        :return: The result of the call.
+        """
+        try:
+            return await hashing_call
+        except HashingQueueFull as exc:
+            raise HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": "1"})
+
+    async def authenticate_user(self, user_data: UserSchema) -> str:
         """
         Authenticate a user. If the user exists and the password is correct, return a signed JWT token.
 
         :param user_data: The user data to be authenticated.
         :return: The signed JWT token.
         """
-        user = self.users.get(Query().username == user_data.username)
-        if user and bcrypt.checkpw(user_data.password.encode("utf-8"), user["password"].encode("utf-8")):
+        password_hash = await run_blocking(self.get_password_hash, user_data.username)
+        if password_hash and await self.run_hasher(self.hasher.check(user_data.password, password_hash)):
             return sign_jwt(user_data.username)
         raise CustomException("Invalid credentials.")
 
-    def register_user(self, user_data: UserSchema) -> str:
+    async def register_user(self, user_data: UserSchema) -> str:
         """
         Register a user.
         If the user does not exist, hash the password and add the user to the database.
@@ -152,7 +162,7 @@ class AuthDatabase:
         :return: The signed JWT token.
         """
         username = user_data.username
-        if self.user_exists(username):
+        if await run_blocking(self.user_exists, username):
             raise CustomException("User already exists.")
         password = user_data.password
 
@@ -169,21 +179,63 @@ class AuthDatabase:
         if not any(char in "!@#$%^&*()-+" for char in password):
             raise CustomException("Password must contain at least one special character.")
 
-        hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
-        new_user = UserSchema(username=username, password=hashed_password.decode("utf-8"))
-        self.users.insert(new_user.dict())
+        hashed_password = await self.run_hasher(self.hasher.hash(password))
+        new_user = UserSchema(username=username, password=hashed_password)
+        await run_blocking(self.insert_user, new_user)
         return sign_jwt(username)
 
-    def decode_token(self, token: str) -> str:
+
+class AuthenticatedUser(HTTPBearer):
+    """
+    A Bearer token dependency that verifies the token once per request and returns the authenticated username.
+    Recently verified tokens are kept in a bounded, expiring cache, so repeated requests skip the JWT decoding and
+    the user lookup.
+    """
+
+    def __init__(self, auth_db: AuthDatabase, auto_error: bool = True):
+        """
+        Initialize the AuthenticatedUser class.
+
+        :param auth_db: The authentication database to look the users up in.
+        :param auto_error: Whether to raise an error if the token is invalid or expired.
+        """
+        super(AuthenticatedUser, self).__init__(auto_error=auto_error)
+        self.auth_db = auth_db
+        self.verified_tokens = TTLCache(VERIFIED_TOKENS_CACHE_SIZE, VERIFIED_TOKENS_CACHE_TTL)
+
+    async def __call__(self, request: Request) -> str:
         """
-        Decode a JWT token and return the user_id.
+        Verify the token and return the username it was signed for.
 
-        :param token: The token to be decoded.
-        :return: The user_id.
+        :param request: The request object.
+        :return: The authenticated username.
         """
-        decoded = decode_jwt(token)
-        if decoded:
-            username = decoded["user_id"]
-            if self.user_exists(username):
-                return username
-        raise CustomException("Invalid or expired token.")
+        credentials: HTTPAuthorizationCredentials = await super(AuthenticatedUser, self).__call__(request)
+        if not credentials:
+            raise HTTPException(status_code=403, detail="Invalid authorization code.")
+        if not credentials.scheme == "Bearer":
+            raise HTTPException(status_code=403, detail="Invalid authentication scheme.")
+
+        username = self.verified_tokens.get(credentials.credentials)
+        if username is None:
+            # The user lookup may load the database, off the event loop
+            username = await run_blocking(self.verify_token, credentials.credentials)
+        return username
+
+    def verify_token(self, token: str) -> str:
+        """
+        Fully verify the token, and cache it until it expires (or at most for the cache's ttl).
+
+        :param token: The token to be verified.
+        :return: The username the token was signed for.
+        """
+        try:
+            payload = decode_jwt(token)
+        except Exception:
+            payload = None
+        if not payload or not self.auth_db.user_exists(payload["user_id"]):
+            raise HTTPException(status_code=403, detail="Invalid token or expired token.")
+
+        time_left = payload["generated"] + TOKEN_LIFETIME - time.time()
+        self.verified_tokens.put(token, payload["user_id"], min(time_left, VERIFIED_TOKENS_CACHE_TTL))
+        return payload["user_id"]
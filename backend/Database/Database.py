@@ -1,9 +1,24 @@
 import logging
+import os
 import time
 from backend.Types.SaveData import SaveData
-from backend.Database.conn.ConnClass import Connection
-from backend.Database.conn.FirestoreConn import FirestoreConn
-from backend.Utility import start_promise, CustomException
+from backend.Database.conn.ConnClass import Connection, make_thumbnail, THUMBNAIL_SUFFIX
+from backend.Database.conn.LocalConn import LocalConn
+from backend.Database.SaveEvents import SaveEventBus
+from backend.Utility import start_promise, run_blocking, CustomException
+
+# The database backend: "firestore", or "local" for the local files database (see LocalConn)
+DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', 'firestore')
+
+
+def save_event_data(data: SaveData) -> dict:
+    """
+    Returns the summary of a committed save that is published to the save's event bus.
+
+    :param data: the committed save data
+    :return: the save's version, story status and shop status
+    """
+    return {"ver": data.ver, "status": data.story.get("status", ""), "shop": data.shop.status}
 
 
 def get_current_timestamp() -> int:
@@ -18,10 +33,16 @@ def get_current_timestamp() -> int:
 class DataBase:
     conn: Connection = None
     gen_img: bool = False
+    events: SaveEventBus = SaveEventBus()
 
     def __init__(self):
         try:
-            self.conn = FirestoreConn()
+            if DATABASE_BACKEND == "local":
+                self.conn = LocalConn()
+            else:
+                # Imported here, so the local database doesn't require the Firebase packages
+                from backend.Database.conn.FirestoreConn import FirestoreConn
+                self.conn = FirestoreConn()
         except Exception as e:
             raise CustomException(f"Failed to connect to database: {e}.")
 
@@ -36,14 +57,21 @@ class DataBase:
     def save_game_data(self, username: str, save_name: str, data: SaveData) -> None:
         """
         Saves the current game data to the Database.
+        The version check and the commit are done under the user's lock, so no other process can commit in between.
+        A newer history summary of the committed save is kept.
         """
         logging.info(f"Saving game: {save_name}")
         logging.debug(f"Data: {data}")
-        if data.ver < self.get_save_data(username, save_name).ver:
-            logging.warning("Tried to commit earlier version. aborting commit.")
-        else:
-            timestamp = get_current_timestamp()
-            self.conn.commit(username, save_name, data.to_dict(), timestamp)
+        with self.conn.lock(username):
+            current_data = self.get_save_data(username, save_name)
+            if data.ver < current_data.ver:
+                logging.warning("Tried to commit earlier version. aborting commit.")
+            else:
+                # Keep a history summary committed in the background since the data was loaded
+                data.merge_summary(current_data)
+                timestamp = get_current_timestamp()
+                self.conn.commit(username, save_name, data.to_dict(), timestamp)
+                self.events.publish(username, save_name, "save", save_event_data(data))
         logging.info(f"Save completed: {save_name}")
 
     def create_save(self, username: str, save_name: str, data: SaveData) -> None:
@@ -54,12 +82,14 @@ class DataBase:
         :param save_name: the name of the save file
         :param data: the data to be saved
         """
-        if self.save_exists(username, save_name):
-            raise Exception("Save already exists.")
+        with self.conn.lock(username):
+            if save_name in self.conn.get_all_saves(username):
+                raise Exception("Save already exists.")
 
-        logging.info(f"Creating save: {save_name}")
-        timestamp = get_current_timestamp()
-        self.conn.commit(username, save_name, data.to_dict(), timestamp)
+            logging.info(f"Creating save: {save_name}")
+            timestamp = get_current_timestamp()
+            self.conn.commit(username, save_name, data.to_dict(), timestamp)
+            self.events.publish(username, save_name, "save", save_event_data(data))
         logging.info(f"Save created: {save_name}")
 
     def delete_save(self, username: str, save_name: str) -> None:
@@ -71,6 +101,8 @@ class DataBase:
         """
         logging.info(f"Deleting save: {save_name}")
         self.conn.delete(username, save_name)
+        self.events.publish(username, save_name, "deleted")
+        self.events.forget(username, save_name)
         logging.info(f"Save deleted: {save_name}")
 
     def saves_list(self, username: str) -> dict:
@@ -96,6 +128,11 @@ class DataBase:
         :param image_bytes: the image to be saved
         """
         self.conn.save_image(username, save_name, category, image_bytes)
+        try:
+            self.conn.save_image(username, save_name, category + THUMBNAIL_SUFFIX, make_thumbnail(image_bytes))
+        except Exception:
+            logging.exception(f"Error saving thumbnail of {category} image:")
+        self.events.publish(username, save_name, "image", {"category": category})
         logging.info(f"Image saved: {save_name}")
 
     def get_save_image(self, username: str, save_name: str, category: str) -> str:
@@ -149,3 +186,171 @@ class DataBase:
         :param save_name: the name of the save file
         """
         self.conn.delete_all_cache(username, save_name)
+
+    # ---------------------------------------------- #
+    # -------------- Async Operations -------------- #
+    # ---------------------------------------------- #
+
+    async def get_save_data_async(self, username: str, save_name: str) -> SaveData:
+        """
+        Returns the content of the save file, without blocking the event loop.
+
+        :return: the content of the save file
+        """
+        return SaveData(await self.conn.read_async(username, save_name))
+
+    async def save_game_data_async(self, username: str, save_name: str, data: SaveData) -> None:
+        """
+        Saves the current game data to the Database, without blocking the event loop.
+        """
+        await run_blocking(self.save_game_data, username, save_name, data)
+
+    async def create_save_async(self, username: str, save_name: str, data: SaveData) -> None:
+        """
+        Creates a new save file with the given name and data, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        :param data: the data to be saved
+        """
+        await run_blocking(self.create_save, username, save_name, data)
+
+    async def delete_save_async(self, username: str, save_name: str) -> None:
+        """
+        Deletes the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        """
+        logging.info(f"Deleting save: {save_name}")
+        await self.conn.delete_async(username, save_name)
+        self.events.publish(username, save_name, "deleted")
+        self.events.forget(username, save_name)
+        logging.info(f"Save deleted: {save_name}")
+
+    async def saves_list_async(self, username: str) -> dict:
+        """
+        Returns the list of user's saves in the Database, without blocking the event loop.
+        """
+        user_data = await self.conn.read_all_async(username)
+        return {save_id: SaveData(user_data[save_id]).background["name"]
+                for save_id in user_data.keys() if save_id != "timestamp"}
+
+    async def save_image_async(self, username: str, save_name: str, category: str, image_bytes: bytes) -> None:
+        """
+        Saves the image to the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        :param category: the category of the image
+        :param image_bytes: the image to be saved
+        """
+        await self.conn.save_image_async(username, save_name, category, image_bytes)
+        try:
+            thumbnail = await run_blocking(make_thumbnail, image_bytes, pool="image")
+            await self.conn.save_image_async(username, save_name, category + THUMBNAIL_SUFFIX, thumbnail)
+        except Exception:
+            logging.exception(f"Error saving thumbnail of {category} image:")
+        self.events.publish(username, save_name, "image", {"category": category})
+        logging.info(f"Image saved: {save_name}")
+
+    async def get_save_image_async(self, username: str, save_name: str, category: str) -> str:
+        """
+        Returns the image of the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        :param category: the category of the image
+        :return: the image of the save file, as a base64 encoded string
+        """
+        return await self.conn.return_image_string_async(username, save_name, category)
+
+    async def get_save_image_bytes_async(self, username: str, save_name: str, category: str) -> bytes:
+        """
+        Returns the raw image of the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        :param category: the category of the image
+        :return: the image bytes
+        """
+        return await self.conn.return_image_bytes_async(username, save_name, category)
+
+    async def get_save_image_hash_async(self, username: str, save_name: str, category: str) -> str:
+        """
+        Returns the content hash of the image of the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        :param category: the category of the image
+        :return: the hash of the image
+        """
+        return await self.conn.return_image_hash_async(username, save_name, category)
+
+    async def cache_async(self, username: str, save_name: str, key: str, data: any):
+        """
+        Adds a cache to the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        :param key: the key of the cache
+        :param data: the data to be cached
+        """
+        await self.conn.cache_async(username, save_name, key, data)
+
+    async def get_cache_async(self, username: str, save_name: str, key: str):
+        """
+        Returns the cache of the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        :param key: the key of the cache
+        :return: the cache of the save file
+        """
+        return await self.conn.get_cache_async(username, save_name, key)
+
+    async def delete_cache_async(self, username: str, save_name: str, key: str):
+        """
+        Deletes the cache of the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        :param key: the key of the cache
+        """
+        await self.conn.delete_cache_async(username, save_name, key)
+
+    async def delete_all_cache_async(self, username: str, save_name: str):
+        """
+        Deletes all caches of the save file with the given name, without blocking the event loop.
+
+        :param username: the name of the user
+        :param save_name: the name of the save file
+        """
+        await self.conn.delete_all_cache_async(username, save_name)
+
+    async def acquire_lease_async(self, name: str, ttl: float) -> bool:
+        """
+        Acquires a named lease for this process, without blocking the event loop.
+
+        :param name: the name of the lease
+        :param ttl: the time to live of the lease, in seconds
+        :return: True if the lease was acquired, False if another process owns it
+        """
+        return await self.conn.acquire_lease_async(name, ttl)
+
+    async def release_lease_async(self, name: str) -> None:
+        """
+        Releases a named lease owned by this process, without blocking the event loop.
+
+        :param name: the name of the lease
+        """
+        await self.conn.release_lease_async(name)
+
+    async def lease_held_elsewhere_async(self, name: str) -> bool:
+        """
+        Checks whether a named lease is owned by another process, without blocking the event loop.
+
+        :param name: the name of the lease
+        :return: True if another process owns the lease
+        """
+        return await self.conn.lease_held_elsewhere_async(name)
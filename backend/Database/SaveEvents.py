@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+import threading
+from typing import AsyncIterator
+from backend.Utility import TTLCache
+
+# Bounds of the saves whose sequence numbers and recent events are kept: the number of saves, and the time since a
+# save's last event after which they're dropped, in seconds
+SAVE_EVENTS_CACHE_SIZE = int(os.getenv('SAVE_EVENTS_CACHE_SIZE', 10000))
+SAVE_EVENTS_CACHE_TTL = float(os.getenv('SAVE_EVENTS_CACHE_TTL', 3600))
+
+
+class SaveEventBus:
+    """
+    Lightweight per-save change notification bus.
+    The Database publishes an event on every change it commits to a save, and clients can wait for the events that
+    followed the last one they saw, instead of re-fetching the whole save to find out what changed.
+    Each save keeps its own increasing sequence number and a short history of recent events, dropped once the save
+    is deleted or has been idle for a while, after which its sequence starts over.
+    Publishing is thread-safe, waiting is done on the event loop.
+    """
+
+    def __init__(self, history_size: int = 32, max_saves: int = SAVE_EVENTS_CACHE_SIZE,
+                 ttl: float = SAVE_EVENTS_CACHE_TTL):
+        """
+        :param history_size: The number of recent events kept for each save.
+        :param max_saves: The number of saves whose events are kept.
+        :param ttl: The time a save's events are kept after its last event, in seconds.
+        """
+        self.history_size = history_size
+        self._lock = threading.Lock()
+        # The sequence number and the recent events of each save, by (username, save name)
+        self._saves = TTLCache(max_saves, ttl)
+        self._waiters: dict[tuple[str, str], set[tuple[asyncio.AbstractEventLoop, asyncio.Future]]] = {}
+
+    def publish(self, username: str, save_name: str, event: str, data: dict = None) -> None:
+        """
+        Publishes an event for a save, waking all of its waiters.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param event: The type of the event.
+        :param data: The data of the event.
+        """
+        key = (username, save_name)
+        with self._lock:
+            sequence, history = self._saves.get(key, (0, []))
+            published = {"seq": sequence + 1, "event": event, "data": data or {}}
+            self._saves.put(key, (sequence + 1, (history + [published])[-self.history_size:]))
+            waiters = self._waiters.pop(key, set())
+        logging.debug(f"Published save event {event} #{sequence + 1} for save: {save_name}")
+
+        # A waiter had seen all the events before this one, it's handed the event in case the save is dropped meanwhile
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._wake, future, [published])
+
+    @staticmethod
+    def _wake(future: asyncio.Future, events: list[dict]) -> None:
+        if not future.done():
+            future.set_result(events)
+
+    def last_sequence(self, username: str, save_name: str) -> int:
+        """
+        Returns the sequence number of the last event published for the save, 0 if there is none.
+        """
+        with self._lock:
+            return self._saves.get((username, save_name), (0, []))[0]
+
+    def events_since(self, username: str, save_name: str, since: int) -> list[dict]:
+        """
+        Returns the recent events of the save that followed the given sequence number.
+        A sequence number ahead of the save's (e.g. from before a server restart) returns all the recent events.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param since: The sequence number of the last event seen.
+        :return: The list of events, oldest first.
+        """
+        with self._lock:
+            return self._events_since(username, save_name, since)
+
+    def _events_since(self, username: str, save_name: str, since: int) -> list[dict]:
+        sequence, history = self._saves.get((username, save_name), (0, []))
+        if since > sequence:
+            since = 0
+        return [event for event in history if event["seq"] > since]
+
+    def clear(self, username: str, save_name: str) -> None:
+        """
+        Drops the history of a save, leaving its sequence number as is.
+        """
+        key = (username, save_name)
+        with self._lock:
+            sequence, _ = self._saves.get(key, (0, []))
+            if sequence:
+                self._saves.put(key, (sequence, []))
+
+    def forget(self, username: str, save_name: str) -> None:
+        """
+        Drops the sequence number and the history of a save, e.g. once it's deleted.
+        The waiters of the save are still woken by its next event.
+        """
+        with self._lock:
+            self._saves.discard((username, save_name))
+
+    async def wait(self, username: str, save_name: str, since: int, timeout: float) -> list[dict]:
+        """
+        Waits until the save has events following the given sequence number, or until the timeout passes.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param since: The sequence number of the last event seen.
+        :param timeout: The maximum time to wait, in seconds.
+        :return: The list of new events, empty if the timeout passed.
+        """
+        key = (username, save_name)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            events = self._events_since(username, save_name, since)
+            if events:
+                return events
+            self._waiters.setdefault(key, set()).add(waiter)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return []
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(key)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters[key]
+
+    async def subscribe(self, username: str, save_name: str, since: int = 0,
+                        keepalive: float = 15) -> AsyncIterator[dict]:
+        """
+        Subscribes to the events of a save, yielding every event that follows the given sequence number.
+        Yields an empty dict every keepalive seconds without events, so a push connection can be kept open.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param since: The sequence number of the last event seen.
+        :param keepalive: The time between keepalive yields, in seconds.
+        """
+        while True:
+            events = await self.wait(username, save_name, since, keepalive)
+            if not events:
+                yield {}
+            for event in events:
+                since = event["seq"]
+                yield event
@@ -1,4 +1,20 @@
+import base64
+import functools
 import hashlib
+import io
+import os
+import pathlib
+import threading
+import time
+from PIL import Image
+from backend.Utility import run_blocking
+
+# The categories of the images of a save
+IMAGE_CATEGORIES = ["shop", "character", "scene"]
+# Thumbnails are stored as a category of their own, named after the full image's category with this suffix
+THUMBNAIL_SUFFIX = "_thumb"
+# The size of the thumbnails' longer side, in pixels
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', 256))
 
 
 def hash_key(key: str) -> str:
@@ -11,12 +27,119 @@ def hash_key(key: str) -> str:
     return hashlib.sha256(key.encode()).hexdigest()
 
 
+def default_image_path(category: str) -> str:
+    """
+    This function is used to get the path of the default image of a category, used when a save has no image.
+
+    :param category: The category of the image.
+    :return: The path of the default image.
+    """
+    return str(pathlib.Path(__file__).parent.resolve()) + "/default_" + category + ".jpg"
+
+
+def image_hash(image_bytes: bytes) -> str:
+    """
+    This function is used to hash an image's content, to be used as its version tag.
+
+    :param image_bytes: The image bytes.
+    :return: The hex digest of the image.
+    """
+    return hashlib.md5(image_bytes).hexdigest()
+
+
+def make_thumbnail(image_bytes: bytes) -> bytes:
+    """
+    This function is used to create the thumbnail of an image.
+
+    :param image_bytes: The image bytes.
+    :return: The thumbnail's JPEG bytes.
+    """
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    thumbnail = io.BytesIO()
+    image.save(thumbnail, "JPEG", quality=85, optimize=True)
+    return thumbnail.getvalue()
+
+
+@functools.lru_cache
+def default_image(category: str) -> bytes:
+    """
+    This function is used to get the default image of a category (or its thumbnail), used when a save has no image.
+
+    :param category: The category of the image.
+    :return: The default image bytes.
+    """
+    if category.endswith(THUMBNAIL_SUFFIX):
+        return make_thumbnail(default_image(category[:-len(THUMBNAIL_SUFFIX)]))
+    with open(default_image_path(category), "rb") as image_file:
+        return image_file.read()
+
+
+@functools.lru_cache
+def default_image_hash(category: str) -> str:
+    return image_hash(default_image(category))
+
+
 class Connection:
     """
     This is the abstract class for the connection classes.
     The connection classes are used to connect to the database and perform operations on it.
+    Every operation also has an awaitable "_async" variant, which by default runs the blocking operation
+    in the async context. Connections with a native async client can override them.
+
+    Connections also provide locks and leases for coordinating between processes sharing the same database.
+    The default implementations only coordinate the threads of this process, and connections that can be shared by
+    several processes (e.g. multiple server workers) should override them.
     """
 
+    _locks_guard = threading.Lock()
+    _user_locks: dict[str, threading.RLock] = {}
+    _leases: dict[str, float] = {}
+
+    def lock(self, username: str):
+        """
+        This method is used to get an exclusive, reentrant lock over a user's saves, to be used as a context manager.
+        Read-check-write sequences over a user's saves must hold it.
+
+        :param username: The username of the user.
+        :return: The lock.
+        """
+        with self._locks_guard:
+            if username not in self._user_locks:
+                self._user_locks[username] = threading.RLock()
+            return self._user_locks[username]
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        """
+        This method is used to acquire a named lease, giving this process the ownership of a task for a limited time.
+        Re-acquiring a lease this process already owns extends it.
+
+        :param name: The name of the lease.
+        :param ttl: The time to live of the lease, in seconds.
+        :return: True if the lease was acquired, False if another process owns it.
+        """
+        with self._locks_guard:
+            self._leases[name] = time.time() + ttl
+            return True
+
+    def release_lease(self, name: str) -> None:
+        """
+        This method is used to release a named lease owned by this process.
+
+        :param name: The name of the lease.
+        """
+        with self._locks_guard:
+            self._leases.pop(name, None)
+
+    def lease_held_elsewhere(self, name: str) -> bool:
+        """
+        This method is used to check whether a named lease is currently owned by another process.
+
+        :param name: The name of the lease.
+        :return: True if another process owns the lease, False otherwise.
+        """
+        return False
+
     def read(self, username: str, save_name: str) -> dict | None:
         """
         This method is used to read a specific save's data from the database.
@@ -88,6 +211,36 @@ class Connection:
         """
         raise NotImplementedError
 
+    def has_image(self, username: str, save_name: str, category: str) -> bool:
+        """
+        This method is used to check whether the save has an image of a category.
+
+        :param username: The username of the user.
+        :param save_name: The name of the save.
+        :param category: The category of the image.
+        :return: Whether the image exists.
+        """
+        raise NotImplementedError
+
+    def backfill_thumbnail(self, username: str, save_name: str, category: str) -> bytes | None:
+        """
+        This method is used to create and save a missing thumbnail from its full image, for the saves created before
+        their images had thumbnails.
+
+        :param username: The username of the user.
+        :param save_name: The name of the save.
+        :param category: The category of the missing image.
+        :return: The thumbnail's bytes, or None if the category isn't a thumbnail or the full image is missing too.
+        """
+        if not category.endswith(THUMBNAIL_SUFFIX):
+            return None
+        full_category = category[:-len(THUMBNAIL_SUFFIX)]
+        if not self.has_image(username, save_name, full_category):
+            return None
+        thumbnail = make_thumbnail(self.return_image_bytes(username, save_name, full_category))
+        self.save_image(username, save_name, category, thumbnail)
+        return thumbnail
+
     def return_image_string(self, username: str, save_name: str, category: str) -> str:
         """
         This method is used to return the save's image bytes as a string.
@@ -99,6 +252,29 @@ class Connection:
         """
         raise NotImplementedError
 
+    def return_image_bytes(self, username: str, save_name: str, category: str) -> bytes:
+        """
+        This method is used to return the save's image bytes, or the category's default image if it has none.
+
+        :param username: The username of the user.
+        :param save_name: The name of the save.
+        :param category: The category of the image.
+        :return: The image bytes.
+        """
+        return base64.b64decode(self.return_image_string(username, save_name, category))
+
+    def return_image_hash(self, username: str, save_name: str, category: str) -> str:
+        """
+        This method is used to return the hash of the save's image (see image_hash), without loading the image
+        where the database allows it.
+
+        :param username: The username of the user.
+        :param save_name: The name of the save.
+        :param category: The category of the image.
+        :return: The hash of the image.
+        """
+        return image_hash(self.return_image_bytes(username, save_name, category))
+
     def cache(self, username: str, save_name: str, key: str, data: any) -> None:
         """
         This method is used to cache data in the database.
@@ -140,3 +316,55 @@ class Connection:
         :param save_name: The name of the save.
         """
         raise NotImplementedError
+
+    # ---------------------------------------------- #
+    # -------------- Async Operations -------------- #
+    # ---------------------------------------------- #
+
+    async def read_async(self, username: str, save_name: str) -> dict | None:
+        return await run_blocking(self.read, username, save_name)
+
+    async def read_all_async(self, username: str) -> dict:
+        return await run_blocking(self.read_all, username)
+
+    async def commit_async(self, username: str, save_name: str, data: dict, timestamp: int) -> None:
+        await run_blocking(self.commit, username, save_name, data, timestamp)
+
+    async def delete_async(self, username: str, save_name: str) -> None:
+        await run_blocking(self.delete, username, save_name)
+
+    async def get_all_saves_async(self, username: str) -> list[str]:
+        return await run_blocking(self.get_all_saves, username)
+
+    async def save_image_async(self, username: str, save_name: str, category: str, image_bytes: bytes) -> None:
+        await run_blocking(self.save_image, username, save_name, category, image_bytes)
+
+    async def return_image_string_async(self, username: str, save_name: str, category: str) -> str:
+        return await run_blocking(self.return_image_string, username, save_name, category)
+
+    async def return_image_bytes_async(self, username: str, save_name: str, category: str) -> bytes:
+        return await run_blocking(self.return_image_bytes, username, save_name, category)
+
+    async def return_image_hash_async(self, username: str, save_name: str, category: str) -> str:
+        return await run_blocking(self.return_image_hash, username, save_name, category)
+
+    async def cache_async(self, username: str, save_name: str, key: str, data: any) -> None:
+        await run_blocking(self.cache, username, save_name, key, data)
+
+    async def get_cache_async(self, username: str, save_name: str, key: str) -> dict | None:
+        return await run_blocking(self.get_cache, username, save_name, key)
+
+    async def delete_cache_async(self, username: str, save_name: str, key: str) -> None:
+        await run_blocking(self.delete_cache, username, save_name, key)
+
+    async def delete_all_cache_async(self, username: str, save_name: str) -> None:
+        await run_blocking(self.delete_all_cache, username, save_name)
+
+    async def acquire_lease_async(self, name: str, ttl: float) -> bool:
+        return await run_blocking(self.acquire_lease, name, ttl)
+
+    async def release_lease_async(self, name: str) -> None:
+        await run_blocking(self.release_lease, name)
+
+    async def lease_held_elsewhere_async(self, name: str) -> bool:
+        return await run_blocking(self.lease_held_elsewhere, name)
@@ -1,8 +1,57 @@
 import base64
-import pathlib
+import threading
+import time
 
 from firebase_admin import credentials, firestore, initialize_app, storage
-from backend.Database.conn.ConnClass import Connection, hash_key
+from backend.Database.conn.ConnClass import Connection, hash_key, default_image, default_image_hash, IMAGE_CATEGORIES, \
+    THUMBNAIL_SUFFIX, image_hash
+from backend.Database.conn.Locks import PROCESS_ID
+
+# The time to live of a user lock's lease, bounding how long a crashed process can keep the lock
+USER_LOCK_TTL = 30
+# The time between attempts to take a user lock held by another process, in seconds
+USER_LOCK_POLL_INTERVAL = 0.05
+
+
+class FirestoreLock:
+    """
+    A reentrant lock shared by the threads of this process and by other processes, backed by a Firestore lease.
+    Only the outermost acquisition in this process takes the lease.
+    """
+
+    def __init__(self, conn: 'FirestoreConn', name: str):
+        self.conn = conn
+        self.name = name
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+
+    def acquire(self) -> None:
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                while not self.conn.acquire_lease(self.name, USER_LOCK_TTL):
+                    time.sleep(USER_LOCK_POLL_INTERVAL)
+            except Exception:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                self.conn.release_lease(self.name)
+            finally:
+                self._thread_lock.release()
+        else:
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
 
 
 class FirestoreConn(Connection):
@@ -16,6 +65,47 @@ class FirestoreConn(Connection):
         initialize_app(cred, {'storageBucket': 'gengamedatabase.appspot.com'})
         self.db = firestore.client()
         self.bucket = storage.bucket()
+        self.user_locks: dict[str, FirestoreLock] = {}
+        self.user_locks_guard = threading.Lock()
+
+    def lock(self, username: str) -> FirestoreLock:
+        with self.user_locks_guard:
+            if username not in self.user_locks:
+                self.user_locks[username] = FirestoreLock(self, "user_lock/" + str(username))
+            return self.user_locks[username]
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        lease_ref = self.db.collection("leases").document(hash_key(name))
+
+        @firestore.transactional
+        def try_acquire(transaction) -> bool:
+            lease = lease_ref.get(transaction=transaction)
+            if lease.exists:
+                lease = lease.to_dict()
+                if lease["owner"] != PROCESS_ID and lease["expires"] > time.time():
+                    return False
+            transaction.set(lease_ref, {"owner": PROCESS_ID, "expires": time.time() + ttl})
+            return True
+
+        return try_acquire(self.db.transaction())
+
+    def release_lease(self, name: str) -> None:
+        lease_ref = self.db.collection("leases").document(hash_key(name))
+
+        @firestore.transactional
+        def try_release(transaction) -> None:
+            lease = lease_ref.get(transaction=transaction)
+            if lease.exists and lease.to_dict()["owner"] == PROCESS_ID:
+                transaction.delete(lease_ref)
+
+        try_release(self.db.transaction())
+
+    def lease_held_elsewhere(self, name: str) -> bool:
+        lease = self.db.collection("leases").document(hash_key(name)).get()
+        if not lease.exists:
+            return False
+        lease = lease.to_dict()
+        return lease["owner"] != PROCESS_ID and lease["expires"] > time.time()
 
     def read(self, username: str, save_name: str) -> dict | None:
         if not username:
@@ -72,8 +162,7 @@ class FirestoreConn(Connection):
             if save_name in cache_data.to_dict():
                 self.db.collection("cache").document(username).update({save_name: firestore.DELETE_FIELD})
 
-        img_categories = ["shop", "character", "scene"]
-        for category in img_categories:
+        for category in IMAGE_CATEGORIES + [category + THUMBNAIL_SUFFIX for category in IMAGE_CATEGORIES]:
             blob = self.bucket.blob(username + "_" + save_name + "_" + category + ".jpg")
             if blob.exists():
                 blob.delete()
@@ -97,12 +186,24 @@ class FirestoreConn(Connection):
         blob.upload_from_string(image_bytes, content_type='image/jpg')
 
     def return_image_string(self, username: str, save_name: str, category: str) -> str:
+        return base64.b64encode(self.return_image_bytes(username, save_name, category)).decode()
+
+    def has_image(self, username: str, save_name: str, category: str) -> bool:
+        return self.bucket.blob(username + "_" + save_name + "_" + category + ".jpg").exists()
+
+    def return_image_bytes(self, username: str, save_name: str, category: str) -> bytes:
         blob = self.bucket.blob(username + "_" + save_name + "_" + category + ".jpg")
         if not blob.exists():
-            with open(str(pathlib.Path(__file__).parent.resolve()) + "/default_" + category + ".jpg", "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode()
-        img_bytes = blob.download_as_string()
-        return base64.b64encode(img_bytes).decode()
+            return self.backfill_thumbnail(username, save_name, category) or default_image(category)
+        return blob.download_as_bytes()
+
+    def return_image_hash(self, username: str, save_name: str, category: str) -> str:
+        # Only the blob's metadata is fetched, which holds the MD5 hash of its content
+        blob = self.bucket.get_blob(username + "_" + save_name + "_" + category + ".jpg")
+        if blob is None:
+            thumbnail = self.backfill_thumbnail(username, save_name, category)
+            return default_image_hash(category) if thumbnail is None else image_hash(thumbnail)
+        return base64.b64decode(blob.md5_hash).hex()
 
     def cache(self, username: str, save_name: str, key: str, data: any) -> None:
         if not self.db.collection("cache").document(username).get().exists:
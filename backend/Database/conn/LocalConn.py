@@ -6,45 +6,74 @@ import os
 import pathlib
 import threading
 from PIL import Image
-from backend.Database.conn.ConnClass import Connection, hash_key
+from backend.Utility import TTLCache
+from backend.Database.conn.ConnClass import Connection, hash_key, default_image, default_image_hash, image_hash, \
+    IMAGE_CATEGORIES, THUMBNAIL_SUFFIX
+from backend.Database.conn.Locks import FileLeases, FileLock
 
 
 class LocalConn(Connection):
     """
     This class is used to connect to the local database.
     The local database is a folder in the backend directory that contains the user's data.
+    The user files are guarded by file locks and replaced atomically, so several server processes can share the folder.
     """
 
-    saves_path = str(pathlib.Path(__file__).parent.resolve()) + '/local_db'
-    save_lock = threading.Lock()
-    cache_lock = threading.Lock()
+    saves_path = os.getenv('LOCAL_DB_PATH', str(pathlib.Path(__file__).parent.resolve()) + '/local_db')
+    file_locks: dict[str, FileLock] = {}
+    file_locks_guard = threading.Lock()
+    # The hashes of the images by path, along with the file stats they were computed for
+    image_hashes = TTLCache(1024, 3600)
 
     def __init__(self):
         if not os.path.exists(self.saves_path):
             os.mkdir(self.saves_path)
+        self.leases = FileLeases(self.saves_path + "/leases")
+
+    def get_file_lock(self, path: str) -> FileLock:
+        with self.file_locks_guard:
+            if path not in self.file_locks:
+                self.file_locks[path] = FileLock(path)
+            return self.file_locks[path]
 
     @staticmethod
     def save_lock_wrapper(func):
-        def wrapper(self, *args, **kwargs):
-            self.save_lock.acquire()
-            logging.info(f"save-Lock acquired by {func.__name__}")
-            result = func(self, *args, **kwargs)
-            logging.info(f"save-Lock released by {func.__name__}")
-            self.save_lock.release()
-            return result
+        def wrapper(self, username, *args, **kwargs):
+            with self.lock(username):
+                logging.debug(f"save-Lock acquired by {func.__name__}")
+                return func(self, username, *args, **kwargs)
         return wrapper
 
     @staticmethod
     def cache_lock_wrapper(func):
-        def wrapper(self, *args, **kwargs):
-            self.cache_lock.acquire()
-            logging.info(f"cache-Lock acquired by {func.__name__}")
-            result = func(self, *args, **kwargs)
-            logging.info(f"cache-Lock released by {func.__name__}")
-            self.cache_lock.release()
-            return result
+        def wrapper(self, username, *args, **kwargs):
+            with self.get_file_lock(self.saves_path + "/" + str(username) + "_cache.lock"):
+                logging.debug(f"cache-Lock acquired by {func.__name__}")
+                return func(self, username, *args, **kwargs)
         return wrapper
 
+    @staticmethod
+    def write_json(path: str, data: dict) -> None:
+        """
+        This method is used to write a JSON file atomically, so readers never see a partially written file.
+        """
+        temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as temp_file:
+            json.dump(data, temp_file, indent=2, separators=(', ', ' : '))
+        os.replace(temp_path, path)
+
+    def lock(self, username: str) -> FileLock:
+        return self.get_file_lock(self.saves_path + "/" + str(username) + ".lock")
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        return self.leases.acquire(hash_key(name), ttl)
+
+    def release_lease(self, name: str) -> None:
+        self.leases.release(hash_key(name))
+
+    def lease_held_elsewhere(self, name: str) -> bool:
+        return self.leases.held_elsewhere(hash_key(name))
+
     def get_save_path(self, username: str) -> str:
         return self.saves_path + "/" + str(username) + ".json"
 
@@ -58,13 +87,11 @@ class LocalConn(Connection):
         """
         This method is used to validate the user files, creating them if they do not exist.
         """
-        if not os.path.exists(self.get_save_path(username)):
-            with open(self.get_save_path(username), "w") as save_file:
-                json.dump({}, save_file, indent=2, separators=(', ', ' : '))
-
-        if not os.path.exists(self.get_cache_path(username)):
-            with open(self.get_cache_path(username), "w") as save_file:
-                json.dump({}, save_file, indent=2, separators=(', ', ' : '))
+        for path in [self.get_save_path(username), self.get_cache_path(username)]:
+            if not os.path.exists(path):
+                with self.get_file_lock(path[:-len(".json")] + ".lock"):
+                    if not os.path.exists(path):
+                        self.write_json(path, {})
 
     def read(self, username: str, save_name: str) -> dict | None:
         self.validate_user_file(username)
@@ -84,29 +111,25 @@ class LocalConn(Connection):
         self.validate_user_file(username)
         with open(self.get_save_path(username), "r") as save_file:
             user_data = json.load(save_file)
-        with open(self.get_save_path(username), "w") as save_file:
-            user_data[save_name] = data
-            user_data["timestamp"] = timestamp
-            json.dump(user_data, save_file, indent=2, separators=(', ', ' : '))
+        user_data[save_name] = data
+        user_data["timestamp"] = timestamp
+        self.write_json(self.get_save_path(username), user_data)
 
     @save_lock_wrapper
     def commit_all(self, username: str, data: dict, timestamp: int) -> None:
         self.validate_user_file(username)
-        with open(self.get_save_path(username), "w") as save_file:
-            data["timestamp"] = timestamp
-            json.dump(data, save_file, indent=2, separators=(', ', ' : '))
+        data["timestamp"] = timestamp
+        self.write_json(self.get_save_path(username), data)
 
     @save_lock_wrapper
     def delete(self, username: str, save_name: str) -> None:
         self.validate_user_file(username)
         with open(self.get_save_path(username), "r") as save_file:
             user_data = json.load(save_file)
-        with open(self.get_save_path(username), "w") as save_file:
-            del user_data[save_name]
-            json.dump(user_data, save_file, indent=2, separators=(', ', ' : '))
+        del user_data[save_name]
+        self.write_json(self.get_save_path(username), user_data)
 
-        img_categories = ["shop", "character", "scene"]
-        for category in img_categories:
+        for category in IMAGE_CATEGORIES + [category + THUMBNAIL_SUFFIX for category in IMAGE_CATEGORIES]:
             if os.path.exists(self.get_image_path(username, save_name, category)):
                 os.remove(self.get_image_path(username, save_name, category))
 
@@ -122,14 +145,42 @@ class LocalConn(Connection):
 
     def save_image(self, username: str, save_name: str, category: str, image_bytes: bytes) -> None:
         image = Image.open(io.BytesIO(image_bytes))
-        image.save(self.get_image_path(username, save_name, category))
+        path = self.get_image_path(username, save_name, category)
+        temp_path = f"{path[:-len('.jpg')]}.{os.getpid()}-{threading.get_ident()}.tmp.jpg"
+        image.save(temp_path)
+        os.replace(temp_path, path)
 
     def return_image_string(self, username: str, save_name: str, category: str) -> str:
-        if not os.path.exists(self.get_image_path(username, save_name, category)):
-            with open(str(pathlib.Path(__file__).parent.resolve()) + "/default_" + category + ".jpg", "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode()
-        with open(self.get_image_path(username, save_name, category), "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode()
+        return base64.b64encode(self.return_image_bytes(username, save_name, category)).decode()
+
+    def has_image(self, username: str, save_name: str, category: str) -> bool:
+        return os.path.exists(self.get_image_path(username, save_name, category))
+
+    def return_image_bytes(self, username: str, save_name: str, category: str) -> bytes:
+        path = self.get_image_path(username, save_name, category)
+        if not os.path.exists(path):
+            return self.backfill_thumbnail(username, save_name, category) or default_image(category)
+        with open(path, "rb") as image_file:
+            return image_file.read()
+
+    def return_image_hash(self, username: str, save_name: str, category: str) -> str:
+        path = self.get_image_path(username, save_name, category)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if self.backfill_thumbnail(username, save_name, category) is None:
+                return default_image_hash(category)
+            stat = os.stat(path)
+
+        # Images are replaced, never modified in place, so a file with the same stats has the same content
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = self.image_hashes.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with open(path, "rb") as image_file:
+            content_hash = image_hash(image_file.read())
+        self.image_hashes.put(path, (version, content_hash))
+        return content_hash
 
     @cache_lock_wrapper
     def cache(self, username: str, save_name: str, key: str, data: any) -> None:
@@ -139,11 +190,10 @@ class LocalConn(Connection):
                 cache_data = json.load(save_file)
         except Exception:
             cache_data = {}
-        with open(self.get_cache_path(username), "w") as save_file:
-            if save_name not in cache_data:
-                cache_data[save_name] = {}
-            cache_data[save_name][hash_key(key)] = data
-            json.dump(cache_data, save_file, indent=2, separators=(', ', ' : '))
+        if save_name not in cache_data:
+            cache_data[save_name] = {}
+        cache_data[save_name][hash_key(key)] = data
+        self.write_json(self.get_cache_path(username), cache_data)
 
     def get_cache(self, username: str, save_name: str, key: str) -> dict | None:
         self.validate_user_file(username)
@@ -164,9 +214,9 @@ class LocalConn(Connection):
                 cache_data = json.load(save_file)
         except Exception:
             cache_data = {}
-        with open(self.get_cache_path(username), "w") as save_file:
+        if hash_key(key) in cache_data.get(save_name, {}):
             del cache_data[save_name][hash_key(key)]
-            json.dump(cache_data, save_file, indent=2, separators=(', ', ' : '))
+        self.write_json(self.get_cache_path(username), cache_data)
 
     @cache_lock_wrapper
     def delete_all_cache(self, username: str, save_name: str) -> None:
@@ -176,7 +226,6 @@ class LocalConn(Connection):
                 cache_data = json.load(save_file)
         except Exception:
             cache_data = {}
-        with open(self.get_cache_path(username), "w") as save_file:
-            if save_name in cache_data:
-                del cache_data[save_name]
-            json.dump(cache_data, save_file, indent=2, separators=(', ', ' : '))
+        if save_name in cache_data:
+            del cache_data[save_name]
+        self.write_json(self.get_cache_path(username), cache_data)
@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+
+    def _lock_file(file) -> None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(file) -> None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+except ImportError:  # Windows
+    import msvcrt
+
+    def _lock_file(file) -> None:
+        file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue  # LK_LOCK gives up after 10 seconds, keep waiting
+
+    def _unlock_file(file) -> None:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+# Identifies this process as a lease owner, unique even across hosts sharing the same storage
+PROCESS_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class FileLock:
+    """
+    A reentrant lock shared by the threads of this process and by other processes, backed by an OS lock on a file.
+    Only the outermost acquisition in this process takes the file lock.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The path of the lock file, created if it doesn't exist.
+        """
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self) -> None:
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, "a+")
+                _lock_file(self._file)
+            except Exception:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                _unlock_file(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FileLeases:
+    """
+    Time-bounded leases shared across processes, stored as files in a directory.
+    A lease is owned by a single process until it is released or until its time to live passes,
+    and the owning process can re-acquire it to extend it.
+    """
+
+    def __init__(self, directory: str):
+        """
+        :param directory: The directory of the lease files, created if it doesn't exist.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = FileLock(os.path.join(directory, "leases.lock"))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name + ".lease")
+
+    def _read(self, name: str) -> dict | None:
+        try:
+            with open(self._path(name), "r") as lease_file:
+                lease = json.load(lease_file)
+        except (OSError, ValueError):
+            return None
+        if lease["expires"] <= time.time():
+            return None
+        return lease
+
+    def acquire(self, name: str, ttl: float) -> bool:
+        with self._lock:
+            lease = self._read(name)
+            if lease is not None and lease["owner"] != PROCESS_ID:
+                return False
+            with open(self._path(name), "w") as lease_file:
+                json.dump({"owner": PROCESS_ID, "expires": time.time() + ttl}, lease_file)
+            return True
+
+    def release(self, name: str) -> None:
+        with self._lock:
+            lease = self._read(name)
+            if lease is not None and lease["owner"] == PROCESS_ID:
+                os.remove(self._path(name))
+
+    def held_elsewhere(self, name: str) -> bool:
+        with self._lock:
+            lease = self._read(name)
+            return lease is not None and lease["owner"] != PROCESS_ID
@@ -1,15 +1,31 @@
+import json
 import logging
-from typing import Union, Annotated
+import os
+from contextlib import asynccontextmanager
+from typing import Union, Annotated, AsyncIterator
 import uvicorn
-from fastapi import FastAPI, Header, Request, Body, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, Request, Body, Depends, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from backend.Game.Game import Game
 from backend.Utility import LOGGING_CONFIG, CustomException
-from backend.Auth import JWTBearer, UserSchema, AuthDatabase
+from backend.Executors import ExecutorRejected, executors_stats, shutdown_executors
+from backend.Auth import AuthenticatedUser, UserSchema, AuthDatabase
+from backend.Admission import UserRateLimit
+from backend.GenAI.Governor import governors_stats
+from backend.GenAI.LLM.models.HTTPModel import HTTPModel
 from fastapi.middleware.cors import CORSMiddleware
 
 
-app = FastAPI(title="GenGame")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Stops the process pools and threads, then closes the connections to the model APIs
+    AuthDB.hasher.shutdown()
+    shutdown_executors()
+    await HTTPModel.close()
+
+
+app = FastAPI(title="GenGame", lifespan=lifespan)
 # Change CORS handling for prod!
 app.add_middleware(
     CORSMiddleware,
@@ -18,12 +34,34 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Images are private to their user, and may be replaced under the same URL, so clients must revalidate them
+IMAGE_CACHE_CONTROL = "private, no-cache"
+# The number of server processes, sharing the database through its locks and leases
+BACKEND_WORKERS = int(os.getenv('BACKEND_WORKERS', 1))
+# The users allowed to read the server's statistics, comma separated (none by default)
+STATS_USERS = {user.strip() for user in os.getenv('STATS_USERS', '').split(',') if user.strip()}
 AuthDB = AuthDatabase()
+current_user = AuthenticatedUser(AuthDB)
+# Per-user admission of the routes that call the LLM
+advance_limit = UserRateLimit("advance", current_user, per_minute=6, burst=3, max_wait=10)
+new_option_limit = UserRateLimit("new_option", current_user, per_minute=6, burst=3, max_wait=5)
+new_save_limit = UserRateLimit("new_save", current_user, per_minute=2, burst=2, max_wait=0)
+shop_limit = UserRateLimit("shop", current_user, per_minute=20, burst=5, max_wait=5)
+rate_limits = [advance_limit, new_option_limit, new_save_limit, shop_limit]
 API = Game()
 
 
-def run_app():
-    uvicorn.run(app, log_level="critical", log_config=LOGGING_CONFIG)
+def run_app(workers: int = 1):
+    """
+    Run the backend server.
+    With more than one worker, each worker is a separate process importing the app on its own.
+
+    :param workers: The number of server processes.
+    """
+    if workers > 1:
+        uvicorn.run("backend.Endpoint:app", workers=workers, log_level="critical", log_config=LOGGING_CONFIG)
+    else:
+        uvicorn.run(app, log_level="critical", log_config=LOGGING_CONFIG)
 
 
 @app.exception_handler(Exception)
@@ -31,6 +69,13 @@ async def custom_exception_handler(request: Request, exc: Exception):
     headers = getattr(exc, "headers", None)
     if not headers:
         headers = {"Access-Control-Allow-Origin": "*"}
+    if isinstance(exc, ExecutorRejected):
+        logging.warning(f"Rejected request: {request.url}: {str(exc)}")
+        return JSONResponse(
+            status_code=503,
+            content={"message": str(exc)},
+            headers={**headers, "Retry-After": "1"}
+        )
     if isinstance(exc, CustomException):
         logging.error(f"Custom exception found in: {request.url}: {str(exc)}")
         return JSONResponse(
@@ -46,88 +91,136 @@ async def custom_exception_handler(request: Request, exc: Exception):
     )
 
 
+async def server_sent_events(events: AsyncIterator[tuple[str, any]]) -> AsyncIterator[str]:
+    """
+    Formats (event, data) pairs as Server-Sent Events, with the data encoded as JSON.
+    Exceptions raised mid-stream are sent as a final "error" event, since the response has already started.
+    """
+    try:
+        async for event, data in events:
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    except Exception as exc:
+        if isinstance(exc, CustomException):
+            logging.error(f"Custom exception found in stream: {str(exc)}")
+            message = str(exc)
+        else:
+            logging.exception(f"exception found in stream:")
+            message = "The server encountered an error while processing the request."
+        yield f"event: error\ndata: {json.dumps(message)}\n\n"
+
+
 @app.post("/login/", tags=["user"])
 async def login(user: UserSchema = Body(...)):
-    return AuthDB.authenticate_user(user)
+    return await AuthDB.authenticate_user(user)
 
 
 @app.post("/register/", tags=["user"])
 async def create_user(user: UserSchema = Body(...)):
-    return AuthDB.register_user(user)
+    return await AuthDB.register_user(user)
 
 
 @app.get('/startup/')
-def startup():
-    return API.system_startup()
+async def startup():
+    return await API.system_startup()
+
 
+@app.get('/stats/')
+async def stats(username: str = Depends(current_user)):
+    if username not in STATS_USERS:
+        raise HTTPException(status_code=403, detail="Not allowed to read the server's statistics.")
+    return {"executors": executors_stats(), "rate_limits": {limit.name: limit.stats() for limit in rate_limits},
+            "llm_cache": API.LLM.model.response_cache.stats(), "llm_json": API.LLM.model.parse_stats.stats(),
+            "llm_hedging": API.LLM.model.hedging.stats(), "llm_retries": API.LLM.model.retries.stats(),
+            "llm_routes": API.LLM.routes(), "llm_pools": API.LLM.pool_stats(), "governors": governors_stats(),
+            "speculation": API.speculation.stats()}
 
-@app.get('/saves_list/', dependencies=[Depends(JWTBearer())])
-def saves(authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.get_saves_list(username)
+
+@app.get('/saves_list/')
+async def saves(username: str = Depends(current_user)):
+    return await API.get_saves_list(username)
 
 
 @app.get('/themes/')
-def themes():
-    return API.get_available_themes()
+async def themes():
+    return await API.get_available_themes()
+
+
+@app.get('/load/')
+async def load(save_name: str, images: Annotated[str | None, Header()], username: str = Depends(current_user)):
+    return await API.load_save(username, save_name, images == "True")
+
+
+@app.post('/new_save/')
+async def new_save(theme: str, body: dict, images: Annotated[str | None, Header()], username: str = Depends(new_save_limit)):
+    return await API.new_save(username, theme, body['background'], images == "True")
+
+
+@app.get('/delete/')
+async def delete(save_name: str, username: str = Depends(current_user)):
+    return await API.delete_save(username, save_name)
+
 
+@app.get('/advance/')
+async def advance(action: str, save_name: str, images: Annotated[str | None, Header()], username: str = Depends(advance_limit)):
+    return await API.advance_story(username, save_name, action, images == "True")
 
-@app.get('/load/', dependencies=[Depends(JWTBearer())])
-def load(save_name: str, images: Annotated[str | None, Header()], authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.load_save(username, save_name, images == "True")
 
+@app.get('/advance_stream/')
+async def advance_stream(action: str, save_name: str, images: Annotated[str | None, Header()], username: str = Depends(advance_limit)):
+    return StreamingResponse(server_sent_events(API.advance_story_stream(username, save_name, action, images == "True")),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-@app.post('/new_save/', dependencies=[Depends(JWTBearer())])
-def new_save(theme: str, body: dict, images: Annotated[str | None, Header()], authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.new_save(username, theme, body['background'], images == "True")
 
+@app.get('/new_option/')
+async def new_option(new_action: str, save_name: str, username: str = Depends(new_option_limit)):
+    return await API.create_new_option(username, save_name, new_action)
 
-@app.get('/delete/', dependencies=[Depends(JWTBearer())])
-def delete(save_name: str, authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.delete_save(username, save_name)
 
+@app.get('/spend/')
+async def spend(skill: str, save_name: str, username: str = Depends(current_user)):
+    return await API.spend_action_point(username, save_name, skill)
 
-@app.get('/advance/', dependencies=[Depends(JWTBearer())])
-def advance(action: str, save_name: str, images: Annotated[str | None, Header()], authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.advance_story(username, save_name, action, images == "True")
 
+@app.get('/shop/')
+async def shop(save_name: str, images: Annotated[str | None, Header()], username: str = Depends(shop_limit)):
+    return await API.get_shop(username, save_name, images == "True")
 
-@app.get('/new_option/', dependencies=[Depends(JWTBearer())])
-def new_option(new_action: str, save_name: str, authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.create_new_option(username, save_name, new_action)
 
+@app.get('/buy/')
+async def buy(item_name: str, save_name: str, username: str = Depends(current_user)):
+    return await API.buy_item(username, save_name, item_name)
 
-@app.get('/spend/', dependencies=[Depends(JWTBearer())])
-def spend(skill: str, save_name: str, authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.spend_action_point(username, save_name, skill)
 
+@app.get('/sell/')
+async def sell(item_name: str, save_name: str, username: str = Depends(current_user)):
+    return await API.sell_item(username, save_name, item_name)
 
-@app.get('/shop/', dependencies=[Depends(JWTBearer())])
-def shop(save_name: str, images: Annotated[str | None, Header()], authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.get_shop(username, save_name, images == "True")
 
+@app.get('/image/')
+async def image(save_name: str, category: str, username: str = Depends(current_user)):
+    return await API.get_image(username, save_name, category)
 
-@app.get('/buy/', dependencies=[Depends(JWTBearer())])
-def buy(item_name: str, save_name: str, authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.buy_item(username, save_name, item_name)
 
+@app.get('/image_file/')
+async def image_file(save_name: str, category: str, if_none_match: Annotated[str | None, Header()] = None,
+                     username: str = Depends(current_user)):
+    # Any of the client's tags (weak or not) matching the current image means it's up to date
+    client_tags = [tag.strip().removeprefix("W/").strip('"') for tag in (if_none_match or "").split(",")]
+    etag, content = await API.get_image_file(username, save_name, category, client_tags[0] if client_tags[0] else None)
+    if content is None or etag in client_tags:
+        return Response(status_code=304, headers={"ETag": f'"{etag}"', "Cache-Control": IMAGE_CACHE_CONTROL})
+    return Response(content, media_type="image/jpeg",
+                    headers={"ETag": f'"{etag}"', "Cache-Control": IMAGE_CACHE_CONTROL})
 
-@app.get('/sell/', dependencies=[Depends(JWTBearer())])
-def sell(item_name: str, save_name: str, authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.sell_item(username, save_name, item_name)
 
+@app.get('/changes/')
+async def changes(save_name: str, since: int = 0, timeout: float = 25, username: str = Depends(current_user)):
+    return await API.wait_for_changes(username, save_name, since, timeout)
 
-@app.get('/image/', dependencies=[Depends(JWTBearer())])
-def image(save_name: str, category: str, authorization: str = Header(None)):
-    username = AuthDB.decode_token(authorization.split(' ')[1])
-    return API.get_image(username, save_name, category)
 
+@app.get('/changes_stream/')
+async def changes_stream(save_name: str, since: int = 0, username: str = Depends(current_user)):
+    return StreamingResponse(server_sent_events(API.stream_changes(username, save_name, since)),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,210 @@
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+# Rejection policies of a full executor queue:
+# "reject" - the new work is rejected.
+# "drop_lowest" - the lowest priority queued work is dropped for the new work, if the new work's priority is higher.
+REJECT = "reject"
+DROP_LOWEST = "drop_lowest"
+
+# The priority of work by the context it was started from, lower runs first
+PRIORITIES = {"foreground": 0, "image": 0, "maintenance": 5, "speculative": 10}
+
+
+class ExecutorRejected(Exception):
+    """
+    Raised when work is rejected (or dropped from the queue) by a full executor, and should be retried later.
+    """
+
+
+class PriorityExecutor(concurrent.futures.Executor):
+    """
+    A thread pool with a bounded, priority ordered queue.
+    Work waits in the queue by priority (then by submission order), and is rejected by the executor's policy when the
+    queue is full, instead of piling up behind work that can't keep up.
+    Keeps queue depth, wait time and rejection statistics for monitoring.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int, policy: str = REJECT):
+        """
+        :param name: the name of the executor, also used for its threads
+        :param workers: the number of worker threads
+        :param queue_size: the number of work items allowed to wait for a free worker
+        :param policy: the rejection policy when the queue is full, REJECT or DROP_LOWEST
+        """
+        if policy not in [REJECT, DROP_LOWEST]:
+            raise ValueError(f"Unknown rejection policy: {policy}")
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self._condition = threading.Condition()
+        self._queue: list[tuple[int, int, float, concurrent.futures.Future, callable]] = []
+        self._order = itertools.count()
+        self._threads: list[threading.Thread] = []
+        self._idle = 0
+        self._shutdown = False
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "dropped": 0,
+                       "max_depth": 0, "total_wait": 0.0, "max_wait": 0.0, "running": 0}
+
+    def submit(self, function: callable, /, *args, priority: int = 0, **kwargs) -> concurrent.futures.Future:
+        """
+        Submits work to the executor.
+
+        :param function: the function to be executed
+        :param args: the arguments to be passed to the function
+        :param priority: the priority of the work, lower runs first
+        :param kwargs: the keyword arguments to be passed to the function
+        :return: the future of the work's result
+        :raises ExecutorRejected: if the queue is full and the work was rejected
+        """
+        future = concurrent.futures.Future()
+        dropped = None
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError(f"Executor {self.name} is shut down.")
+            if len(self._queue) >= self.queue_size:
+                lowest = max(self._queue) if self._queue else None
+                if self.policy == DROP_LOWEST and lowest is not None and lowest[0] > priority:
+                    self._queue.remove(lowest)
+                    heapq.heapify(self._queue)
+                    self._stats["dropped"] += 1
+                    dropped = lowest[3]
+                else:
+                    self._stats["rejected"] += 1
+                    raise ExecutorRejected(f"The {self.name} executor is full, try again later.")
+
+            heapq.heappush(self._queue, (priority, next(self._order), time.monotonic(), future,
+                                         lambda: function(*args, **kwargs)))
+            self._stats["submitted"] += 1
+            self._stats["max_depth"] = max(self._stats["max_depth"], len(self._queue))
+            if self._idle == 0 and len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"{self.name}_{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            else:
+                self._condition.notify()
+
+        if dropped is not None:
+            logging.warning(f"Dropped queued work from the full {self.name} executor.")
+            dropped.set_exception(ExecutorRejected(f"Dropped from the full {self.name} executor."))
+        return future
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                self._idle += 1
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                self._idle -= 1
+                if not self._queue:
+                    return
+                _, _, queued_at, future, call = heapq.heappop(self._queue)
+                wait = time.monotonic() - queued_at
+                self._stats["total_wait"] += wait
+                self._stats["max_wait"] = max(self._stats["max_wait"], wait)
+                self._stats["running"] += 1
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(call())
+                    outcome = "completed"
+                except BaseException as exc:
+                    future.set_exception(exc)
+                    outcome = "failed"
+            else:
+                outcome = "completed"
+            with self._condition:
+                self._stats["running"] -= 1
+                self._stats[outcome] += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the executor's statistics: its size, current and maximal queue depth, work counters and wait times.
+        """
+        with self._condition:
+            started = self._stats["completed"] + self._stats["failed"] + self._stats["running"]
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "policy": self.policy,
+                "depth": len(self._queue),
+                "max_depth": self._stats["max_depth"],
+                "running": self._stats["running"],
+                "submitted": self._stats["submitted"],
+                "completed": self._stats["completed"],
+                "failed": self._stats["failed"],
+                "rejected": self._stats["rejected"],
+                "dropped": self._stats["dropped"],
+                "avg_wait": self._stats["total_wait"] / started if started else 0.0,
+                "max_wait": self._stats["max_wait"],
+            }
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._condition:
+            self._shutdown = True
+            if cancel_futures:
+                for item in self._queue:
+                    item[3].cancel()
+                self._queue.clear()
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def executor_from_env(name: str, workers: int, queue_size: int, policy: str) -> PriorityExecutor:
+    """
+    Creates an executor, with its settings overridable by the EXECUTOR_<NAME>_WORKERS, EXECUTOR_<NAME>_QUEUE_SIZE
+    and EXECUTOR_<NAME>_POLICY environment variables.
+    """
+    prefix = f"EXECUTOR_{name.upper()}_"
+    return PriorityExecutor(name,
+                            int(os.getenv(prefix + "WORKERS", workers)),
+                            int(os.getenv(prefix + "QUEUE_SIZE", queue_size)),
+                            os.getenv(prefix + "POLICY", policy))
+
+
+# The executors of the blocking work, by the kind of work:
+# foreground - work a client is waiting for (database access, model calls).
+# speculative - work done ahead of time, which is worthless if it can't keep up (story cache, shop prefetch).
+# image - image generation, which is slow and must not hold up the rest.
+# maintenance - startup probes and other background bookkeeping.
+EXECUTORS = {
+    "foreground": executor_from_env("foreground", 32, 256, REJECT),
+    "speculative": executor_from_env("speculative", 8, 64, DROP_LOWEST),
+    "image": executor_from_env("image", 4, 32, DROP_LOWEST),
+    "maintenance": executor_from_env("maintenance", 2, 32, REJECT),
+}
+
+
+def get_executor(name: str) -> PriorityExecutor:
+    """
+    Returns the executor with the given name.
+
+    :param name: the name of the executor
+    :return: the executor
+    """
+    if name not in EXECUTORS:
+        raise ValueError(f"Unknown executor: {name}")
+    return EXECUTORS[name]
+
+
+def executors_stats() -> dict:
+    """
+    Returns the statistics of all the executors, by name.
+    """
+    return {name: executor.stats() for name, executor in EXECUTORS.items()}
+
+
+def shutdown_executors() -> None:
+    """
+    Shuts all the executors down, dropping their queued work.
+    """
+    for executor in EXECUTORS.values():
+        executor.shutdown(wait=False, cancel_futures=True)
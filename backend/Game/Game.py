@@ -1,25 +1,81 @@
-import time
+import asyncio
+import heapq
+import itertools
+from typing import AsyncIterator
 import backend.GenAI.T2I as T2I
 from backend.Types.Theme import Theme
-from backend.GenAI.LLM.LLM import LLM
+from backend.GenAI.LLM.LLM import LLM, compact_json, count_tokens
 from backend.Utility import *
 from backend.Types.Inventory import Inventory
 from backend.Game.GameUtils import *
 from backend.Types.Themes import get_theme, Available_Themes
 from backend.Database.Database import DataBase
+from backend.Database.conn.ConnClass import image_hash, THUMBNAIL_SUFFIX
+from backend.Game.PendingResults import PendingResults
+from backend.Game.Speculation import Speculation, TREE_KEY, child_state, key_version, node_key, state_prefix
 from backend import SNS
 
 
+# The longest a client can wait for save changes in a single long-poll request, in seconds
+MAX_LONG_POLL_TIMEOUT = 30
+# The time to live of the leases on a save's story cache and shop generations, bounding a crashed process's hold
+GENERATION_LEASE_TTL = 180
+# The time between checks on a generation owned by another server process, in seconds
+LEASE_POLL_INTERVAL = 0.5
+
+
 class Game:
     DB = DataBase()
     LLM = LLM()
+    pending_results = PendingResults()
+    speculation = Speculation()
+    shop_generations = SingleFlight()
 
     # ----------------------------------------------------- #
     # ---------------------- LLM Calls -------------------- #
     # ----------------------------------------------------- #
 
+    def roll_action(self, player_data: SaveData, action: str) -> str:
+        """
+        Roll the result of an action based on the player's data and the action's success rate.
+
+        :param player_data: The player's data.
+        :param action: The chosen action.
+        :return: The result string of the action ("Success" or "Failure").
+        """
+        action_index = player_data.story["options"].index(action)
+        success_rate = calculate_success_rate(player_data, action_index)
+        action_result = probability_function(success_rate)
+        logging.debug(f"Success rate: {success_rate}, Action result: {action_result}")
+        return action_result
+
+    async def add_quest_update(self, player_data: SaveData, action: str, result: dict) -> dict:
+        """
+        Add the quest update for a generated action result, by calling the LLM model with the quest updater.
+        In the fused mode, the storyteller already generated the quest update along with the result, and the quest
+        updater is only called if that update is missing or invalid.
+
+        :param player_data: The player's data.
+        :param action: The chosen action.
+        :param result: The generated action result.
+        :return: The action result, including the quest update.
+        """
+        if self.LLM.fused_quest_update and player_data.quest is not None:
+            if self.LLM.has_valid_quest_update(result):
+                logging.debug(f"Quest update generated with the action result: {result['quest']}")
+                return result
+            logging.warning("The action result has no valid quest update, calling the quest updater.")
+
+        quest_result = await self.LLM.update_quest(player_data, action, result["scene"], result["inventory"])
+        if quest_result["status"] == "error":
+            logging.error(f"LLM model error: {quest_result['reason']}")
+            raise Exception(quest_result["reason"])
+        result["quest"] = quest_result["result"]
+        logging.debug(f"Quest update result: {result['quest']}")
+        return result
+
     @error_wrapper
-    def generate_action_result(self, username: str, save_name: str, action: str) -> dict:
+    async def generate_action_result(self, username: str, save_name: str, action: str) -> dict:
         """
         Generate the result of an action based on the player's data and the chosen action.
         Method calls the LLM model to generate the result.
@@ -29,19 +85,23 @@ class Game:
         :param action: The chosen action.
         :return: The result of the action.
         """
-        logging.info(f"Generating action result for {action}.")
+        # Retrieve the story data and generate the result of the chosen action in it
+        player_data = await self.DB.get_save_data_async(username, save_name)
+        return await self.action_result_for(player_data, action)
 
-        # Retrieve the story data and the index of the chosen action
-        player_data = self.DB.get_save_data(username, save_name)
-        action_index = player_data.story["options"].index(action)
+    async def action_result_for(self, player_data: SaveData, action: str) -> dict:
+        """
+        Generate the result of an action in a story state, which may be a speculated one rather than the saved one.
 
-        # Calculate the success rate of the action and generate the result string
-        success_rate = calculate_success_rate(player_data, action_index)
-        action_result = probability_function(success_rate)
-        logging.debug(f"Success rate: {success_rate}, Action result: {action_result}")
+        :param player_data: The player's data.
+        :param action: The chosen action.
+        :return: The result of the action.
+        """
+        logging.info(f"Generating action result for {action}.")
+        action_result = self.roll_action(player_data, action)
 
         # Call the LLM model to generate the result of the action
-        result = self.LLM.generate_action_result(player_data, action, action_result)
+        result = await self.LLM.generate_action_result(player_data, action, action_result)
         if result["status"] == "error":
             logging.error(f"LLM model error: {result['reason']}")
             raise Exception(result["reason"])
@@ -52,19 +112,44 @@ class Game:
         logging.info(f"Generated action result for {action}.")
         logging.debug(f"Action result: {result}")
 
-        quest_result = self.LLM.update_quest(player_data, action, result["scene"], result["inventory"])
-        if quest_result["status"] == "error":
-            logging.error(f"LLM model error: {quest_result['reason']}")
-            raise quest_result["reason"]
-        result["quest"] = quest_result["result"]
-        logging.debug(f"Quest update result: {result['quest']}")
+        return await self.add_quest_update(player_data, action, result)
 
-        return result
+    async def stream_action_result(self, username: str, save_name: str, action: str) -> AsyncIterator[tuple[str, any]]:
+        """
+        Generate the result of an action like generate_action_result, while streaming the scene text.
+        Yields ("scene", text) events as the scene's text arrives, and a final ("result", result) event with the
+        whole result, including the quest update.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param action: The chosen action.
+        """
+        logging.info(f"Streaming action result for {action}.")
+        player_data = await self.DB.get_save_data_async(username, save_name)
+        action_result = self.roll_action(player_data, action)
+
+        result = None
+        async for event, payload in self.LLM.stream_action_result(player_data, action, action_result):
+            if event == "scene":
+                yield event, payload
+            else:
+                result = payload
+        if result["status"] == "error":
+            logging.error(f"LLM model error: {result['reason']}")
+            raise Exception(result["reason"])
+
+        result = result["result"]
+        result["action_result"] = action_result
+        logging.info(f"Generated action result for {action}.")
+        yield "result", await self.add_quest_update(player_data, action, result)
 
-    def generate_story_cache(self, username: str, save_name: str, img_flag: bool = False) -> None:
+    async def generate_story_cache(self, username: str, save_name: str, img_flag: bool = False) -> None:
         """
-        Generate the results of all the actions into the cache to speed up the story advancement.
+        Generate the speculative story tree into the cache to speed up the story advancement: the results of the
+        current actions, and down to the configured depth, the results of the actions those results lead to.
         This method is called after each action to generate the results of the next actions, asynchronously.
+        The results are cached by the save version and story state they were generated for, so the results a previous
+        tree generated below the branch the player took are reused, and those of the other branches are deleted.
 
         :param username: The username of the player.
         :param save_name: The name of the save.
@@ -72,43 +157,213 @@ class Game:
         """
         logging.info("Generating story cache...")
 
+        # Speculating while the storyteller's model keeps failing only adds to its load, the chosen action is generated
+        # on demand
+        if self.LLM.model_for("action_result").breaker.state != "closed":
+            logging.info("Skipping story cache, the model's circuit breaker is open.")
+            return
+
+        lease = None
         try:
             # Load the player's data
-            player_data = self.DB.get_save_data(username, save_name)
+            player_data = await self.DB.get_save_data_async(username, save_name)
+
+            # Take the lease on this version's speculation, unless another server process already took it
+            lease = f"story_cache/{username}/{save_name}/{player_data.ver}"
+            if not await self.DB.acquire_lease_async(lease, GENERATION_LEASE_TTL):
+                logging.info("Story cache is generated by another process.")
+                return
 
             # Initialize the shop data and save it
             if player_data.shop.status == "closed":
                 logging.info("Initializing shop...")
-                start_promise(self.get_shop, username, save_name, img_flag)
+                start_task(self.get_shop(username, save_name, img_flag))
 
-            # Initialize the cache with "in progress" for each action
-            self.DB.delete_all_cache(username, save_name)
-            for action in player_data.story["options"]:
-                self.DB.cache(username, save_name, action, "in progress")
+            await self.start_story_tree(username, save_name, player_data)
         except Exception as e:
             logging.exception(f"Error initializing story cache:")
+            if lease is not None:
+                await self.DB.release_lease_async(lease)
             return
 
-        # Generate the results of each action asynchronously
-        choices_promises = [start_promise(self.generate_action_result, username, save_name, choice)
-                            for choice in player_data.story["options"]]
+        try:
+            await self.expand_story_tree(username, save_name, player_data)
+        except Exception as e:
+            logging.exception(f"Error generating story cache:")
+        finally:
+            await self.DB.cache_async(username, save_name, TREE_KEY, self.speculation.record(username, save_name))
+            await self.DB.release_lease_async(lease)
+
+    async def start_story_tree(self, username: str, save_name: str, root: SaveData) -> None:
+        """
+        Make a story state the root of the save's speculative story tree, dropping the pending and cached results
+        which it can't reach.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param root: The player's current data.
+        """
+        self.speculation.start(username, save_name, root)
+        if not self.speculation.has_record(username, save_name):
+            self.speculation.load_record(username, save_name,
+                                         await self.DB.get_cache_async(username, save_name, TREE_KEY))
+        self.pending_results.clear(username, save_name, keep=lambda key: key_version(key) >= root.ver)
+        for key in self.speculation.prune(username, save_name):
+            await self.DB.delete_cache_async(username, save_name, key)
+        await self.DB.cache_async(username, save_name, TREE_KEY, self.speculation.record(username, save_name))
+
+    async def expand_story_tree(self, username: str, save_name: str, root: SaveData) -> None:
+        """
+        Generate the results of the speculative story tree, best first: by the estimated probability of the player
+        reaching each result, from the actions' success rates and the players' pick frequencies.
+        The first level is always generated, while the levels below it are limited by the speculation token budget.
+        Stops expanding the branches the player didn't take once the story advances, and while the model's circuit
+        breaker is open.
 
-        # Generate the results of each action and update the cache
-        for idx, action in enumerate(player_data.story["options"]):
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param root: The player's current data.
+        """
+        # The actions to expand, by the negated probability of reaching them, in their order of addition for equal ones
+        queue = []
+        order = itertools.count()
+
+        def add_actions(state: SaveData, probability: float, depth: int, lineage: list[str]) -> None:
+            for action, action_probability in zip(state.story["options"], self.speculation.option_probabilities(state)):
+                heapq.heappush(queue, (-probability * action_probability, next(order), depth, state, action, lineage))
+
+        add_actions(root, 1.0, 1, [state_prefix(root)])
+        width = max(self.speculation.width, len(root.story["options"]))
+        breaker = self.LLM.model_for("action_result").breaker
+        running = set()
+        try:
+            while queue or running:
+                while queue and len(running) < width and breaker.state == "closed":
+                    negated_probability, _, depth, state, action, lineage = heapq.heappop(queue)
+                    if self.speculation.is_current(username, save_name, lineage):
+                        running.add(asyncio.create_task(self.speculate_result(
+                            username, save_name, state, action, depth, lineage, -negated_probability)))
+                if not running:
+                    break
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        logging.error(f"Error expanding story cache: {task.exception()!r}")
+                    elif task.result() is not None:
+                        add_actions(*task.result())
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def speculate_result(self, username: str, save_name: str, state: SaveData, action: str, depth: int,
+                               lineage: list[str], probability: float) -> tuple | None:
+        """
+        Get the speculative result of an action in a story state of the tree, reusing it if it's already cached or
+        being generated, or generating and caching it otherwise.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param state: The story state the action is chosen in.
+        :param action: The action.
+        :param depth: The level of the result in the tree, from 1.
+        :param lineage: The key prefixes of the story states from the tree's root down to this state.
+        :param probability: The estimated probability of the player reaching the result.
+        :return: The arguments for adding the actions of the state the result leads to, or None if it isn't expanded.
+        """
+        key = node_key(state, action)
+        result = None
+        if self.pending_results.get(username, save_name, key) is None:
+            result = await self.DB.get_cache_async(username, save_name, key)
+            if result == "in progress":
+                logging.debug(f"Cache for option {action} is generated by another process.")
+                return None
+        if result is None and self.pending_results.get(username, save_name, key) is not None:
+            result = await self.pending_results.wait(username, save_name, key)
+            if result is None:
+                return None
+
+        if result is not None:
+            self.speculation.count("reused")
+        else:
+            if depth > 1 and not self.speculation.budget.take(
+                    self.speculation.estimate(self.LLM.action_result_tokens(state, action))):
+                self.speculation.count("over_budget")
+                return None
+            self.pending_results.register(username, save_name, key)
             try:
-                res = await_promise(choices_promises[idx])
-                if res["status"] == "error":
-                    self.DB.delete_cache(username, save_name, action)
-                    logging.error(f"Error generating cache for option {action}: {res['reason']}")
-                else:
-                    self.DB.cache(username, save_name, action, res["result"])
-                    logging.debug(f"Generated cache for option {action}: {res['result']}")
+                await self.DB.cache_async(username, save_name, key, "in progress")
+                result = await self.action_result_for(state, action)
+            except asyncio.CancelledError:
+                # The "in progress" entry would keep the node from being speculated again
+                self.pending_results.discard(username, save_name, key)
+                await asyncio.shield(self.DB.delete_cache_async(username, save_name, key))
+                raise
             except Exception as e:
-                self.DB.delete_cache(username, save_name, action)
-                logging.exception(f"Error generating story cache:")
+                self.pending_results.discard(username, save_name, key)
+                await self.DB.delete_cache_async(username, save_name, key)
+                logging.exception(f"Error generating cache for option {action}:")
+                return None
+            self.pending_results.resolve(username, save_name, key, result)
+            await self.DB.cache_async(username, save_name, key, result)
+            self.speculation.count_result(depth, count_tokens(compact_json(result)))
+            logging.debug(f"Generated cache for option {action}: {result}")
+
+        # The player may have taken another branch while the result was generated
+        if not self.speculation.is_current(username, save_name, lineage):
+            await self.DB.delete_cache_async(username, save_name, key)
+            return None
+        self.speculation.add_stored(username, save_name, key, lineage)
+        if depth >= self.speculation.depth:
+            return None
+        child = child_state(state, action, result)
+        if child is None:
+            return None
+        return child, probability, depth + 1, lineage + [state_prefix(child)]
+
+    async def update_history_summary(self, username: str, save_name: str) -> None:
+        """
+        Fold the older turns of the story's history into its rolling summary, once they go over their token budget.
+        This method is called after each action, asynchronously, so the prompts stay within the history token budget
+        however long the story gets. Only one process summarizes a save at a time.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        """
+        lease = f"summary/{username}/{save_name}"
+        try:
+            player_data = await self.DB.get_save_data_async(username, save_name)
+            upto = self.LLM.turns_to_summarize(player_data)
+            if upto == player_data.get_summary()["upto"]:
+                return
+            if not await self.DB.acquire_lease_async(lease, GENERATION_LEASE_TTL):
+                logging.info("History summary is updated by another process.")
+                return
+        except Exception as e:
+            logging.exception(f"Error initializing history summary:")
+            return
+
+        try:
+            logging.info(f"Summarizing history up to entry {upto}...")
+            result = await self.LLM.summarize_history(player_data, upto)
+            if result["status"] == "error":
+                logging.error(f"Error summarizing history: {result['reason']}")
+                return
+
+            # Apply the summary to the latest save, unless it was already summarized further or its story was restarted
+            latest_data = await self.DB.get_save_data_async(username, save_name)
+            if latest_data.get_summary()["upto"] >= upto or \
+                    latest_data.story["history"][:upto] != player_data.story["history"][:upto]:
+                logging.info("History changed while summarizing, dropping the summary.")
+                return
+            latest_data.set_summary(str(result["result"]["summary"]), upto)
+            await self.DB.save_game_data_async(username, save_name, latest_data)
+        except Exception as e:
+            logging.exception(f"Error updating history summary:")
+        finally:
+            await self.DB.release_lease_async(lease)
 
     @error_wrapper
-    def generate_shop(self, username: str, save_name: str, data: SaveData, img_flag: bool = False) -> dict:
+    async def generate_shop(self, username: str, save_name: str, data: SaveData, img_flag: bool = False) -> dict:
         """
         Generate the shop for the player based on the player's data.
 
@@ -121,7 +376,7 @@ class Game:
         logging.info("Generating shop...")
 
         # Call the LLM model to generate the shop and save it
-        result = self.LLM.generate_shop(data)
+        result = await self.LLM.generate_shop(data)
         if result["status"] == "success":
             result = result["result"]
             logging.debug(f"Generated shop: {result}")
@@ -129,12 +384,12 @@ class Game:
             result["image"] = None
             if img_flag and "prompt" in result:
                 logging.info("Generating shop image..." if not DEBUG else "Generating shop image. Prompt: " + result["prompt"])
-                img = T2I.generate(result["prompt"])
+                img = await T2I.generate_async(result["prompt"])
                 if img["status"] == "error":
                     logging.error(f"Shop generation image error: {img['reason']}")
                     raise Exception(img["reason"])
                 else:
-                    self.DB.save_image(username, save_name, "shop", img["result"])
+                    await self.DB.save_image_async(username, save_name, "shop", img["result"])
                 logging.info("Generated shop image.")
             logging.info("Generated shop.")
             return result
@@ -143,7 +398,7 @@ class Game:
             raise Exception(result["reason"])
 
     @error_wrapper
-    def generate_backstory(self, theme: Theme, background: dict) -> dict:
+    async def generate_backstory(self, theme: Theme, background: dict) -> dict:
         """
         Generate an initial backstory for the player based on the player's theme and background.
         This is done by calling the LLM model with the backstory generator.
@@ -152,7 +407,7 @@ class Game:
         :param background: The player's background.
         """
         # Call the LLM model to generate the backstory and return it
-        result = self.LLM.generate_backstory(theme, background)
+        result = await self.LLM.generate_backstory(theme, background)
         if result["status"] == "success":
             result = result["result"]
             logging.info("Generated backstory: " + str(result))
@@ -168,13 +423,13 @@ class Game:
     # ------------------------ Util ----------------------- #
     # ----------------------------------------------------- #
 
-    def initialize_save(self, username: str, save_name: str, img_flag: bool = False) -> SaveData:
+    async def initialize_save(self, username: str, save_name: str, img_flag: bool = False) -> SaveData:
         """
         Initialize the story for the player when the save is loaded.
         Used for resetting the cache and status of the story when the save is loaded.
         """
         # Load the player's data
-        player_data = self.DB.get_save_data(username, save_name)
+        player_data = await self.DB.get_save_data_async(username, save_name)
         logging.debug(f"Story data: {player_data.story}")
 
         # Reset the story data and cache
@@ -182,9 +437,9 @@ class Game:
         if player_data.shop.status == "generating":
             player_data.shop.close()
             logging.info("Resetting shop.")
-            self.DB.save_game_data(username, save_name, player_data)
+            await self.DB.save_game_data_async(username, save_name, player_data)
 
-        start_promise(self.generate_story_cache, username, save_name, img_flag)
+        start_task(self.generate_story_cache(username, save_name, img_flag), "speculative")
 
         return player_data
 
@@ -193,7 +448,7 @@ class Game:
     # ----------------------------------------------------- #
 
     @APIEndpoint
-    def system_startup(self) -> list[str]:
+    async def system_startup(self) -> list[str]:
         """
         Get the status of the system.
         This is done by calling all the GenAI with a testing prompt.
@@ -201,11 +456,9 @@ class Game:
         :return: The status of each model.
         """
         # Call the LLM and T2I GenAI with a testing prompt.
-        # This is done in a non-blocking way to speed up the response.
-        test_llm_promise = start_promise(self.LLM.test)
-        test_t2i_promise = start_promise(T2I.generate, "system_test")
-        test_llm = await_promise(test_llm_promise)
-        test_t2i = await_promise(test_t2i_promise)
+        # This is done concurrently to speed up the response, as maintenance work behind the players' requests.
+        test_llm, test_t2i = await asyncio.gather(start_task(self.LLM.test(), "maintenance"),
+                                                  start_task(T2I.generate_async("system_test"), "maintenance"))
 
         # Process the results and return the status of each model
         result = []
@@ -220,18 +473,24 @@ class Game:
         return result
 
     @APIEndpoint
-    def get_saves_list(self, username: str) -> list:
+    async def get_saves_list(self, username: str) -> list:
         """
         Get the list of all the saves.
 
+        The images aren't included, only the content hash of each save's character thumbnail, which the client can
+        fetch lazily from the image file route (category "character_thumb") and revalidate by the hash.
+
         :param username: The username of the player.
-        :return: The list of all the saves and their respective images.
+        :return: The list of all the saves, with their ids, names and thumbnail hashes.
         """
-        saves = self.DB.saves_list(username)
-        return [{"id": save, "name": saves[save], "image": self.DB.get_save_image(username, save, 'character')} for save in saves.keys()]
+        saves = await self.DB.saves_list_async(username)
+        thumbnails = await asyncio.gather(*[self.DB.get_save_image_hash_async(username, save, 'character' + THUMBNAIL_SUFFIX)
+                                            for save in saves.keys()])
+        return [{"id": save, "name": saves[save], "thumbnail": thumbnail}
+                for save, thumbnail in zip(saves.keys(), thumbnails)]
 
     @APIEndpoint
-    def get_available_themes(self) -> dict:
+    async def get_available_themes(self) -> dict:
         """
         Get the list of all the available themes and their required fields.
 
@@ -240,7 +499,7 @@ class Game:
         return {theme.name: {"name": theme.name, "fields": theme.fields} for theme in Available_Themes}
 
     @APIEndpoint
-    def load_save(self, username: str, save_name: str, img_flag: bool = False) -> dict:
+    async def load_save(self, username: str, save_name: str, img_flag: bool = False) -> dict:
         """
         Load a save's data.
 
@@ -249,10 +508,10 @@ class Game:
         :param img_flag: Whether to generate an image for the character.
         :return: The data of the save.
         """
-        return self.initialize_save(username, save_name, img_flag).to_dict()
+        return (await self.initialize_save(username, save_name, img_flag)).to_dict()
 
     @APIEndpoint
-    def new_save(self, username: str, theme_name: str, background: dict, img_flag: bool) -> str:
+    async def new_save(self, username: str, theme_name: str, background: dict, img_flag: bool) -> str:
         """
         Create a new save with the given data.
 
@@ -261,7 +520,7 @@ class Game:
         :param background: The background of the save.
         :param img_flag: Whether to generate an image for the character.
         """
-        if len(self.DB.saves_list(username).keys()) >= 5:
+        if len((await self.DB.saves_list_async(username)).keys()) >= 5:
             logging.error("Too many saves.")
             raise CustomException("Too many saves.")
 
@@ -281,7 +540,7 @@ class Game:
                 raise CustomException("Missing required field: " + field)
 
         # Generate the backstory for the player
-        result = self.generate_backstory(theme, background)
+        result = await self.generate_backstory(theme, background)
         if result["status"] == "error":
             raise Exception(result["reason"])
         result = result["result"]
@@ -307,49 +566,144 @@ class Game:
         save_data.init_story()
 
         # Generate and initial main quest
-        quest_result = self.LLM.generate_quest(save_data)
+        quest_result = await self.LLM.generate_quest(save_data)
         if quest_result["status"] == "error":
             raise Exception(quest_result["reason"])
         logging.debug(f"Quest generation result: {quest_result['result']}")
         save_data.set_quest(quest_result["result"])
 
         # Save the data and generate the story cache
-        self.DB.create_save(username, save_name, save_data)
-        start_promise(self.generate_story_cache, username, save_name, img_flag)
+        await self.DB.create_save_async(username, save_name, save_data)
+        start_task(self.generate_story_cache(username, save_name, img_flag), "speculative")
 
         # Generate the character images if needed
         if img_flag:
-            char_img_promise = start_promise(T2I.generate, result["character_prompt"])
-            scene_img_promise = start_promise(T2I.generate, result["scene_prompt"])
-
-            char_img = await_promise(char_img_promise)
-            scene_img = await_promise(scene_img_promise)
+            char_img, scene_img = await asyncio.gather(T2I.generate_async(result["character_prompt"]),
+                                                       T2I.generate_async(result["scene_prompt"]))
 
             if char_img["status"] == "error":
                 raise Exception("char image error: " + char_img["reason"])
             else:
-                self.DB.save_image(username, save_name, "character", char_img["result"])
+                await self.DB.save_image_async(username, save_name, "character", char_img["result"])
 
             if scene_img["status"] == "error":
                 raise Exception("scene image error: " + scene_img["reason"])
             else:
-                self.DB.save_image(username, save_name, "scene", scene_img["result"])
+                await self.DB.save_image_async(username, save_name, "scene", scene_img["result"])
 
         return save_name
 
     @APIEndpoint
-    def delete_save(self, username: str, save_name: str):
+    async def delete_save(self, username: str, save_name: str):
         """
         Delete a save.
 
         :param username: The username of the player.
         :param save_name: The name of the save.
         """
-        self.DB.delete_save(username, process_save_name(save_name))
-        self.DB.delete_all_cache(username, save_name)
+        await self.DB.delete_save_async(username, process_save_name(save_name))
+        await self.DB.delete_all_cache_async(username, save_name)
+        self.pending_results.clear(username, save_name)
+        self.speculation.forget(username, save_name)
+
+    async def start_advance(self, username: str, save_name: str, action: str) -> SaveData:
+        """
+        Validate the chosen action and mark the story as advancing.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param action: The chosen action.
+        :return: The player's data.
+        """
+        player_data = await self.DB.get_save_data_async(username, save_name)
+
+        if player_data.story["health"] <= 0:
+            logging.error("Player is dead.")
+            raise CustomException("Player is dead.")
+
+        if action not in player_data.story["options"]:
+            logging.error(f"Invalid action: {action}")
+            raise CustomException("Invalid action.")
+        self.speculation.picks.record(player_data.story["options"].index(action), len(player_data.story["options"]))
+
+        player_data.story["status"] = "advancing"
+        logging.debug(f"Action: {action}, Story data: {player_data.story}")
+        await self.DB.save_game_data_async(username, save_name, player_data)
+        return player_data
+
+    async def get_speculative_result(self, username: str, save_name: str, action: str,
+                                     player_data: SaveData) -> dict | None:
+        """
+        Get the speculative result of an action, waiting for it if it's still being generated.
+        A result generated in this process is awaited directly, and one generated by another server process is polled
+        from the storage cache while that process holds the speculation's lease.
+        An "in progress" cache entry with no generation behind it is stale, and is treated as a cache miss.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param action: The chosen action.
+        :param player_data: The player's data the action was chosen in.
+        :return: The result of the action, or None if it's not cached.
+        """
+        key = node_key(player_data, action)
+        if self.pending_results.get(username, save_name, key) is not None:
+            self.speculation.count("waited")
+            cache_data = await self.pending_results.wait(username, save_name, key)
+        else:
+            lease = f"story_cache/{username}/{save_name}/{player_data.ver}"
+            cache_data = await self.DB.get_cache_async(username, save_name, key)
+            while cache_data == "in progress" and await self.DB.lease_held_elsewhere_async(lease):
+                await asyncio.sleep(LEASE_POLL_INTERVAL)
+                cache_data = await self.DB.get_cache_async(username, save_name, key)
+        logging.debug(f"Retrieved cache: {cache_data}")
+        if cache_data and cache_data != "in progress":
+            self.speculation.count("hits")
+            return cache_data
+        self.speculation.count("misses")
+        return None
+
+    async def finish_advance(self, username: str, save_name: str, player_data: SaveData, action: str, result: dict,
+                             img_flag: bool) -> None:
+        """
+        Apply the result of the chosen action to the story and save it, then start generating the next story cache.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param player_data: The player's data.
+        :param action: The chosen action.
+        :param result: The result of the action.
+        :param img_flag: Whether to generate an image for the prompt.
+        """
+        # Generate an image for the prompt if needed
+        if img_flag:
+            img = await T2I.generate_async(result["prompt"])
+            if img["status"] == "error":
+                logging.error(img["reason"] + "\n" + "prompt: " + result["prompt"])
+            else:
+                await self.DB.save_image_async(username, save_name, "scene", img["result"])
+
+        # Update the story
+        player_data.update_story(result, action)
+        player_data.shop.close()
+        player_data.advance_version()
+
+        # Quest completion handling
+        logging.debug(f"Quest status: {player_data.quest.status}")
+        if player_data.quest.status == "Completed" or player_data.quest.status == "Failed":
+            logging.info("Quest completed or failed. starting new quest.")
+            quest_result = await self.LLM.generate_quest(player_data)
+            if quest_result["status"] == "error":
+                raise Exception(quest_result["reason"])
+            player_data.set_quest(quest_result["result"])
+
+        # Save the data and generate the story cache
+        await self.DB.save_game_data_async(username, save_name, player_data)
+        if player_data.story["health"] > 0:
+            start_task(self.generate_story_cache(username, save_name, img_flag), "speculative")
+            start_task(self.update_history_summary(username, save_name), "maintenance")
 
     @APIEndpoint
-    def advance_story(self, username: str, save_name: str, action: str, img_flag: bool) -> str:
+    async def advance_story(self, username: str, save_name: str, action: str, img_flag: bool) -> str:
         """
         Advance the story for the player by processing the result of the chosen action, and then updating the story data.
         This is done by generating the result of the action and updating the story data.
@@ -364,77 +718,75 @@ class Game:
         :param img_flag: Whether to generate an image for the prompt.
         :return: The status of the story after advancing.
         """
-        player_data = self.DB.get_save_data(username, save_name)
-
-        if player_data.story["health"] <= 0:
-            logging.error("Player is dead.")
-            raise CustomException("Player is dead.")
-
-        if action not in player_data.story["options"]:
-            logging.error(f"Invalid action: {action}")
-            raise CustomException("Invalid action.")
+        player_data = await self.start_advance(username, save_name, action)
 
         try:
-            # Initialize the story status and load the player's data
-            player_data.story["status"] = "advancing"
-            logging.debug(f"Action: {action}, Story data: {player_data.story}")
-            self.DB.save_game_data(username, save_name, player_data)
-
-            # Check if the result is already generated in the cache, and wait for it if it's in progress
-            while True:
-                cache_data = self.DB.get_cache(username, save_name, action)
-                if cache_data and cache_data == "in progress":
-                    time.sleep(1)
-                else:
-                    break
-            logging.debug(f"Retrieved cache: {cache_data}")
-
-            # Generate the result of the action
-            if cache_data and cache_data != "in progress":  # If the result is already generated in the cache
-                result = cache_data
+            # Check if the result is already generated in the cache, and generate it if it's not
+            result = await self.get_speculative_result(username, save_name, action, player_data)
+            if result is not None:
                 logging.debug(f"Retrieved result from cache: {result}")
             else:  # If the result is not generated in the cache (caused by an error while generating the cache)
-                result = self.generate_action_result(username, save_name, action)
+                result = await self.generate_action_result(username, save_name, action)
                 if result["status"] == "error":
                     raise Exception(result["reason"])
                 result = result["result"]
             logging.debug(f"Result: {result}")
 
-            # Generate an image for the prompt if needed
-            if img_flag:
-                img = T2I.generate(result["prompt"])
-                if img["status"] == "error":
-                    logging.error(img["reason"] + "\n" + "prompt: " + result["prompt"])
-                else:
-                    self.DB.save_image(username, save_name, "scene", img["result"])
+            await self.finish_advance(username, save_name, player_data, action, result, img_flag)
+            return result["action_result"]
+        except Exception as e:
+            logging.exception(f"Error advancing story:")
+            player_data.story["status"] = "error: " + str(e)
+            await self.DB.save_game_data_async(username, save_name, player_data)
 
-            # Update the story
-            player_data.update_story(result, action)
-            player_data.shop.close()
-            player_data.advance_version()
-
-            # Quest completion handling
-            logging.debug(f"Quest status: {player_data.quest.status}")
-            if player_data.quest.status == "Completed" or player_data.quest.status == "Failed":
-                logging.info("Quest completed or failed. starting new quest.")
-                quest_result = self.LLM.generate_quest(player_data)
-                if quest_result["status"] == "error":
-                    raise Exception(quest_result["reason"])
-                player_data.set_quest(quest_result["result"])
-
-            # Save the data and generate the story cache
-            self.DB.save_game_data(username, save_name, player_data)
-            if player_data.story["health"] > 0:
-                start_promise(self.generate_story_cache, username, save_name, img_flag)
+    async def advance_story_stream(self, username: str, save_name: str, action: str,
+                                   img_flag: bool) -> AsyncIterator[tuple[str, any]]:
+        """
+        Advance the story like advance_story, while streaming the new scene.
+        Yields ("scene", text) events with the scene's text as it's generated (at once if it's already cached),
+        then a final ("result", data) event with the action result, the new options and the quest update,
+        or an ("error", reason) event if advancing failed.
 
-            return result["action_result"]
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param action: The chosen action.
+        :param img_flag: Whether to generate an image for the prompt.
+        """
+        logging.info(f"--------- API call: advance_story_stream started!")
+        player_data = await self.start_advance(username, save_name, action)
+
+        try:
+            result = await self.get_speculative_result(username, save_name, action, player_data)
+            if result is not None:
+                logging.debug(f"Retrieved result from cache: {result}")
+                yield "scene", result["scene"]
+            else:
+                async for event, payload in self.stream_action_result(username, save_name, action):
+                    if event == "scene":
+                        yield event, payload
+                    else:
+                        result = payload
+            logging.debug(f"Result: {result}")
+
+            await self.finish_advance(username, save_name, player_data, action, result, img_flag)
+            yield "result", {
+                "action_result": result["action_result"],
+                "scene": player_data.story["scene"],
+                "options": player_data.story["options"],
+                "rates": player_data.story["rates"],
+                "health": player_data.story["health"],
+                "quest": player_data.quest.to_dict() if player_data.quest else None,
+                "ver": player_data.ver
+            }
         except Exception as e:
             logging.exception(f"Error advancing story:")
             player_data.story["status"] = "error: " + str(e)
-            self.DB.save_game_data(username, save_name, player_data)
+            await self.DB.save_game_data_async(username, save_name, player_data)
+            yield "error", str(e)
+        logging.info(f"--------- API call: advance_story_stream finished!")
 
     @APIEndpoint
-    def create_new_option(self, username: str, save_name: str, new_action: str) -> str:
+    async def create_new_option(self, username: str, save_name: str, new_action: str) -> str:
         """
         Create a new option for the player based on the player's data.
 
@@ -444,7 +796,7 @@ class Game:
         :return: An error message if the action is invalid, otherwise an empty string.
         """
         # Load the player's data and update the story data
-        player_data = self.DB.get_save_data(username, save_name)
+        player_data = await self.DB.get_save_data_async(username, save_name)
 
         # check action guardrails
         if len(player_data.story["options"]) >= 5:
@@ -459,7 +811,7 @@ class Game:
             raise CustomException("Invalid action: " + decision.reason)
 
         # Call the LLM model to generate the result of the action
-        result = self.LLM.generate_custom_action(player_data, new_action)
+        result = await self.LLM.generate_custom_action(player_data, new_action)
         if result["status"] == "error":
             raise Exception(result["reason"])
 
@@ -478,11 +830,11 @@ class Game:
                                                else list(player_data.skills.keys())[0])
         player_data.story["levels"].append(result["level"] if isinstance(result["level"], int) else 0)
         player_data.story["experience"].append(result["experience"] if isinstance(result["experience"], int) else 0)
-        self.DB.save_game_data(username, save_name, player_data)
+        await self.DB.save_game_data_async(username, save_name, player_data)
         return "Created!"
 
     @APIEndpoint
-    def spend_action_point(self, username: str, save_name: str, skill: str) -> None:
+    async def spend_action_point(self, username: str, save_name: str, skill: str) -> None:
         """
         Spend an action point to increase a skill for the player.
 
@@ -491,7 +843,7 @@ class Game:
         :param skill: The skill to increase.
         """
         # Load the player's data and check if the player has enough action points and the skill exists
-        player_data = self.DB.get_save_data(username, save_name)
+        player_data = await self.DB.get_save_data_async(username, save_name)
 
         if player_data.action_points <= 0:
             logging.error("No action points left.")
@@ -505,44 +857,84 @@ class Game:
         player_data.skills[skill] += 1
         player_data.advance_version()
         logging.info(f"Spent action point on skill: {skill}")
-        self.DB.save_game_data(username, save_name, player_data)
+        await self.DB.save_game_data_async(username, save_name, player_data)
 
-    @APIEndpoint
-    def get_shop(self, username: str, save_name: str, img_flag: bool) -> dict:
+    async def stock_shop(self, username: str, save_name: str, img_flag: bool) -> dict:
         """
-        Produce the shop for the player based on the player's data.
-        First, check if the shop is already generated, and if not, generate it.
+        Generate the shop for the player and stock it in the save.
+        Should only run through the shop generations single-flight, so each save has at most one generation in flight.
+        If another server process is already generating the shop, waits for its generation instead.
 
         :param username: The username of the player.
         :param save_name: The name of the save.
         :param img_flag: Whether to generate an image for the shop.
         :return: The generated shop.
         """
-        # Load the player's data
-        player_data = self.DB.get_save_data(username, save_name)
-
-        # Check if the shop is already generated
-        while player_data.shop.status == "generating":
-            player_data = self.DB.get_save_data(username, save_name)
-            continue
+        lease = f"shop/{username}/{save_name}"
+        if not await self.DB.acquire_lease_async(lease, GENERATION_LEASE_TTL):
+            return await self.wait_for_shop(username, save_name)
 
-        # Generate the shop if it is not already generated
-        if player_data.shop.status == "closed":
-            logging.info("No shop in cache.")
+        try:
+            player_data = await self.DB.get_save_data_async(username, save_name)
             player_data.shop.generating()
-            self.DB.save_game_data(username, save_name, player_data)
+            await self.DB.save_game_data_async(username, save_name, player_data)
 
-            result = self.generate_shop(username, save_name, player_data, img_flag)
+            result = await self.generate_shop(username, save_name, player_data, img_flag)
             if result["status"] == "error":
                 logging.error(f"Shop generation error: {result['reason']}")
                 player_data.shop.close()
-                self.DB.save_game_data(username, save_name, player_data)
+                await self.DB.save_game_data_async(username, save_name, player_data)
                 raise Exception(result["reason"])
             result = result["result"]
             player_data.shop.stock(result)
             logging.info("Generated shop.")
             logging.debug(f"Generated shop: {result}")
-            self.DB.save_game_data(username, save_name, player_data)
+            await self.DB.save_game_data_async(username, save_name, player_data)
+            return result
+        finally:
+            await self.DB.release_lease_async(lease)
+
+    async def wait_for_shop(self, username: str, save_name: str) -> dict:
+        """
+        Wait for the shop generation owned by another server process to finish.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :return: The generated shop.
+        """
+        logging.info("Shop is generated by another process, waiting for it...")
+        while await self.DB.lease_held_elsewhere_async(f"shop/{username}/{save_name}"):
+            await asyncio.sleep(LEASE_POLL_INTERVAL)
+
+        player_data = await self.DB.get_save_data_async(username, save_name)
+        if player_data.shop.status != "open":
+            raise Exception("Shop generation failed.")
+        return player_data.shop.to_dict()
+
+    @APIEndpoint
+    async def get_shop(self, username: str, save_name: str, img_flag: bool) -> dict:
+        """
+        Produce the shop for the player based on the player's data.
+        First, check if the shop is already generated, and if not, generate it.
+        Concurrent callers for the same save share a single in-flight generation.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param img_flag: Whether to generate an image for the shop.
+        :return: The generated shop.
+        """
+        # Join the shop generation if it is already in flight
+        if self.shop_generations.in_flight((username, save_name)):
+            return await self.shop_generations.run((username, save_name), self.stock_shop, username, save_name, img_flag)
+
+        # Load the player's data
+        player_data = await self.DB.get_save_data_async(username, save_name)
+
+        # Generate the shop if it is not already generated.
+        # A "generating" shop with no generation in flight is left over from an interrupted one, so it is regenerated.
+        if player_data.shop.status == "closed" or player_data.shop.status == "generating":
+            logging.info("No shop in cache.")
+            result = await self.shop_generations.run((username, save_name), self.stock_shop, username, save_name, img_flag)
         elif player_data.shop.status == "unavailable":
             logging.error("Shop unavailable.")
             raise CustomException("Shop unavailable at player's location.")
@@ -552,7 +944,7 @@ class Game:
         return result
 
     @APIEndpoint
-    def buy_item(self, username: str, save_name: str, item_name: str) -> None:
+    async def buy_item(self, username: str, save_name: str, item_name: str) -> None:
         """
         Buy an item from the shop for the player.
 
@@ -561,7 +953,7 @@ class Game:
         :param item_name: The item to buy.
         """
         # Load the player's data and check if the player has enough coins and doesn't own the item
-        player_data = self.DB.get_save_data(username, save_name)
+        player_data = await self.DB.get_save_data_async(username, save_name)
 
         category, price = player_data.shop.get_sold_item(item_name)
         logging.debug(f"Item: {item_name}, Category: {category}, Price: {price}")
@@ -576,10 +968,10 @@ class Game:
         player_data.coins -= price
         player_data.shop.item_sold(item_name)
         logging.info(f"Bought item: {item_name}")
-        self.DB.save_game_data(username, save_name, player_data)
+        await self.DB.save_game_data_async(username, save_name, player_data)
 
     @APIEndpoint
-    def sell_item(self, username: str, save_name: str, item_name: str) -> None:
+    async def sell_item(self, username: str, save_name: str, item_name: str) -> None:
         """
         Sell an item to the shop for the player.
 
@@ -588,7 +980,7 @@ class Game:
         :param item_name: The item to sell.
         """
         # Load the player's data and check if the player owns the item
-        player_data = self.DB.get_save_data(username, save_name)
+        player_data = await self.DB.get_save_data_async(username, save_name)
 
         if item_name not in player_data.shop.buy_items.keys():
             raise CustomException("I don't want this item.")
@@ -604,10 +996,10 @@ class Game:
         player_data.coins += price
         player_data.shop.item_bought(item_name)
         logging.info(f"Sold item: {item_name}")
-        self.DB.save_game_data(username, save_name, player_data)
+        await self.DB.save_game_data_async(username, save_name, player_data)
 
     @APIEndpoint
-    def get_image(self, username: str, save_name: str, category: str) -> str:
+    async def get_image(self, username: str, save_name: str, category: str) -> str:
         """
         Get the image of the last generated prompt, as a base64 string.
 
@@ -615,4 +1007,57 @@ class Game:
         :param save_name: The name of the save.
         :param category: The category of the image.
         """
-        return self.DB.get_save_image(username, save_name, category)
+        return await self.DB.get_save_image_async(username, save_name, category)
+
+    @APIEndpoint
+    async def get_image_file(self, username: str, save_name: str, category: str,
+                             etag: str = None) -> tuple[str, bytes | None]:
+        """
+        Get the raw image of the last generated prompt, along with its content hash as its version tag.
+        If the client's tag matches the current image, the image isn't loaded at all.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param category: The category of the image.
+        :param etag: The tag of the image the client already has, if any.
+        :return: The image's tag, and its bytes (or None if the client's tag is current).
+        """
+        if etag is not None and etag == await self.DB.get_save_image_hash_async(username, save_name, category):
+            return etag, None
+        content = await self.DB.get_save_image_bytes_async(username, save_name, category)
+        return image_hash(content), content
+
+    @APIEndpoint
+    async def wait_for_changes(self, username: str, save_name: str, since: int, timeout: float) -> dict:
+        """
+        Long-poll for the changes committed to a save after the last change the client has seen.
+        Returns as soon as there are new changes, or with no changes once the timeout passes.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param since: The sequence number of the last change the client has seen (0 for none).
+        :param timeout: The maximum time to wait, in seconds.
+        :return: The new changes, and the sequence number to pass in the next call.
+        """
+        timeout = min(max(timeout, 0), MAX_LONG_POLL_TIMEOUT)
+        events = await self.DB.events.wait(username, save_name, since, timeout)
+        return {
+            "seq": events[-1]["seq"] if events else self.DB.events.last_sequence(username, save_name),
+            "events": events
+        }
+
+    async def stream_changes(self, username: str, save_name: str, since: int) -> AsyncIterator[tuple[str, any]]:
+        """
+        Push the changes committed to a save after the last change the client has seen, as they happen.
+        Yields (event, data) pairs, with the change's sequence number in the data,
+        and ("keepalive", {}) pairs while there are no changes.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param since: The sequence number of the last change the client has seen (0 for none).
+        """
+        async for event in self.DB.events.subscribe(username, save_name, since):
+            if not event:
+                yield "keepalive", {}
+            else:
+                yield event["event"], {"seq": event["seq"], **event["data"]}
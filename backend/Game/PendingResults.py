@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+
+class PendingResults:
+    """
+    In-process registry of the speculative action results that are still being generated.
+    Each entry is a future keyed by (username, save_name, key), where the key identifies the action's result in the
+    speculative story tree (see Speculation.node_key), resolved by the story cache generator as soon as its result
+    exists, so a waiting story advancement wakes immediately without polling the storage cache.
+    An entry resolved with None means no result is coming, and the caller should generate it itself.
+    """
+
+    def __init__(self):
+        self._pending: dict[tuple[str, str, str], asyncio.Future] = {}
+
+    def register(self, username: str, save_name: str, key: str) -> asyncio.Future:
+        """
+        Registers a new pending result, discarding the previous one for the same key if it exists.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param key: The key of the result.
+        :return: The future to be resolved with the result.
+        """
+        self.discard(username, save_name, key)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[(username, save_name, key)] = future
+        return future
+
+    def get(self, username: str, save_name: str, key: str) -> asyncio.Future | None:
+        """
+        Returns the pending result future for the given key, or None if nothing is pending.
+        """
+        return self._pending.get((username, save_name, key))
+
+    def resolve(self, username: str, save_name: str, key: str, result: dict | None) -> None:
+        """
+        Resolves the pending result for the given key, waking all of its waiters.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param key: The key of the result.
+        :param result: The generated result, or None if the generation failed.
+        """
+        future = self._pending.pop((username, save_name, key), None)
+        if future is not None and not future.done():
+            future.set_result(result)
+            logging.debug(f"Resolved pending result {key}.")
+
+    def discard(self, username: str, save_name: str, key: str) -> None:
+        """
+        Discards the pending result for the given key, releasing its waiters with no result.
+        """
+        self.resolve(username, save_name, key, None)
+
+    def clear(self, username: str, save_name: str, keep=None) -> None:
+        """
+        Discards all the pending results of the given save.
+
+        :param username: The username of the player.
+        :param save_name: The name of the save.
+        :param keep: A predicate on the results' keys, selecting the pending results to keep, if any.
+        """
+        for key in [key for key in self._pending.keys() if key[0] == username and key[1] == save_name]:
+            if keep is None or not keep(key[2]):
+                self.discard(*key)
+
+    async def wait(self, username: str, save_name: str, key: str) -> dict | None:
+        """
+        Waits for the pending result of the given key.
+        The wait is shielded, so a cancelled waiter does not cancel the result for the others.
+
+        :return: The generated result, or None if nothing is pending or the generation failed.
+        """
+        future = self.get(username, save_name, key)
+        if future is None:
+            return None
+        return await asyncio.shield(future)
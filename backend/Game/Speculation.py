@@ -0,0 +1,244 @@
+import copy
+import hashlib
+import os
+import threading
+import time
+from backend.Types.SaveData import SaveData
+
+# The number of levels of the speculative story tree: 1 generates the results of the current options, 2 also the
+# results of the options those results lead to, and so on
+SPECULATION_DEPTH = int(os.getenv('SPECULATION_DEPTH', 1))
+# The tokens per minute the speculation below the first level may spend, shared by all the saves
+SPECULATION_TOKEN_BUDGET = int(os.getenv('SPECULATION_TOKEN_BUDGET', 60000))
+# The number of results a save's speculation generates at once (at least the number of current options)
+SPECULATION_WIDTH = int(os.getenv('SPECULATION_WIDTH', 3))
+
+# The cache key of a save's record of its stored speculative results
+TREE_KEY = "speculation_tree"
+
+
+def state_prefix(data: SaveData) -> str:
+    """
+    Returns the key prefix of a story state: its version and a fingerprint of its last turn, so the states of different
+    branches at the same version have different keys.
+    """
+    turn = "\0".join(data.story["history"][-2:] + [data.story["scene"]])
+    return f"{data.ver}/{hashlib.sha256(turn.encode()).hexdigest()[:16]}"
+
+
+def node_key(data: SaveData, action: str) -> str:
+    """
+    Returns the cache key of an action's speculative result in a story state.
+    """
+    return f"{state_prefix(data)}/{action}"
+
+
+def key_version(key: str) -> int:
+    """
+    Returns the save version of a speculative result's cache key.
+    """
+    return int(key.split("/", 1)[0])
+
+
+def child_state(data: SaveData, action: str, result: dict) -> SaveData | None:
+    """
+    Returns the story state an action's result leads to, as the story advancement would apply it,
+    or None if the story can't continue from it without another model call (the player died or the quest ended).
+
+    :param data: the story state the action was chosen in
+    :param action: the chosen action
+    :param result: the action's result, including its quest update
+    :return: the next story state, or None
+    """
+    if data.quest is None:
+        return None
+    child = SaveData(copy.deepcopy(data.to_dict()))
+    child.update_story(copy.deepcopy(result), action)
+    child.advance_version()
+    if child.story["health"] <= 0 or not child.story["options"] or child.quest is None or not child.quest.is_active():
+        return None
+    return child
+
+
+class PickStats:
+    """
+    Counts how often the players pick each option position, out of the times it was offered.
+    """
+
+    def __init__(self):
+        self.offered: dict[int, int] = {}
+        self.picked: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, index: int, options: int) -> None:
+        """
+        Records a pick.
+
+        :param index: the position of the picked option
+        :param options: the number of options offered
+        """
+        with self._lock:
+            for position in range(options):
+                self.offered[position] = self.offered.get(position, 0) + 1
+            self.picked[index] = self.picked.get(index, 0) + 1
+
+    def frequency(self, index: int) -> float:
+        """
+        Returns the pick frequency of an option position, smoothed towards a third while there are few picks.
+        """
+        with self._lock:
+            return (self.picked.get(index, 0) + 1) / (self.offered.get(index, 0) + 3)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {position: round(self.picked.get(position, 0) / offered, 3)
+                    for position, offered in sorted(self.offered.items())}
+
+
+class TokenBudget:
+    """
+    A token bucket of the tokens the speculation may spend, refilled continuously up to a minute's worth.
+    """
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, tokens: int) -> bool:
+        """
+        Takes tokens from the budget.
+
+        :param tokens: the number of tokens to spend
+        :return: whether the budget had enough tokens
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60)
+            self.updated = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
+class Speculation:
+    """
+    The policy and the bookkeeping of the speculative story tree of each save.
+    The tree's results are cached by key (see node_key), so a result generated below the first level is found by the
+    next turn's speculation and story advancement, as long as the player took that branch.
+    Keeps, by save, the root of its latest tree, so an older tree stops expanding once the story moved on,
+    and the keys of its stored results with their lineage (the state prefixes from their tree's root down to them),
+    so the results of the branches the player didn't take are deleted.
+    """
+
+    def __init__(self, depth: int = SPECULATION_DEPTH, token_budget: int = SPECULATION_TOKEN_BUDGET,
+                 width: int = SPECULATION_WIDTH):
+        """
+        :param depth: the number of levels of the tree
+        :param token_budget: the tokens per minute the levels below the first may spend
+        :param width: the number of results a tree generates at once
+        """
+        self.depth = max(1, depth)
+        self.width = max(1, width)
+        self.budget = TokenBudget(token_budget)
+        self.picks = PickStats()
+        # The running average of a result's size in tokens, for estimating a result's cost before generating it
+        self.result_tokens = 400.0
+        self.roots: dict[tuple[str, str], str] = {}
+        self.stored: dict[tuple[str, str], dict[str, list[str]]] = {}
+        self._counts = {"generated": {}, "reused": 0, "over_budget": 0, "hits": 0, "waited": 0, "misses": 0,
+                        "pruned": 0}
+        self._lock = threading.Lock()
+
+    def option_probabilities(self, data: SaveData) -> list[float]:
+        """
+        Estimates the probability of the player picking each of the state's options, from the options' success rates
+        and the players' pick frequencies of their positions.
+        """
+        rates = data.story["rates"]
+        weights = [self.picks.frequency(index) * max(float(rates[index]) if index < len(rates) else 0.5, 0.05)
+                   for index in range(len(data.story["options"]))]
+        total = sum(weights)
+        return [weight / total for weight in weights]
+
+    def start(self, username: str, save_name: str, root: SaveData) -> None:
+        """
+        Marks the tree rooted at a story state as the save's latest.
+        """
+        with self._lock:
+            self.roots[(username, save_name)] = state_prefix(root)
+
+    def is_current(self, username: str, save_name: str, lineage: list[str]) -> bool:
+        """
+        Checks whether the save's latest tree starts at or above a state, given the state's lineage.
+        """
+        with self._lock:
+            return self.roots.get((username, save_name)) in lineage
+
+    def forget(self, username: str, save_name: str) -> None:
+        with self._lock:
+            self.roots.pop((username, save_name), None)
+            self.stored.pop((username, save_name), None)
+
+    def has_record(self, username: str, save_name: str) -> bool:
+        with self._lock:
+            return (username, save_name) in self.stored
+
+    def load_record(self, username: str, save_name: str, record: dict | None) -> None:
+        """
+        Sets the save's record of stored results, as persisted by a previous tree, unless it's already known.
+        """
+        with self._lock:
+            self.stored.setdefault((username, save_name), dict(record or {}))
+
+    def record(self, username: str, save_name: str) -> dict[str, list[str]]:
+        with self._lock:
+            return dict(self.stored.get((username, save_name), {}))
+
+    def add_stored(self, username: str, save_name: str, key: str, lineage: list[str]) -> None:
+        with self._lock:
+            self.stored.setdefault((username, save_name), {})[key] = lineage
+
+    def prune(self, username: str, save_name: str) -> list[str]:
+        """
+        Removes the stored results the save's latest tree can't reach from the record.
+
+        :return: the keys of the removed results, to delete from the cache
+        """
+        with self._lock:
+            root = self.roots.get((username, save_name))
+            stored = self.stored.get((username, save_name), {})
+            pruned = [key for key, lineage in stored.items() if root not in lineage]
+            for key in pruned:
+                del stored[key]
+            self._counts["pruned"] += len(pruned)
+            return pruned
+
+    def estimate(self, prompt_tokens: int) -> int:
+        """
+        Estimates the tokens a result costs, from its prompt's size and the average result size.
+        """
+        return prompt_tokens + int(self.result_tokens)
+
+    def count_result(self, depth: int, result_tokens: int) -> None:
+        with self._lock:
+            self._counts["generated"][depth] = self._counts["generated"].get(depth, 0) + 1
+            self.result_tokens = 0.9 * self.result_tokens + 0.1 * result_tokens
+
+    def count(self, outcome: str) -> None:
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the tree configuration, the results generated by depth, the results reused from a previous tree,
+        the expansions skipped for the budget, the advancements that found their result (of which, those that waited
+        for it to be generated) or not, and the pick frequencies by option position.
+        """
+        with self._lock:
+            counts = {**self._counts, "generated": dict(self._counts["generated"])}
+        hits, misses = counts["hits"], counts["misses"]
+        return {"depth": self.depth, "width": self.width, "token_budget": self.budget.per_minute, **counts,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0, "pick_frequency": self.picks.stats()}
@@ -0,0 +1,302 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+import time
+from backend.Executors import PRIORITIES
+from backend.Utility import work_context
+
+
+class Lease:
+    """
+    A governor's permission for one request, holding the tokens it was charged up front.
+    """
+
+    def __init__(self, context: str, tokens: int):
+        self.context = context
+        self.tokens = tokens
+        # The tokens the request actually used, if known once it's done
+        self.used: int | None = None
+
+
+class _Waiter:
+    def __init__(self, lease: Lease, notify: callable):
+        self.lease = lease
+        self.notify = notify
+        self.granted = False
+        self.cancelled = False
+        self.queued_at = time.monotonic()
+
+
+class ProviderGovernor:
+    """
+    Limits the requests the process sends to a model provider, by requests per minute, tokens per minute and
+    requests in flight, so the game stays under the provider's quota instead of running into its throttling.
+    Requests waiting for the limits are let through by the priority of the work they were started from (see
+    PRIORITIES), so the players' actions go ahead of the speculation, and in arrival order within a priority.
+    The rates are token buckets holding up to a minute's worth. A request is charged its estimated tokens up front,
+    and the estimate is corrected by the tokens it actually used once it's done.
+    A limit of 0 is unlimited.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_in_flight: int = 0):
+        """
+        :param name: the name of the provider
+        :param requests_per_minute: the number of requests per minute
+        :param tokens_per_minute: the number of tokens per minute, prompts and responses
+        :param max_in_flight: the number of requests at once
+        """
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_in_flight = max_in_flight
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        # The running average of a response's size in tokens, for estimating a request's cost before it's sent
+        self.response_tokens = 500.0
+        self._waiters: list[tuple[int, int, _Waiter]] = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {"granted": 0, "waited": 0, "max_queued": 0, "total_wait": 0.0, "max_wait": 0.0}
+        self._context_stats: dict[str, dict] = {}
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.requests_per_minute, self.requests + elapsed * self.requests_per_minute / 60)
+        self.tokens = min(self.tokens_per_minute, self.tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _dispatch(self) -> float | None:
+        """
+        Grants the waiting requests the limits allow, in priority order.
+
+        :return: the time until the limits' refill allows the next waiting request, or None if it waits for a request
+            in flight to finish (or nothing waits)
+        """
+        granted = []
+        wait = None
+        with self._lock:
+            self._refill()
+            while self._waiters:
+                waiter = self._waiters[0][2]
+                if waiter.cancelled:
+                    heapq.heappop(self._waiters)
+                    continue
+                if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                    break
+                # A request larger than a minute's tokens would never fit, it waits for a full bucket instead
+                tokens = min(waiter.lease.tokens, self.tokens_per_minute)
+                if self.requests_per_minute and self.requests < 1:
+                    wait = (1 - self.requests) * 60 / self.requests_per_minute
+                if self.tokens_per_minute and self.tokens < tokens:
+                    wait = max(wait or 0, (tokens - self.tokens) * 60 / self.tokens_per_minute)
+                if wait is not None:
+                    break
+                heapq.heappop(self._waiters)
+                if self.requests_per_minute:
+                    self.requests -= 1
+                if self.tokens_per_minute:
+                    self.tokens -= waiter.lease.tokens
+                self.in_flight += 1
+                waiter.granted = True
+                self._count_grant(waiter)
+                granted.append(waiter)
+        for waiter in granted:
+            waiter.notify()
+        return wait
+
+    def _count_grant(self, waiter: _Waiter) -> None:
+        waited = time.monotonic() - waiter.queued_at
+        context = self._context_stats.setdefault(waiter.lease.context, {"granted": 0, "total_wait": 0.0})
+        context["granted"] += 1
+        context["total_wait"] += waited
+        self._stats["granted"] += 1
+        self._stats["total_wait"] += waited
+        self._stats["max_wait"] = max(self._stats["max_wait"], waited)
+        if waited > 0.001:
+            self._stats["waited"] += 1
+
+    def _enqueue(self, tokens: int, notify: callable) -> _Waiter:
+        context = work_context.get()
+        waiter = _Waiter(Lease(context, tokens), notify)
+        with self._lock:
+            heapq.heappush(self._waiters, (PRIORITIES[context], next(self._order), waiter))
+            self._stats["max_queued"] = max(self._stats["max_queued"], len(self._waiters))
+        return waiter
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        # A waiter that stopped waiting gives up its place, or its permission if it was granted meanwhile
+        with self._lock:
+            waiter.cancelled = True
+            granted = waiter.granted
+        if granted:
+            self.release(waiter.lease)
+        else:
+            self._dispatch()
+
+    async def acquire_async(self, tokens: int = 0) -> Lease:
+        """
+        Waits for the limits to allow a request, by the priority of the current work context.
+
+        :param tokens: the estimated tokens of the request
+        :return: the lease of the request, to be released once it's done
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        waiter = self._enqueue(tokens, lambda: loop.call_soon_threadsafe(ready.set))
+        try:
+            while True:
+                wait = self._dispatch()
+                if waiter.granted:
+                    return waiter.lease
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(ready.wait(), wait)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def acquire(self, tokens: int = 0) -> Lease:
+        """
+        Waits for the limits to allow a request like acquire_async, blocking the calling thread.
+        """
+        ready = threading.Event()
+        waiter = self._enqueue(tokens, ready.set)
+        try:
+            while True:
+                wait = self._dispatch()
+                if waiter.granted:
+                    return waiter.lease
+                ready.wait(wait)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def release(self, lease: Lease) -> None:
+        """
+        Releases a request's lease once it's done, correcting its tokens by those it used, if known.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if lease.used is not None and self.tokens_per_minute:
+                self.tokens = max(-self.tokens_per_minute, self.tokens - (lease.used - lease.tokens))
+        self._dispatch()
+
+    def record_response(self, lease: Lease, prompt_tokens: int, response_tokens: int) -> None:
+        """
+        Records the tokens a request used, for correcting its charge and the estimate of the next ones.
+        """
+        lease.used = prompt_tokens + response_tokens
+        with self._lock:
+            self.response_tokens = 0.9 * self.response_tokens + 0.1 * response_tokens
+
+    def has_capacity(self, tokens: int = 0) -> bool:
+        """
+        Checks whether a request would be let through at once, without waiting behind other requests or the limits.
+        """
+        with self._lock:
+            self._refill()
+            if any(not waiter.cancelled for _, _, waiter in self._waiters):
+                return False
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+            if self.requests_per_minute and self.requests < 1:
+                return False
+            return not self.tokens_per_minute or self.tokens >= min(tokens, self.tokens_per_minute)
+
+    def estimate(self, prompt_tokens: int, max_tokens: int = None) -> int:
+        """
+        Estimates the tokens a request costs, from its prompt's size and its response limit or the average response.
+        """
+        return prompt_tokens + (max_tokens or int(self.response_tokens))
+
+    @contextlib.asynccontextmanager
+    async def lease_async(self, tokens: int = 0):
+        """
+        Holds a lease for the duration of a request.
+        """
+        lease = await self.acquire_async(tokens)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    @contextlib.contextmanager
+    def lease(self, tokens: int = 0):
+        """
+        Holds a lease for the duration of a request, blocking the calling thread while waiting for it.
+        """
+        lease = self.acquire(tokens)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def stats(self) -> dict:
+        """
+        Returns the governor's limits, the requests in flight and waiting, the grant counters and wait times,
+        and the average wait by work context.
+        """
+        with self._lock:
+            self._refill()
+            granted = self._stats["granted"]
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "queued": sum(not waiter.cancelled for _, _, waiter in self._waiters),
+                "max_queued": self._stats["max_queued"],
+                "granted": granted,
+                "waited": self._stats["waited"],
+                "avg_wait": self._stats["total_wait"] / granted if granted else 0.0,
+                "max_wait": self._stats["max_wait"],
+                "available_requests": round(self.requests, 1) if self.requests_per_minute else None,
+                "available_tokens": round(self.tokens) if self.tokens_per_minute else None,
+                "avg_wait_by_context": {context: stats["total_wait"] / stats["granted"]
+                                        for context, stats in self._context_stats.items()},
+            }
+
+
+def governor_from_env(name: str) -> ProviderGovernor:
+    """
+    Creates a provider's governor, with its limits set by the PROVIDER_<NAME>_REQUESTS_PER_MINUTE,
+    PROVIDER_<NAME>_TOKENS_PER_MINUTE and PROVIDER_<NAME>_MAX_IN_FLIGHT environment variables (unlimited by default).
+    """
+    prefix = f"PROVIDER_{name.upper()}_"
+    return ProviderGovernor(name,
+                            float(os.getenv(prefix + "REQUESTS_PER_MINUTE", 0)),
+                            float(os.getenv(prefix + "TOKENS_PER_MINUTE", 0)),
+                            int(os.getenv(prefix + "MAX_IN_FLIGHT", 0)))
+
+
+# The governors by provider, shared by all the models and image generation of the process
+GOVERNORS: dict[str, ProviderGovernor] = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(name: str) -> ProviderGovernor:
+    """
+    Returns the governor of a provider, created on first use.
+
+    :param name: the name of the provider
+    :return: the governor
+    """
+    with _governors_lock:
+        if name not in GOVERNORS:
+            GOVERNORS[name] = governor_from_env(name)
+        return GOVERNORS[name]
+
+
+def governors_stats() -> dict:
+    """
+    Returns the statistics of all the governors, by provider.
+    """
+    with _governors_lock:
+        governors = list(GOVERNORS.values())
+    return {governor.name: governor.stats() for governor in governors}
@@ -0,0 +1,162 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+
+# The call types whose requests are hedged, comma separated ("*" for all), none by default
+LLM_HEDGE_CALL_TYPES = {call_type.strip() for call_type in os.getenv('LLM_HEDGE_CALL_TYPES', '').split(',')
+                        if call_type.strip()}
+# A duplicate request is sent once a request takes longer than this percentile of the call type's recent latencies
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', 95))
+# The maximal share of the requests which may be duplicated, and the number of recent latencies kept by call type
+# (a call type isn't hedged until it has a tenth of them)
+LLM_HEDGE_MAX_RATE = float(os.getenv('LLM_HEDGE_MAX_RATE', 0.05))
+LLM_HEDGE_WINDOW = int(os.getenv('LLM_HEDGE_WINDOW', 500))
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """
+    Returns the percentile of the values, by the nearest rank.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(len(values) * percent / 100)) - 1))]
+
+
+class HedgePolicy:
+    """
+    Hedges the model requests of the opted-in call types against the long tail of the model's latency:
+    once a request takes longer than a percentile of its call type's recent latencies, a duplicate request is sent,
+    the first response to arrive is used and the other request is cancelled.
+    The duplicates are capped by a budget, which every request adds the max rate to and every duplicate takes one from,
+    so the hedging can't multiply the load when the model slows down as a whole.
+    Keeps the latencies of the single requests (the model's latency) and the latencies the callers saw with the
+    hedging, so the tail improvement shows up in the statistics.
+    """
+
+    def __init__(self, call_types: set[str] = LLM_HEDGE_CALL_TYPES, hedge_percentile: float = LLM_HEDGE_PERCENTILE,
+                 max_rate: float = LLM_HEDGE_MAX_RATE, window: int = LLM_HEDGE_WINDOW):
+        """
+        :param call_types: the call types whose requests are hedged, "*" for all
+        :param hedge_percentile: the percentile of the recent latencies after which a duplicate is sent
+        :param max_rate: the maximal share of the requests which may be duplicated
+        :param window: the number of recent latencies kept by call type
+        """
+        self.call_types = call_types
+        self.hedge_percentile = hedge_percentile
+        self.max_rate = max_rate
+        self.window = window
+        self.min_samples = max(1, window // 10)
+        # A quiet period saves up at most a few duplicates
+        self.max_budget = 5.0
+        self.budget = 1.0
+        self._request_latencies: dict[str, collections.deque] = {}
+        self._observed_latencies: dict[str, collections.deque] = {}
+        self._counts: dict[str, dict[str, int]] = {}
+
+    def enabled(self, call_type: str | None) -> bool:
+        """
+        Checks whether the requests of a call type are hedged.
+        """
+        return call_type is not None and ("*" in self.call_types or call_type in self.call_types)
+
+    def _latencies(self, latencies: dict[str, collections.deque], call_type: str) -> collections.deque:
+        if call_type not in latencies:
+            latencies[call_type] = collections.deque(maxlen=self.window)
+        return latencies[call_type]
+
+    def _count(self, call_type: str, outcome: str) -> None:
+        counts = self._counts.setdefault(call_type, {"requests": 0, "hedged": 0, "hedge_won": 0, "capped": 0})
+        counts[outcome] += 1
+
+    def hedge_delay(self, call_type: str) -> float | None:
+        """
+        Returns how long a request of the call type may take before it is hedged, or None if there are too few
+        recent latencies to tell.
+        """
+        latencies = self._latencies(self._request_latencies, call_type)
+        if len(latencies) < self.min_samples:
+            return None
+        return percentile(list(latencies), self.hedge_percentile)
+
+    async def _timed(self, call_type: str, request: callable) -> str:
+        # A cancelled request counts with the time it took so far, or the slowest requests would drop out of the tail
+        start = time.monotonic()
+        try:
+            response = await request()
+        except asyncio.CancelledError:
+            self._latencies(self._request_latencies, call_type).append(time.monotonic() - start)
+            raise
+        self._latencies(self._request_latencies, call_type).append(time.monotonic() - start)
+        return response
+
+    async def run(self, call_type: str | None, request: callable) -> str:
+        """
+        Runs a model request, hedging it if its call type is hedged.
+
+        :param call_type: the type of the call
+        :param request: a coroutine function making the request, called again for the duplicate
+        :return: the response of the request which finished first
+        """
+        if not self.enabled(call_type):
+            return await request()
+
+        start = time.monotonic()
+        self._count(call_type, "requests")
+        self.budget = min(self.budget + self.max_rate, self.max_budget)
+        delay = self.hedge_delay(call_type)
+        first = asyncio.create_task(self._timed(call_type, request))
+        try:
+            done, _ = await asyncio.wait([first], timeout=delay)
+            if done or self.budget < 1:
+                if not done:
+                    self._count(call_type, "capped")
+                response = await first
+            else:
+                self.budget -= 1
+                self._count(call_type, "hedged")
+                logging.info(f"Hedging a {call_type} request after {delay:.2f}s.")
+                second = asyncio.create_task(self._timed(call_type, request))
+                try:
+                    winner = await self._first_success(first, second)
+                finally:
+                    second.cancel()
+                if winner is second:
+                    self._count(call_type, "hedge_won")
+                response = winner.result()
+        finally:
+            first.cancel()
+        self._latencies(self._observed_latencies, call_type).append(time.monotonic() - start)
+        return response
+
+    @staticmethod
+    async def _first_success(first: asyncio.Task, second: asyncio.Task) -> asyncio.Task:
+        # The first request to succeed, or the first one's failure if both failed
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task
+        return first
+
+    def stats(self) -> dict:
+        """
+        Returns the hedging configuration and counters by call type, with the latency percentiles of the single
+        requests and those the callers saw.
+        """
+        stats = {"call_types": sorted(self.call_types), "percentile": self.hedge_percentile,
+                 "max_rate": self.max_rate, "budget": round(self.budget, 2)}
+        for call_type, counts in self._counts.items():
+            requests = list(self._latencies(self._request_latencies, call_type))
+            observed = list(self._latencies(self._observed_latencies, call_type))
+            stats[call_type] = {
+                **counts,
+                "hedge_rate": counts["hedged"] / counts["requests"] if counts["requests"] else 0.0,
+                "hedge_delay": self.hedge_delay(call_type),
+                "request_p50": percentile(requests, 50) if requests else None,
+                "request_p99": percentile(requests, 99) if requests else None,
+                "observed_p50": percentile(observed, 50) if observed else None,
+                "observed_p99": percentile(observed, 99) if observed else None,
+            }
+        return stats
@@ -1,6 +1,16 @@
+import functools
+import json
 import logging
+import os
+import re
+from typing import AsyncIterator
 
+from backend.GenAI.LLM.StreamedField import StreamedField
+from backend.GenAI.LLM.ResponseSchemas import SchemaError
+from backend.GenAI.LLM.Tokens import count_tokens
 from backend.GenAI.LLM.models.ChatGPT import ChatGPT
+from backend.GenAI.LLM.models.ModelPool import ModelPool, pool_members
+from backend.GenAI.LLM.models.OfflineModel import OfflineModel
 from backend.Types.SaveData import SaveData
 from backend.Types.Theme import Theme
 from backend.GenAI.LLM.models.ModelClass import Model
@@ -12,49 +22,232 @@ def image_prompt(subject: str):
     artstation, in style of [famous artist 1], [famous artist 2], [famous artist 3]."
 
 
+def model_pool(model_name: str = None, max_tokens: int = None, temperature: float = None,
+               request_timeout: float = None) -> ModelPool:
+    """
+    Creates a pool of the models configured in MODEL_POOL_MEMBERS, each with the given model name and limits.
+    """
+    members = {}
+    for name, backend, base_url in pool_members():
+        if backend not in MODELS or backend == "pool":
+            raise ValueError(f"Unknown model pool member backend: {backend}")
+        member = MODELS[backend](model_name, max_tokens, temperature, request_timeout)
+        member.provider = name
+        if base_url is not None:
+            member.base_url = base_url
+        members[name] = member
+    return ModelPool(members)
+
+
+# The model backends by name, and the one the game uses ("offline" runs the game without network access, "pool"
+# spreads the requests over the models of MODEL_POOL_MEMBERS)
+MODELS = {"chatgpt": ChatGPT, "offline": OfflineModel, "pool": model_pool}
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'chatgpt')
+
+# The call types of the LLM requests
+CALL_TYPES = ["test", "backstory", "action_result", "custom_action", "quest", "quest_update", "history_summary", "shop"]
+
+# The token budget of the history in a prompt, shared by the rolling summary of the older turns and the recent turns
+# kept verbatim, and the length the summary is asked to keep to
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 1500))
+HISTORY_SUMMARY_TOKENS = int(os.getenv('HISTORY_SUMMARY_TOKENS', 300))
+
+# Whether the storyteller also updates the quest in the same response, instead of a separate quest updater call
+LLM_FUSED_QUEST_UPDATE = os.getenv('LLM_FUSED_QUEST_UPDATE', 'false').lower() in ['1', 'true', 'yes']
+
+# Placeholders for the per-call parts of the precompiled prompts
+BACKGROUND_PLACEHOLDER = "<<background>>"
+HISTORY_PLACEHOLDER = "<<history>>"
+
+
+def compact(prompt: str) -> str:
+    """
+    Collapses the whitespace runs left in a prompt by its line continuations, which only cost input tokens.
+    """
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def compact_json(data: dict) -> str:
+    """
+    Serializes a model input as compact JSON.
+    """
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False,
+                      default=lambda value: value.to_dict() if hasattr(value, "to_dict") else str(value))
+
+
+def verbatim_start(history: list[str], upto: int, budget: int) -> int:
+    """
+    Finds where the recent turns kept verbatim start, taking whole turns from the end of the history while they fit in
+    the token budget. The last turn is always kept, and the turns covered by the summary never are.
+
+    :param history: the history, alternating player actions and scenes
+    :param upto: the number of history entries covered by the summary
+    :param budget: the token budget of the verbatim turns
+    :return: the index of the first verbatim entry, always a player action
+    """
+    start = max(len(history) - (len(history) % 2 or 2), 0)
+    tokens = sum(count_tokens(part) for part in history[start:])
+    while start - 2 >= upto:
+        tokens += count_tokens(history[start - 2]) + count_tokens(history[start - 1])
+        if tokens > budget:
+            break
+        start -= 2
+    return max(start, upto)
+
+
+@functools.lru_cache(maxsize=256)
+def render_history(history: tuple[str, ...]) -> str:
+    """
+    Renders a (trimmed) history as a string, memoized, since every call of a turn renders the same history.
+
+    :param history: the history to be rendered, starting with a player action
+    :return: the history as a string
+    """
+    written_history = ""
+    for idx, part in enumerate(history):
+        if idx % 2 == 0:
+            written_history += "(player action: " + part + ") "
+        else:
+            written_history += part + " "
+    return written_history
+
+
+def llm_route(call_type: str) -> dict:
+    """
+    Returns the model route of a call type, from its environment variables (e.g. LLM_CUSTOM_ACTION_MODEL):
+    the backend, the model name, the maximal number of response tokens, the sampling temperature and the request
+    timeout, in seconds. The unset ones are the default model's.
+    """
+    def setting(name: str, cast: type):
+        value = os.getenv(f'LLM_{call_type.upper()}_{name}', '')
+        return cast(value) if value else None
+
+    return {"backend": setting("BACKEND", str) or LLM_BACKEND, "model": setting("MODEL", str),
+            "max_tokens": setting("MAX_TOKENS", int), "temperature": setting("TEMPERATURE", float),
+            "timeout": setting("TIMEOUT", float)}
+
+
+# The model routes by call type
+LLM_ROUTES = {call_type: llm_route(call_type) for call_type in CALL_TYPES}
+
+
+def route_models(routes: dict[str, dict]) -> dict[str, Model]:
+    """
+    Creates the models of the call types whose route differs from the default model, one for each distinct route.
+
+    :param routes: the model routes by call type
+    :return: the models by call type
+    """
+    default_route = llm_route("")
+    models, route_instances = {}, {}
+    for call_type, route in routes.items():
+        if route == default_route:
+            continue
+        key = tuple(route.values())
+        if key not in route_instances:
+            route_instances[key] = MODELS[route["backend"]](route["model"], route["max_tokens"], route["temperature"],
+                                                             route["timeout"])
+        models[call_type] = route_instances[key]
+    return models
+
+
 class LLM:
-    model: Model = ChatGPT()
+    model: Model = MODELS[LLM_BACKEND]()
+    # The models of the call types routed away from the default model, e.g. to a faster model for the small calls
+    models: dict[str, Model] = route_models(LLM_ROUTES)
+    fused_quest_update: bool = LLM_FUSED_QUEST_UPDATE
 
-    def write_history(self, history: list[str]) -> str:
+    def write_history(self, data: SaveData, action: str = None) -> str:
         """
-        Turns the history list into a string, trimming it if it's too long.
+        Turns the save's history into a string within the history token budget: the rolling summary of the older
+        turns, followed by as many of the recent turns as fit in the rest of the budget, verbatim.
+        Turns which are neither summarized yet nor recent enough are left out until the summary catches up. If the
+        summary falls more than an update behind (e.g. while its updates fail), it's left out instead, and the recent
+        turns take the whole budget.
 
-        :param history: the history to be trimmed
-        :return: the trimmed history as a string
+        :param data: the save data
+        :param action: a player action to add to the end of the history, if any
+        :return: the history as a string
         """
-        history_limit = 2 * self.model.history_window_size
-        written_history = ""
-        history_to_write = history
+        history = data.story["history"] + ([action + "."] if action is not None else [])
+        summary = data.get_summary()
+        start = verbatim_start(history, summary["upto"], HISTORY_TOKEN_BUDGET - count_tokens(summary["text"]))
+        if start > summary["upto"]:
+            logging.debug(f"History is {start - summary['upto']} entries ahead of its summary.")
+            # An update folds the unsummarized turns down to half of their budget, so more left out is a missed update
+            if sum(count_tokens(part) for part in history[summary["upto"]:start]) > \
+                    (HISTORY_TOKEN_BUDGET - HISTORY_SUMMARY_TOKENS) // 2:
+                logging.info(f"History summary is {start - summary['upto']} entries behind, leaving it out.")
+                summary = {"text": "", "upto": 0}
+                start = verbatim_start(history, 0, HISTORY_TOKEN_BUDGET)
 
-        if len(history) > history_limit:
-            history_to_write = history[len(history) - history_limit:]
+        written_history = render_history(tuple(history[start:]))
+        if summary["text"]:
+            written_history = "(summary of the story so far: " + summary["text"] + ") " + written_history
+        return written_history
 
-        for idx, part in enumerate(history_to_write):
-            if idx % 2 == 0:
-                written_history += "(player action: " + part + ") "
-            else:
-                written_history += part + " "
+    def turns_to_summarize(self, data: SaveData) -> int:
+        """
+        Returns the number of history entries the summary should cover.
+        Older turns are folded into the summary once the unsummarized turns go over their part of the budget,
+        and then down to half of it, so the summary is updated once every few turns rather than on every turn.
 
-        return written_history
+        :param data: the save data
+        :return: the number of entries the summary should cover, or the number it covers if it doesn't need an update
+        """
+        history = data.story["history"]
+        upto = data.get_summary()["upto"]
+        verbatim_budget = HISTORY_TOKEN_BUDGET - HISTORY_SUMMARY_TOKENS
+        if verbatim_start(history, upto, verbatim_budget) == upto:
+            return upto
+        return verbatim_start(history, upto, verbatim_budget // 2)
+
+    def model_for(self, call_type: str) -> Model:
+        """
+        Returns the model serving a call type.
+        """
+        return self.models.get(call_type, self.model)
+
+    def routes(self) -> dict:
+        """
+        Returns the model, the response token limit, the temperature and the request timeout of each call type.
+        """
+        routes = {}
+        for call_type in CALL_TYPES:
+            model = self.model_for(call_type)
+            routes[call_type] = {"model": model.model_name, "max_tokens": model.max_tokens,
+                                 "temperature": model.temperature, "timeout": model.request_timeout}
+        return routes
+
+    def pool_stats(self) -> dict:
+        """
+        Returns the statistics of the model pools, by the call types they serve.
+        """
+        call_types = {}
+        for call_type in CALL_TYPES:
+            model = self.model_for(call_type)
+            call_types.setdefault(id(model), (model, []))[1].append(call_type)
+        return {",".join(types): model.stats() for model, types in call_types.values() if isinstance(model, ModelPool)}
 
     # ---------------------------------------------- #
     # ----------------- Generators ----------------- #
     # ---------------------------------------------- #
 
-    def test(self) -> str:
-        return self.model.generate("test", "test")
+    async def test(self) -> str:
+        return await self.model_for("test").generate_async("test", "test", "test")
 
-    def generate_backstory(self, theme: Theme, background: dict) -> dict:
+    async def generate_backstory(self, theme: Theme, background: dict) -> dict:
         backstory_generator_input = {
             "inventory": theme.generate_empty_inventory(background),
             "background": background
         }
         logging.debug(f"Backstory generator input: {backstory_generator_input}")
-        return self.model.generate_json(self.backstory_system(theme, background), str(backstory_generator_input))
+        return await self.model_for("backstory").generate_json_async(
+            self.backstory_system(theme, background), compact_json(backstory_generator_input), "backstory")
 
-    def generate_action_result(self, data: SaveData, action: str, action_result: str) -> dict:
+    def action_result_input(self, data: SaveData, action: str, action_result: str) -> dict:
         action_json = {
-            "history": self.write_history(data.story["history"]),
+            "history": self.write_history(data),
             "choice": action,
             "result": action_result,
             "current_quest": data.quest.generate_dict_for_action(),
@@ -63,60 +256,118 @@ class LLM:
             "coins": data.coins
         }
         logging.debug(f"Action JSON: {action_json}")
+        return action_json
+
+    @staticmethod
+    def has_valid_quest_update(result: dict) -> bool:
+        """
+        Checks whether an action result includes a quest update, as generated by the fused storyteller.
+        """
+        quest = result.get("quest")
+        if not isinstance(quest, dict):
+            return False
+        if "quest_completed" in quest:
+            return quest["quest_completed"] != "completed" or "new_backstory" in quest
+        return all(isinstance(quest.get(field), list) for field in ["completed", "failed", "new"])
+
+    def action_result_tokens(self, data: SaveData, action: str) -> int:
+        """
+        Estimates the number of prompt tokens of an action result request.
+        """
+        action_json = self.action_result_input(data, action, "Success")
+        return count_tokens(self.storyteller_system(data)) + count_tokens(compact_json(action_json))
+
+    async def generate_action_result(self, data: SaveData, action: str, action_result: str) -> dict:
+        action_json = self.action_result_input(data, action, action_result)
 
-        result = self.model.generate_json(self.storyteller_system(data), str(action_json))
-        if result["status"] == "success" and "options" in result["result"] and len(result["result"]["options"]) > 0 and not isinstance(result["result"]["options"][0], str):
-            logging.debug(f"BAD RESULT! Action result: {result['result']}")
-            logging.debug(f"Trying again...")
-            result = self.model.generate_json(self.storyteller_system(data), str(action_json))
-            if result["status"] == "success" and not isinstance(result["result"]["options"][0], str):
-                logging.debug(f"BAD RESULT AGAIN! Action result: {result['result']}")
-                logging.debug(f"Failed to generate a valid result!")
-                return {"status": "error", "reason": "Failed to generate a valid result!"}
-        return result
-
-    def generate_custom_action(self, data: SaveData, new_action: str) -> dict:
+        return await self.model_for("action_result").generate_json_async(
+            self.storyteller_system(data), compact_json(action_json), "action_result")
+
+    async def stream_action_result(self, data: SaveData, action: str, action_result: str) -> AsyncIterator[tuple[str, any]]:
+        """
+        Generate the action result while streaming the scene text.
+        Yields ("scene", text) events as the scene's text arrives, and a final ("result", result) event with the
+        whole result, in the same format generate_action_result returns.
+        If the streamed response turns out to be invalid, the result is regenerated without streaming,
+        so the final result's scene is the one to keep.
+        """
+        action_json = self.action_result_input(data, action, action_result)
+        system = self.storyteller_system(data)
+        model = self.model_for("action_result")
+        scene = StreamedField("scene")
+        response = ""
+        try:
+            async for chunk in model.generate_stream_async(system, compact_json(action_json), "action_result"):
+                response += chunk
+                scene_text = scene.feed(chunk)
+                if scene_text:
+                    yield "scene", scene_text
+            yield "result", {"status": "success", "result": model.parse_json(response, "action_result")}
+            return
+        except SchemaError as exc:
+            logging.warning(f"Invalid streamed action result: {exc}")
+            model.parse_stats.count("action_result", "retried")
+        except Exception as _:
+            logging.exception("Error streaming action result:")
+        await model.forget_response(system, compact_json(action_json), "action_result")
+        logging.debug(f"Trying again without streaming...")
+        yield "result", await self.generate_action_result(data, action, action_result)
+
+    async def generate_custom_action(self, data: SaveData, new_action: str) -> dict:
         action_json = {
             "desired_action": new_action,
-            "history": self.write_history(data.story["history"]),
+            "history": self.write_history(data),
             "current_inventory": data.inventory,
             "current_coins": data.coins,
             "current_scene": data.story["scene"],
         }
         logging.debug(f"Action JSON: {action_json}")
-        return self.model.generate_json(self.action_system(data), str(action_json))
+        return await self.model_for("custom_action").generate_json_async(
+            self.action_system(data), compact_json(action_json), "custom_action")
 
-    def generate_quest(self, data: SaveData) -> dict:
+    async def generate_quest(self, data: SaveData) -> dict:
         quest_generator_input = {
             "background": data.background,
-            "history": self.write_history(data.story["history"]),
+            "history": self.write_history(data),
             "current_scene": data.story["scene"],
             "inventory": data.inventory
         }
         logging.debug(f"Quest generator input: {quest_generator_input}")
-        return self.model.generate_json(self.quest_system(data.theme), str(quest_generator_input))
+        return await self.model_for("quest").generate_json_async(
+            self.quest_system(data.theme), compact_json(quest_generator_input), "quest")
 
-    def update_quest(self, data: SaveData, action: str, new_scene: str, inventory: dict) -> dict:
+    async def update_quest(self, data: SaveData, action: str, new_scene: str, inventory: dict) -> dict:
         if data.quest is None:
             return {"status": "error", "reason": "No active quest!"}
         quest_updater_input = {
             "background": data.background,
-            "history": self.write_history(data.story["history"] + ["(player action: " + action + ") "]),
+            "history": self.write_history(data, action),
             "current_scene": new_scene,
             "inventory": inventory,
             "quest": data.quest.generate_dict_for_action()
         }
         logging.debug(f"Quest updater input: {quest_updater_input}")
-        return self.model.generate_json(self.quest_update_system(data.theme), str(quest_updater_input))
+        return await self.model_for("quest_update").generate_json_async(
+            self.quest_update_system(data.theme), compact_json(quest_updater_input), "quest_update")
 
-    def generate_shop(self, data: SaveData) -> dict:
+    async def summarize_history(self, data: SaveData, upto: int) -> dict:
+        summary = data.get_summary()
+        summarizer_input = {
+            "summary": summary["text"],
+            "new_events": render_history(tuple(data.story["history"][summary["upto"]:upto]))
+        }
+        logging.debug(f"History summarizer input: {summarizer_input}")
+        return await self.model_for("history_summary").generate_json_async(
+            self.summary_system(data.theme), compact_json(summarizer_input), "history_summary")
+
+    async def generate_shop(self, data: SaveData) -> dict:
         shop_generator_input = {
             "inventory": data.inventory,
             "background": data.background
         }
         logging.debug(f"Shop generator input: {shop_generator_input}")
-        return self.model.generate_json(self.shop_system(data.theme, data.inventory.categories),
-                                        str(shop_generator_input))
+        return await self.model_for("shop").generate_json_async(
+            self.shop_system(data.theme, data.inventory.categories), compact_json(shop_generator_input), "shop")
 
     # ---------------------------------------------- #
     # ------------ Prompt Constructors ------------- #
@@ -128,7 +379,7 @@ class LLM:
         for field in extra_fields:
             extra_fields_str += f"{field['extra_field']}: {field['extra_field_value']}, "
 
-        return f"You are the Game Master, narrating a text-based {theme} adventure game. \
+        return compact(f"You are the Game Master, narrating a text-based {theme} adventure game. \
         Your current role is to generate the player's backstory. \
         \
         I will provide you in json format the player's background and details. \
@@ -150,14 +401,19 @@ class LLM:
         and should be consistent with the player's background and the {theme} theme. \
         Keep the inventory minimal, no more than 2 items. \
         \
-        " + self.model.sys_footer()
+        " + self.model_for("backstory").sys_footer())
 
     def storyteller_system(self, data: SaveData):
-        theme = data.theme
-        background = data.background
-        skills = list(data.skills.keys())
+        fused = self.fused_quest_update and data.quest is not None
+        template = self.storyteller_template(data.theme, tuple(data.skills.keys()), fused)
+        return template.replace(BACKGROUND_PLACEHOLDER, compact_json(data.background))
+
+    @functools.lru_cache(maxsize=64)
+    def storyteller_template(self, theme: Theme, skills: tuple[str, ...], fused: bool = False):
+        skills = list(skills)
+        quest_update = self.fused_quest_template(theme) if fused else ""
 
-        return (f"You are the Game Master, narrating a text-based {theme} adventure game. \
+        return compact(f"You are the Game Master, narrating a text-based {theme} adventure game. \
         Guide the player through an exciting {theme} world filled with secrets to uncover, puzzles to solve, exciting \
         twists and challenges to beat, fitting the {theme} theme. \
         Adapt the story to the player's choices and ensure they experience a thrilling and engaging adventure. \
@@ -165,7 +421,7 @@ class LLM:
         If the player has a quest and goals, make sure to include them in the story. \
         If not, aim the story towards a new quest. \
         \
-        Player's background: {background} \
+        Player's background: {BACKGROUND_PLACEHOLDER} \
         \
         I will provide you in json format the following: \
         A history of the story so far, \
@@ -203,17 +459,42 @@ class LLM:
         coins: the updated player's amount of coins. \
         prompt: {image_prompt('''this scene''')} \
         Keep the prompt in the {theme} theme and coherent with the story so far, and don't include the player in it! \
+        {quest_update} \
         \
         IMPORTANT: When the player's health reaches 0, do not include the options field! \
         \
-        ") + self.model.sys_footer()
+        " + self.model_for("action_result").sys_footer())
+
+    @staticmethod
+    def fused_quest_template(theme: Theme):
+        return f"quest: the update of the player's quest and goals according to the new scene, in a json format. \
+        If the quest has completed or failed, it contains the following fields: \
+            quest_completed: a string value indicating weather the player's quest is completed or failed: 'completed' \
+            or 'failed'. \
+            new_backstory: an updated player's backstory according to the result of the quest (keep it short!). \
+        Else, it contains the following fields: \
+            completed: a list of the player's completed goals' titles. \
+            failed: a list of the player's failed goals' titles. \
+            new: a list of the player's new goals in dict format, each containing the following fields: \
+            - title: the goal's title. \
+            - goal: a short description of what the player needs to achieve, being clear and direct, so it's easy to tell if \
+            the player achieved them or not, and consistent with the player's backstory, inventory and the {theme} theme. \
+            - xp_reward: the amount of experience points the player will receive if he achieves the goal, in range [0, 100].\
+            - gold_reward: add this field only if the goal completion means the player receives coins from the goal \
+            requester, and set it to the amount of coins the player will receive, in range [0, 250]. \
+        Only add new goals if the new scene generates a new long-term goal for the player to achieve in order to \
+        progress in the main quest. Not every scene presents a new goal, and no need to add several goals at once! \
+        If the goal's text contains a ' character, escape it with a backslash."
 
     def action_system(self, data: SaveData):
-        theme = data.theme
-        history = data.story["history"]
-        skills = list(data.skills.keys())
+        template = self.action_template(data.theme, tuple(data.skills.keys()))
+        return template.replace(HISTORY_PLACEHOLDER, self.write_history(data))
 
-        return f"You are the Game Master, narrating a text-based {theme} adventure game. \
+    @functools.lru_cache(maxsize=64)
+    def action_template(self, theme: Theme, skills: tuple[str, ...]):
+        skills = list(skills)
+
+        return compact(f"You are the Game Master, narrating a text-based {theme} adventure game. \
         Your current role is to check weather the player's desired action is valid and generate it's properties. \
         A valid action is an action that the player can take according to his current inventory, coins, \
         the world's logic, and the story history so far. \
@@ -235,12 +516,13 @@ class LLM:
             experience: an integer value in range [0, 15] representing the experience points the player will gain if \
             he chooses this action. \
         \
-        Follows is the player's story history so far: {history} \
+        Follows is the player's story history so far: {HISTORY_PLACEHOLDER} \
         \
-        " + self.model.sys_footer()
+        " + self.model_for("custom_action").sys_footer())
 
+    @functools.lru_cache(maxsize=64)
     def quest_system(self, theme: Theme):
-        return (f"You are the Game Master, narrating a text-based {theme} adventure game. \
+        return compact(f"You are the Game Master, narrating a text-based {theme} adventure game. \
         Your current role is to generate a main quest for the player to achieve, with 3 sub-goals. \
         The main quest should be long, challenging, and engaging, fitting the {theme} theme, and consistent with the \
         player's backstory, inventory and the history so far (if any). \
@@ -274,10 +556,11 @@ class LLM:
         the previous one, and leading to the main quest. \
         If the quest's or goals' text contains a ' character, escape it with a backslash. \
         \
-        ") + self.model.sys_footer()
+        " + self.model_for("quest").sys_footer())
 
+    @functools.lru_cache(maxsize=64)
     def quest_update_system(self, theme: Theme):
-        return (f"You are the Game Master, narrating a text-based {theme} adventure game. \
+        return compact(f"You are the Game Master, narrating a text-based {theme} adventure game. \
         Your current role is to check weather the player's quest or goals are achieved and update the player's goals \
         and quest. \
         If you have a new goal to add to the player, add it according to the current scene, in the context of the \
@@ -314,10 +597,36 @@ class LLM:
         history, inventory, other goals and most importantly, the main quest. \
         If the goal's text contains a ' character, escape it with a backslash. \
         \
-        ") + self.model.sys_footer()
+        " + self.model_for("quest_update").sys_footer())
+
+    @functools.lru_cache(maxsize=64)
+    def summary_system(self, theme: Theme):
+        return compact(f"You are the Game Master, narrating a text-based {theme} adventure game. \
+        Your current role is to keep a running summary of the story so far, so it can be remembered after the \
+        events themselves are forgotten. \
+        \
+        I will provide you in json format the following: \
+            The summary of the story so far (empty at the start of the story), \
+            The new events of the story since the summary, as the player's actions and the scenes that followed. \
+        \
+        You will reply with a single json format containing the following field: \
+            summary: the updated summary of the story, covering both the summary so far and the new events. \
+        \
+        Keep the summary under {HISTORY_SUMMARY_TOKENS * 3 // 4} words, written as a short narration in the past tense. \
+        Keep the facts that matter for the rest of the story: the places visited, the characters met, the promises \
+        made, the items gained or lost, and the progress on the player's quests. \
+        Compress the older events more than the new ones, and leave out details that no longer matter. \
+        \
+        " + self.model_for("history_summary").sys_footer())
 
     def shop_system(self, theme: Theme, inv_categories: list[str]):
-        return (f"You are the Game Master, narrating a text-based {theme} adventure game. \
+        return self.shop_template(theme, tuple(inv_categories))
+
+    @functools.lru_cache(maxsize=64)
+    def shop_template(self, theme: Theme, inv_categories: tuple[str, ...]):
+        inv_categories = list(inv_categories)
+
+        return compact(f"You are the Game Master, narrating a text-based {theme} adventure game. \
         Your current role is to run a shop for the player to interact with. \
         \
         I will provide you in json format details about the player's character, \
@@ -344,4 +653,4 @@ class LLM:
         the player. \
         Note, That the shopkeeper knows the player's character well, and is a snarky person. \
         \
-        ") + self.model.sys_footer()
+        " + self.model_for("shop").sys_footer())
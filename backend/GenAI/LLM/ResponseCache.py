@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from backend.Utility import TTLCache
+
+# The call types whose responses are cached, comma separated ("*" for all), none by default
+LLM_CACHE_CALL_TYPES = {call_type.strip() for call_type in os.getenv('LLM_CACHE_CALL_TYPES', '').split(',')
+                        if call_type.strip()}
+# The bounds of the in-memory tier, and the time to live of the cached responses in seconds
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', 1024))
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', 86400))
+# The path of the disk tier's database (empty to keep the cache in memory only), and its maximal number of responses
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', 'backend/llm_cache.sqlite3')
+LLM_CACHE_DISK_SIZE = int(os.getenv('LLM_CACHE_DISK_SIZE', 100000))
+
+
+def response_key(model_name: str, system: str, request: str) -> str:
+    """
+    Returns the cache key of a model response.
+
+    :param model_name: the name of the model
+    :param system: the system message
+    :param request: the user request
+    :return: the key of the response
+    """
+    return hashlib.sha256("\0".join([model_name, system, request]).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    A two-tier cache of model responses: a bounded in-memory LRU tier in front of a SQLite tier on disk,
+    which survives restarts and is shared by the server's processes.
+    Both tiers expire responses by their time to live, and the disk tier drops its oldest responses over its bound.
+    The disk operations are blocking, and should run off the event loop.
+    """
+
+    def __init__(self, call_types: set[str] = LLM_CACHE_CALL_TYPES, max_size: int = LLM_CACHE_SIZE,
+                 ttl: float = LLM_CACHE_TTL, path: str = LLM_CACHE_PATH, disk_size: int = LLM_CACHE_DISK_SIZE):
+        """
+        :param call_types: the call types whose responses are cached, "*" for all
+        :param max_size: the maximal number of responses in memory
+        :param ttl: the time to live of a response, in seconds
+        :param path: the path of the disk tier's database, or an empty string for no disk tier
+        :param disk_size: the maximal number of responses on disk
+        """
+        self.call_types = call_types
+        self.ttl = ttl
+        self.path = path
+        self.disk_size = disk_size
+        self.memory = TTLCache(max_size, ttl)
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._puts = 0
+        self._stats = {"disk_hits": 0, "disk_misses": 0, "stores": 0, "coalesced": 0, "errors": 0}
+
+    def enabled(self, call_type: str | None) -> bool:
+        """
+        Checks whether the responses of a call type are cached.
+        """
+        return call_type is not None and ("*" in self.call_types or call_type in self.call_types)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # Opened on first use, and shared by the threads (which access it under the lock)
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                             "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires)")
+            self._db.commit()
+        return self._db
+
+    def get(self, key: str) -> str | None:
+        """
+        Returns the cached response of the key, from memory or from disk, or None if it isn't cached.
+
+        :param key: the key of the response
+        :return: the response
+        """
+        response = self.memory.get(key)
+        if response is not None:
+            return response
+        return self.get_disk(key)
+
+    def get_disk(self, key: str) -> str | None:
+        """
+        Returns the cached response of the key from disk, promoting it to memory, or None if it isn't cached.
+        """
+        if not self.path:
+            return None
+
+        try:
+            with self._lock:
+                row = self.db.execute("SELECT response, expires FROM responses WHERE key = ? AND expires > ?",
+                                      (key, time.time())).fetchone()
+                self._stats["disk_hits" if row else "disk_misses"] += 1
+        except sqlite3.Error:
+            logging.exception("Error reading the LLM response cache:")
+            self._stats["errors"] += 1
+            return None
+        if row is None:
+            return None
+        self.memory.put(key, row[0], row[1] - time.time())
+        return row[0]
+
+    def get_memory(self, key: str) -> str | None:
+        """
+        Returns the cached response of the key if it's in memory, without touching the disk.
+        """
+        return self.memory.get(key)
+
+    def put(self, key: str, response: str) -> None:
+        """
+        Caches a response in both tiers.
+
+        :param key: the key of the response
+        :param response: the response
+        """
+        self.memory.put(key, response)
+        self._stats["stores"] += 1
+        if not self.path:
+            return
+
+        try:
+            with self._lock:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                                (key, response, time.time() + self.ttl))
+                self._puts += 1
+                if self._puts % 100 == 0:
+                    self._prune()
+                self.db.commit()
+        except sqlite3.Error:
+            logging.exception("Error writing the LLM response cache:")
+            self._stats["errors"] += 1
+
+    def _prune(self) -> None:
+        self.db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+        self.db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY expires DESC "
+                        "LIMIT -1 OFFSET ?)", (self.disk_size,))
+
+    def discard(self, key: str) -> None:
+        """
+        Removes a response from both tiers, e.g. when it turned out to be invalid.
+
+        :param key: the key of the response
+        """
+        self.memory.discard(key)
+        if not self.path:
+            return
+
+        try:
+            with self._lock:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+        except sqlite3.Error:
+            logging.exception("Error writing the LLM response cache:")
+            self._stats["errors"] += 1
+
+    def coalesced(self) -> None:
+        """
+        Counts a request that joined an identical request already in flight.
+        """
+        self._stats["coalesced"] += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the cache's configuration and the hit/miss counters of both tiers.
+        """
+        return {"call_types": sorted(self.call_types), "memory": self.memory.stats(), **self._stats}
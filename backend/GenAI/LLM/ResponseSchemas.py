@@ -0,0 +1,223 @@
+import ast
+import json
+import re
+import threading
+
+
+class SchemaError(ValueError):
+    """
+    Raised when a model response can't be parsed, or doesn't fit its schema even after repair.
+    """
+
+
+class Optional:
+    """
+    A schema field the response may leave out (or set to null).
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+class OneOf:
+    """
+    A schema matched by the first of its alternatives the value fits.
+    """
+
+    def __init__(self, *specs):
+        self.specs = specs
+
+
+# The schemas of the JSON responses, by call type.
+# A schema is a type (str, int, float, bool, dict, list), a list of a single schema (a list of values of that schema),
+# a dict of schemas by key (an object with these fields, extra fields are kept as is), Optional or OneOf.
+QUEST_GOAL = {"title": str, "goal": Optional(str), "description": Optional(str), "xp_reward": int,
+              "gold_reward": Optional(int)}
+NEW_GOAL = {"title": str, "goal": str, "xp_reward": int, "gold_reward": Optional(int)}
+QUEST_UPDATE = OneOf({"quest_completed": str, "new_backstory": Optional(str)},
+                     {"completed": [str], "failed": [str], "new": [NEW_GOAL]})
+RESPONSE_SCHEMAS = {
+    "backstory": {"name": str, "backstory": str, "traits": [str], "starting_location": str, "inventory": dict,
+                  "character_prompt": str, "scene_prompt": str},
+    "action_result": {"scene": str, "new_location": Optional(str), "options": Optional([str]),
+                      "rates": Optional([float]), "advantages": Optional([str]), "level": Optional([int]),
+                      "experience": Optional([int]), "health": int, "inventory": dict, "coins": int, "prompt": str,
+                      "quest": Optional(QUEST_UPDATE)},
+    "custom_action": {"valid": str, "rate": Optional(float), "advantage": Optional(str), "level": Optional(int),
+                      "experience": Optional(int)},
+    "quest": {"quest_title": str, "quest_description": str, "quest_xp_reward": int, "quest_gold_reward": Optional(int),
+              "goals": OneOf([QUEST_GOAL], dict)},
+    "quest_update": QUEST_UPDATE,
+    "shop": OneOf({"problem": str},
+                  {"sold_items": dict, "buy_items": dict, "shopkeeper_description": str,
+                   "shopkeeper_recommendation": str, "prompt": str}),
+    "history_summary": {"summary": str},
+}
+
+# The fields a text value is taken from, when a model wraps it in an object
+TEXT_FIELDS = ["option", "action", "text", "name", "title", "description", "value"]
+NUMBER = re.compile(r"^[-+]?\d+(\.\d*)?$|^[-+]?\.\d+$")
+
+
+def extract_json(response: str) -> str:
+    """
+    Cuts the JSON object out of a response, dropping a fenced code block's markers and any prose around the object.
+    """
+    text = response.strip()
+    if text.startswith("```"):
+        text = text[text.find("\n") + 1:]
+        text = text[:text.rfind("```")] if "```" in text else text
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return text
+    return text[start:end + 1]
+
+
+def parse_json(response: str) -> tuple[dict, bool]:
+    """
+    Parses a model response as a JSON object.
+    Strict JSON is parsed directly, and anything else goes through the tolerant path: the object is cut out of any
+    fences and prose, and parsed as JSON, as a Python literal (single quotes, True/None) or without trailing commas.
+
+    :param response: the response from the model
+    :return: the parsed object, and whether the tolerant path was needed
+    :raises SchemaError: if the response isn't a JSON object
+    """
+    try:
+        result = json.loads(response)
+        if isinstance(result, dict):
+            return result, False
+    except ValueError:
+        pass
+
+    text = extract_json(response)
+    for parse in [json.loads, ast.literal_eval, lambda value: json.loads(re.sub(r",\s*([}\]])", r"\1", value))]:
+        try:
+            result = parse(text)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+        if isinstance(result, dict):
+            return result, True
+    raise SchemaError("Error parsing JSON.\n" + response)
+
+
+def _coerce_scalar(value: any, spec: type) -> tuple[any, bool]:
+    if spec is str:
+        if isinstance(value, str):
+            return value, False
+        if isinstance(value, bool):
+            return "yes" if value else "no", True
+        if isinstance(value, (int, float)):
+            return str(value), True
+        if isinstance(value, dict):
+            for field in TEXT_FIELDS:
+                if isinstance(value.get(field), str):
+                    return value[field], True
+            texts = [item for item in value.values() if isinstance(item, str)]
+            if texts:
+                return texts[0], True
+    elif spec in [int, float]:
+        if isinstance(value, bool):
+            raise SchemaError(f"Expected a number, got {value!r}.")
+        if isinstance(value, (int, float)):
+            return (round(value), value != round(value)) if spec is int else (value, False)
+        if isinstance(value, str) and NUMBER.match(value.strip()):
+            number = float(value.strip())
+            return (round(number) if spec is int else number), True
+    elif spec is bool:
+        if isinstance(value, bool):
+            return value, False
+        if isinstance(value, str) and value.strip().lower() in ["yes", "no", "true", "false"]:
+            return value.strip().lower() in ["yes", "true"], True
+    elif spec is dict:
+        if isinstance(value, dict):
+            return value, False
+    elif spec is list:
+        if isinstance(value, list):
+            return value, False
+        if isinstance(value, tuple):
+            return list(value), True
+    else:
+        raise TypeError(f"Unknown schema type: {spec}")
+    raise SchemaError(f"Expected {spec.__name__}, got {value!r}.")
+
+
+def coerce(value: any, spec) -> tuple[any, bool]:
+    """
+    Checks a value against a schema, repairing the common defects of model responses: values wrapped in objects,
+    numbers as strings, lists as tuples or as numbered objects, and null optional fields.
+
+    :param value: the value to be checked
+    :param spec: the schema of the value
+    :return: the (repaired) value, and whether it was repaired
+    :raises SchemaError: if the value doesn't fit the schema and can't be repaired
+    """
+    if isinstance(spec, Optional):
+        return coerce(value, spec.spec)
+    if isinstance(spec, OneOf):
+        errors = []
+        for alternative in spec.specs:
+            try:
+                return coerce(value, alternative)
+            except SchemaError as exc:
+                errors.append(str(exc))
+        raise SchemaError(" / ".join(errors))
+    if isinstance(spec, list):
+        repaired = False
+        if isinstance(value, dict):  # A numbered object, like {"1": ..., "2": ...}
+            value, repaired = list(value.values()), True
+        elif isinstance(value, tuple):
+            value, repaired = list(value), True
+        elif not isinstance(value, list):
+            raise SchemaError(f"Expected a list, got {value!r}.")
+        items = []
+        for item in value:
+            item, item_repaired = coerce(item, spec[0])
+            items.append(item)
+            repaired = repaired or item_repaired
+        return items, repaired
+    if isinstance(spec, dict):
+        if not isinstance(value, dict):
+            raise SchemaError(f"Expected an object, got {value!r}.")
+        result = dict(value)
+        repaired = False
+        for field, field_spec in spec.items():
+            if result.get(field) is None:
+                if not isinstance(field_spec, Optional):
+                    raise SchemaError(f"Missing field: {field}.")
+                if field in result:
+                    del result[field]
+                    repaired = True
+                continue
+            result[field], field_repaired = coerce(result[field], field_spec)
+            repaired = repaired or field_repaired
+        return result, repaired
+    return _coerce_scalar(value, spec)
+
+
+class ParseStats:
+    """
+    Counts the outcomes of parsing the JSON responses, by call type:
+    responses parsed strictly, through the tolerant path, repaired to fit their schema, retried with a second model
+    call, and failed even after the retry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: dict[str, dict[str, int]] = {}
+
+    def count(self, call_type: str | None, outcome: str) -> None:
+        with self._lock:
+            counts = self._counts.setdefault(call_type or "other", {"responses": 0, "strict": 0, "tolerant": 0,
+                                                                     "repaired": 0, "retried": 0, "failed": 0})
+            counts[outcome] += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the counters by call type, with the rates of the responses which needed a repair or a retry.
+        """
+        with self._lock:
+            return {call_type: {**counts,
+                                "repair_rate": counts["repaired"] / counts["responses"] if counts["responses"] else 0.0,
+                                "retry_rate": counts["retried"] / counts["responses"] if counts["responses"] else 0.0}
+                    for call_type, counts in self._counts.items()}
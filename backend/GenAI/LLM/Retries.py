@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import httpx
+from backend.GenAI.Offline import OfflineError
+
+# The number of attempts of a model request, and the exponential backoff between them, in seconds: the delay before
+# the n-th retry is drawn uniformly up to min(max, base * 2^n) ("full jitter"), or the server's Retry-After if longer
+LLM_ATTEMPTS = int(os.getenv('LLM_ATTEMPTS', 2))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', 0.5))
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', 8))
+# The number of consecutive failed requests after which a backend's circuit breaker opens, and how long it stays open
+# before letting a probe request through, in seconds
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', 5))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', 30))
+
+# HTTP statuses worth retrying: timeouts, conflicts, throttling and the server's errors
+RETRYABLE_STATUSES = {408, 409, 425, 429}
+# Failures of the transport worth retrying: timeouts, connection errors, and the offline backends' simulated failures
+RETRYABLE_ERRORS = (httpx.TransportError, TimeoutError, OfflineError)
+
+
+class CircuitOpenError(Exception):
+    """
+    A request refused without calling the model, because the backend's circuit breaker is open.
+    """
+
+
+def response_status(exc: Exception) -> int | None:
+    """
+    Returns the HTTP status of a failed API request, or None if the failure isn't an HTTP error response.
+    """
+    return getattr(getattr(exc, "response", None), "status_code", None)
+
+
+def is_retryable(exc: Exception) -> bool:
+    """
+    Checks whether a failed request may succeed when retried.
+    Throttling, server errors, timeouts and connection errors are transient, while requests the server rejected as
+    invalid (e.g. a bad request or a missing API key) and any other failure (e.g. a response that can't be parsed or a
+    bug) fail the same way again.
+    """
+    status = response_status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    return isinstance(exc, RETRYABLE_ERRORS)
+
+
+def retry_after(exc: Exception) -> float | None:
+    """
+    Returns the delay the server asked for in a throttling response's Retry-After header, in seconds, if any.
+    """
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Fails a backend's requests fast while the backend is down or throttling, instead of piling more requests on it.
+    Opens after a number of consecutive retryable failures, and after a cooldown lets a single probe request through
+    ("half open"): its success closes the breaker, and its failure opens it for another cooldown.
+    """
+
+    def __init__(self, name: str, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        """
+        :param name: the name of the backend
+        :param failures: the number of consecutive failures which open the breaker
+        :param cooldown: the time the breaker stays open before a probe, in seconds
+        """
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> None:
+        """
+        Lets a request through, or refuses it while the breaker is open or its probe is in flight.
+
+        :raises CircuitOpenError: If the request is refused
+        """
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self.probing:
+                self.probing = True
+                logging.info(f"Circuit breaker of {self.name} is half open, probing.")
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"The {self.name} circuit breaker is open.")
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f"Circuit breaker of {self.name} closed.")
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.probing or (self.opened_at is None and self.consecutive_failures >= self.failures):
+                logging.warning(f"Circuit breaker of {self.name} opened after "
+                                f"{self.consecutive_failures} consecutive failures.")
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+            self.probing = False
+
+    def release(self) -> None:
+        """
+        Releases the probe of a request which ended without telling whether the backend is healthy (e.g. cancelled).
+        """
+        with self._lock:
+            self.probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self._state(), "consecutive_failures": self.consecutive_failures,
+                    "times_opened": self.times_opened, "rejected": self.rejected}
+
+
+class RetryPolicy:
+    """
+    Retries the failed model requests with exponential backoff and jitter, so that when the model throttles,
+    the requests that failed together don't all retry together and make the overload worse.
+    Only the retryable failures are retried, and each backend's requests go through its circuit breaker.
+    Counts the attempts, retries and failures by call type.
+    """
+
+    def __init__(self, attempts: int = LLM_ATTEMPTS, backoff_base: float = LLM_BACKOFF_BASE,
+                 backoff_max: float = LLM_BACKOFF_MAX):
+        """
+        :param attempts: the number of attempts of a request
+        :param backoff_base: the backoff of the first retry, in seconds, doubled for each retry
+        :param backoff_max: the maximal backoff, in seconds
+        """
+        self.attempts = max(1, attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self._counts: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, backend: str) -> CircuitBreaker:
+        """
+        Returns the circuit breaker of a backend.
+        """
+        with self._lock:
+            if backend not in self.breakers:
+                self.breakers[backend] = CircuitBreaker(backend)
+            return self.breakers[backend]
+
+    def _count(self, call_type: str | None, outcome: str) -> None:
+        with self._lock:
+            counts = self._counts.setdefault(str(call_type), {"requests": 0, "attempts": 0, "retried": 0,
+                                                               "not_retryable": 0, "exhausted": 0, "fast_failed": 0})
+            counts[outcome] += 1
+
+    def backoff(self, retry: int, exc: Exception) -> float:
+        """
+        Returns the delay before a retry.
+
+        :param retry: the number of the retry, from 0
+        :param exc: the failure being retried
+        :return: the delay, in seconds
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+        return max(delay, min(retry_after(exc) or 0, self.backoff_max))
+
+    def _failed(self, breaker: CircuitBreaker, call_type: str | None, exc: Exception, last: bool) -> bool:
+        # Records a failed attempt, and returns whether it should be retried
+        if isinstance(exc, CircuitOpenError):
+            self._count(call_type, "fast_failed")
+            return False
+        if not is_retryable(exc):
+            if response_status(exc) is not None:
+                # The backend answered, so it isn't down
+                breaker.record_success()
+            else:
+                # The request failed on our side (e.g. a bug or a full executor), telling nothing of the backend
+                breaker.release()
+            self._count(call_type, "not_retryable")
+            return False
+        breaker.record_failure()
+        # A retry would only be refused by the breaker once it opened
+        if last or breaker.state != "closed":
+            self._count(call_type, "exhausted")
+            return False
+        self._count(call_type, "retried")
+        logging.warning(f"Retrying a {call_type} request to {breaker.name} after: {exc!r}")
+        return True
+
+    async def run_async(self, backend: str, call_type: str | None, request: callable):
+        """
+        Runs a request until it succeeds, fails with a non-retryable error, or runs out of attempts.
+
+        :param backend: the name of the backend, selecting its circuit breaker
+        :param call_type: the type of the call
+        :param request: a coroutine function making the request, called again for each attempt
+        :return: the response of the request
+        :raises CircuitOpenError: If the backend's circuit breaker is open
+        """
+        breaker = self.breaker(backend)
+        self._count(call_type, "requests")
+        for attempt in range(self.attempts):
+            try:
+                breaker.allow()
+                self._count(call_type, "attempts")
+                response = await request()
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as exc:
+                if not self._failed(breaker, call_type, exc, attempt + 1 >= self.attempts):
+                    raise
+                await asyncio.sleep(self.backoff(attempt, exc))
+                continue
+            breaker.record_success()
+            return response
+
+    def run(self, backend: str, call_type: str | None, request: callable):
+        """
+        Runs a request like run_async, blocking between the attempts.
+        """
+        breaker = self.breaker(backend)
+        self._count(call_type, "requests")
+        for attempt in range(self.attempts):
+            try:
+                breaker.allow()
+                self._count(call_type, "attempts")
+                response = request()
+            except Exception as exc:
+                if not self._failed(breaker, call_type, exc, attempt + 1 >= self.attempts):
+                    raise
+                time.sleep(self.backoff(attempt, exc))
+                continue
+            breaker.record_success()
+            return response
+
+    async def stream_async(self, backend: str, call_type: str | None, request: callable):
+        """
+        Runs a streamed request like run_async, yielding its chunks as they arrive.
+        A request is retried only if it failed before its first chunk was yielded.
+
+        :param backend: the name of the backend, selecting its circuit breaker
+        :param call_type: the type of the call
+        :param request: a function returning an async iterator over the response chunks, called again for each attempt
+        :return: an async iterator over the response chunks
+        """
+        breaker = self.breaker(backend)
+        self._count(call_type, "requests")
+        for attempt in range(self.attempts):
+            started = False
+            try:
+                breaker.allow()
+                self._count(call_type, "attempts")
+                async for chunk in request():
+                    started = True
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                breaker.release()
+                raise
+            except Exception as exc:
+                if not self._failed(breaker, call_type, exc, started or attempt + 1 >= self.attempts):
+                    raise
+                await asyncio.sleep(self.backoff(attempt, exc))
+                continue
+            breaker.record_success()
+            return
+
+    def stats(self) -> dict:
+        """
+        Returns the retry configuration, the counters by call type and the state of each backend's circuit breaker.
+        """
+        with self._lock:
+            counts = {call_type: dict(counts) for call_type, counts in self._counts.items()}
+            breakers = list(self.breakers.values())
+        return {"attempts": self.attempts, "backoff_base": self.backoff_base, "backoff_max": self.backoff_max,
+                "breakers": {breaker.name: breaker.stats() for breaker in breakers}, **counts}
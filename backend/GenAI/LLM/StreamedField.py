@@ -0,0 +1,64 @@
+import re
+
+# Escape sequences allowed in the model's JSON (or python literal) strings
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "/": "/", "\\": "\\", "\"": "\"", "'": "'"}
+
+
+class StreamedField:
+    """
+    Extracts the value of a single string field from a JSON response while it is still being streamed.
+    The response chunks are fed as they arrive, and each feed returns the newly decoded part of the field's value,
+    so it can be pushed to the client before the whole response is complete.
+    """
+
+    def __init__(self, field: str):
+        """
+        :param field: The name of the string field to extract.
+        """
+        self.field_start = re.compile(r"""["']""" + re.escape(field) + r"""["']\s*:\s*(["'])""")
+        self.buffer = ""
+        self.position = 0
+        self.quote = None
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        Feed the next chunk of the streamed response.
+
+        :param chunk: The next chunk of the response.
+        :return: The newly decoded part of the field's value, or an empty string if there is none yet.
+        """
+        if self.done:
+            return ""
+        self.buffer += chunk
+
+        if self.quote is None:
+            match = self.field_start.search(self.buffer)
+            if not match:
+                return ""
+            self.quote = match.group(1)
+            self.position = match.end()
+
+        decoded = ""
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if char == self.quote:
+                self.done = True
+                break
+            if char == "\\":
+                escape = self.buffer[self.position + 1:self.position + 2]
+                if not escape:
+                    break  # Wait for the rest of the escape sequence
+                if escape == "u":
+                    code = self.buffer[self.position + 2:self.position + 6]
+                    if len(code) < 4:
+                        break
+                    decoded += chr(int(code, 16)) if all(c in "0123456789abcdefABCDEF" for c in code) else code
+                    self.position += 6
+                    continue
+                decoded += ESCAPES.get(escape, escape)
+                self.position += 2
+                continue
+            decoded += char
+            self.position += 1
+        return decoded
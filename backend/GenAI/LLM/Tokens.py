@@ -0,0 +1,12 @@
+import math
+import os
+
+# The average number of characters per token, for estimating the token count of a text
+CHARS_PER_TOKEN = float(os.getenv('CHARS_PER_TOKEN', 4))
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of a text.
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import threading
+import httpx
+from backend.Executors import EXECUTORS
+from backend.GenAI.LLM.models.ModelClass import Model
+
+# The timeouts of the model API requests, in seconds: establishing a connection, and waiting for the response's data
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', 5))
+LLM_READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', 120))
+# The maximal number of connections to the model API, by default one for each worker that may call the model,
+# and the number of idle connections kept alive for reuse
+LLM_POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', EXECUTORS["foreground"].workers + EXECUTORS["speculative"].workers))
+LLM_KEEPALIVE_SIZE = int(os.getenv('LLM_KEEPALIVE_SIZE', LLM_POOL_SIZE))
+
+
+class HTTPModel(Model):
+    """
+    A model served over an HTTP API, through clients shared by all the requests of the process.
+    The clients keep their connections alive in a bounded pool, so a request doesn't pay for a new connection (and
+    TLS handshake), and the async requests don't hold a thread while they wait for the model.
+    The async client is bound to the event loop it was created in, so a new one is created for a new loop.
+    """
+    timeout = httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    limits = httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_KEEPALIVE_SIZE)
+    _client: httpx.Client | None = None
+    _async_clients: dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+    _clients_lock = threading.Lock()
+
+    def request_timeouts(self) -> httpx.Timeout:
+        """
+        Returns the timeouts of the model's requests, its own request timeout replacing the read timeout if it has one.
+        """
+        if self.request_timeout is None:
+            return self.timeout
+        return httpx.Timeout(self.request_timeout, connect=LLM_CONNECT_TIMEOUT)
+
+    def headers(self) -> dict:
+        """
+        Returns the headers of the API requests, e.g. their authorization.
+        """
+        return {}
+
+    @property
+    def client(self) -> httpx.Client:
+        with self._clients_lock:
+            if HTTPModel._client is None:
+                HTTPModel._client = httpx.Client(timeout=self.timeout, limits=self.limits)
+            return HTTPModel._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            if loop not in HTTPModel._async_clients:
+                # Drop the clients of closed loops, whose connections can't be used anymore
+                for closed_loop in [other for other in HTTPModel._async_clients if other.is_closed()]:
+                    del HTTPModel._async_clients[closed_loop]
+                HTTPModel._async_clients[loop] = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+            return HTTPModel._async_clients[loop]
+
+    def post(self, url: str, payload: dict) -> dict:
+        """
+        Post a request to the API and return its JSON response.
+
+        :param url: The URL of the API endpoint
+        :param payload: The JSON body of the request
+        :return: The JSON response
+        """
+        response = self.client.post(url, json=payload, headers=self.headers(), timeout=self.request_timeouts())
+        response.raise_for_status()
+        return response.json()
+
+    async def post_async(self, url: str, payload: dict) -> dict:
+        """
+        Post a request to the API and return its JSON response, without blocking the event loop.
+
+        :param url: The URL of the API endpoint
+        :param payload: The JSON body of the request
+        :return: The JSON response
+        """
+        response = await self.async_client.post(url, json=payload, headers=self.headers(),
+                                               timeout=self.request_timeouts())
+        response.raise_for_status()
+        return response.json()
+
+    async def stream_lines_async(self, url: str, payload: dict):
+        """
+        Post a request to the API and yield the lines of its streamed response as they arrive.
+
+        :param url: The URL of the API endpoint
+        :param payload: The JSON body of the request
+        :return: An async iterator over the response lines
+        """
+        async with self.async_client.stream("POST", url, json=payload, headers=self.headers(),
+                                            timeout=self.request_timeouts()) as response:
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                yield line
+
+    @classmethod
+    async def close(cls) -> None:
+        """
+        Close the shared clients and their connections.
+        """
+        with cls._clients_lock:
+            client, HTTPModel._client = HTTPModel._client, None
+            async_clients, HTTPModel._async_clients = HTTPModel._async_clients, {}
+        if client is not None:
+            client.close()
+        loop = asyncio.get_running_loop()
+        for client_loop, async_client in async_clients.items():
+            if client_loop is loop:
+                await async_client.aclose()
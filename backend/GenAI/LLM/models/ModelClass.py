@@ -1,14 +1,69 @@
-import ast
+import asyncio
+from typing import AsyncIterator
 from backend.Utility import *
+from backend.GenAI.Governor import get_governor
+from backend.GenAI.LLM.Tokens import count_tokens
+from backend.GenAI.LLM.ResponseCache import ResponseCache, response_key
+from backend.GenAI.LLM import ResponseSchemas
+from backend.GenAI.LLM.Hedging import HedgePolicy
+from backend.GenAI.LLM.Retries import RetryPolicy
 
 
 class Model:
-    num_of_retries = 2
-    history_window_size = 20
+    model_name = ""
+    # The provider serving the model, whose limits its requests share (see backend/GenAI/Governor.py)
+    provider = ""
+    # The limits of the responses, the backend's defaults if None
+    max_tokens: int | None = None
+    temperature: float | None = None
+    request_timeout: float | None = None
+    # Retries with backoff, through a circuit breaker by backend, shared by all the models
+    retries = RetryPolicy()
+    # Opt-in cache of the responses, by call type, shared by all the models (their responses are keyed by model name)
+    response_cache = ResponseCache()
+    response_requests = SingleFlight()
+    parse_stats = ResponseSchemas.ParseStats()
+    # Opt-in hedging of the slow requests, by call type
+    hedging = HedgePolicy()
+
+    def __init__(self, model_name: str = None, max_tokens: int = None, temperature: float = None,
+                 request_timeout: float = None):
+        """
+        :param model_name: The name of the model, the backend's default if None
+        :param max_tokens: The maximal number of tokens of a response
+        :param temperature: The sampling temperature of the responses
+        :param request_timeout: The time limit of a request, in seconds
+        """
+        if model_name:
+            self.model_name = model_name
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.request_timeout = request_timeout
 
     def sys_footer(self) -> str:
         raise NotImplementedError
 
+    @property
+    def backend(self) -> str:
+        """
+        The name of the model's backend: its provider, or the model's name without one.
+        """
+        return self.provider or self.model_name
+
+    @property
+    def breaker(self):
+        """
+        The circuit breaker of the model's backend, open while the backend keeps failing.
+        """
+        return self.retries.breaker(self.backend)
+
+    @property
+    def governor(self):
+        """
+        The governor of the model's provider, limiting the requests sent to it.
+        """
+        return get_governor(self.backend)
+
     def _request(self, system_message: str, request: str) -> str:
         """
         Request a response from the model
@@ -19,6 +74,48 @@ class Model:
         """
         raise NotImplementedError
 
+    async def _request_async(self, system_message: str, request: str) -> str:
+        """
+        Request a response from the model without blocking the event loop.
+        By default, runs the blocking request in the async context, models with a native async client should override it.
+
+        :param system_message: The system message
+        :param request: The user request
+        :return: The response from the model
+        """
+        return await run_blocking(self._request, system_message, request)
+
+    async def _request_stream_async(self, system_message: str, request: str) -> AsyncIterator[str]:
+        """
+        Request a response from the model, yielding the response text chunks as they arrive.
+        By default, yields the whole response at once, models that support streaming should override it.
+
+        :param system_message: The system message
+        :param request: The user request
+        :return: An async iterator over the response text chunks
+        """
+        yield await self._request_async(system_message, request)
+
+    def parse_json(self, response: str, call_type: str = None) -> dict:
+        """
+        Parse a response from the model as JSON, and check it against the call type's schema, if it has one.
+        Tries strict JSON first, then the tolerant parsing, and repairs the common defects the schema allows for.
+
+        :param response: The response from the model
+        :param call_type: The type of the call, selecting the schema of the response
+        :return: The parsed response
+        :raises SchemaError: If the response can't be parsed or repaired to fit the schema
+        """
+        self.parse_stats.count(call_type, "responses")
+        result, tolerant = ResponseSchemas.parse_json(response)
+        self.parse_stats.count(call_type, "tolerant" if tolerant else "strict")
+        if call_type in ResponseSchemas.RESPONSE_SCHEMAS:
+            result, repaired = ResponseSchemas.coerce(result, ResponseSchemas.RESPONSE_SCHEMAS[call_type])
+            if repaired:
+                logging.debug(f"Repaired {call_type} response: {response}")
+                self.parse_stats.count(call_type, "repaired")
+        return result
+
     @error_wrapper
     def generate(self, system: str, request: str) -> str:
         """
@@ -28,14 +125,7 @@ class Model:
         :param request: The user request
         :return: The response from the model
         """
-        retries = self.num_of_retries
-        while retries > 0:
-            try:
-                return self._request(request, system)
-            except Exception as exc:
-                retries -= 1
-                if retries == 0:
-                    raise exc
+        return self.retries.run(self.backend, None, lambda: self._governed_request(request, system))
 
     @error_wrapper
     def generate_json(self, system: str, request: str) -> dict:
@@ -48,13 +138,143 @@ class Model:
         """
         result = self.generate(request, system)
         if result["status"] == "success":
-            try:
-                response = result["result"]
-                if response.startswith("```"):
-                    response = response[response.find("\n"):]
-                    response = response[:response.rfind("\n")]
-                return ast.literal_eval(response)
-            except Exception as _:
-                raise Exception("Error parsing JSON.\n" + result["result"])
+            return self.parse_json(result["result"])
         else:
             raise Exception(result["reason"])
+
+    async def forget_response(self, system: str, request: str, call_type: str | None) -> None:
+        """
+        Remove a response from the response cache, so the next identical request is sent to the model.
+        Should be called when a response turns out to be invalid.
+
+        :param system: The system message
+        :param request: The user request
+        :param call_type: The type of the call
+        """
+        if self.response_cache.enabled(call_type):
+            await run_blocking(self.response_cache.discard, response_key(self.model_name, system, request))
+
+    async def _request_and_cache(self, key: str, system: str, request: str, call_type: str) -> str:
+        response = await run_blocking(self.response_cache.get_disk, key)
+        if response is None:
+            response = await self._request_with_retries(system, request, call_type)
+            await run_blocking(self.response_cache.put, key, response)
+        return response
+
+    def _governed_request(self, system_message: str, request: str) -> str:
+        prompt_tokens = count_tokens(system_message) + count_tokens(request)
+        with self.governor.lease(self.governor.estimate(prompt_tokens, self.max_tokens)) as lease:
+            response = self._request(system_message, request)
+            self.governor.record_response(lease, prompt_tokens, count_tokens(response))
+            return response
+
+    async def _governed_request_async(self, system: str, request: str) -> str:
+        # The timeout starts once the governor lets the request through, waiting for the quota isn't the model's delay
+        prompt_tokens = count_tokens(system) + count_tokens(request)
+        async with self.governor.lease_async(self.governor.estimate(prompt_tokens, self.max_tokens)) as lease:
+            if self.request_timeout is None:
+                response = await self._request_async(system, request)
+            else:
+                response = await asyncio.wait_for(self._request_async(system, request), self.request_timeout)
+            self.governor.record_response(lease, prompt_tokens, count_tokens(response))
+            return response
+
+    async def _governed_stream_async(self, system: str, request: str) -> AsyncIterator[str]:
+        prompt_tokens = count_tokens(system) + count_tokens(request)
+        async with self.governor.lease_async(self.governor.estimate(prompt_tokens, self.max_tokens)) as lease:
+            chunks = []
+            async for chunk in self._request_stream_async(system, request):
+                chunks.append(chunk)
+                yield chunk
+            self.governor.record_response(lease, prompt_tokens, count_tokens("".join(chunks)))
+
+    async def _request_with_retries(self, system: str, request: str, call_type: str = None) -> str:
+        return await self.retries.run_async(
+            self.backend, call_type,
+            lambda: self.hedging.run(call_type, lambda: self._governed_request_async(system, request)))
+
+    @error_wrapper
+    async def generate_async(self, system: str, request: str, call_type: str = None) -> str:
+        """
+        Generate a response from the model, awaitable variant of generate
+        If the call type's responses are cached, a cached response is returned without calling the model,
+        and concurrent identical requests share a single call.
+        If the call type's requests are hedged, a request slower than usual is raced by a duplicate.
+        A failed request is retried with backoff if its failure is transient, and fails fast while the model's
+        circuit breaker is open.
+
+        :param system: The system message
+        :param request: The user request
+        :param call_type: The type of the call (e.g. "action_result"), selecting whether its response is cached
+        :return: The response from the model
+        """
+        if not self.response_cache.enabled(call_type):
+            return await self._request_with_retries(system, request, call_type)
+
+        key = response_key(self.model_name, system, request)
+        response = self.response_cache.get_memory(key)
+        if response is not None:
+            return response
+        if self.response_requests.in_flight(key):
+            self.response_cache.coalesced()
+        return await self.response_requests.run(key, self._request_and_cache, key, system, request, call_type)
+
+    @error_wrapper
+    async def generate_json_async(self, system: str, request: str, call_type: str = None) -> dict:
+        """
+        Generate a response from the model and parse it as JSON, awaitable variant of generate_json
+        A response that doesn't fit the call type's schema, even after repair, is requested once more.
+
+        :param system: The system message
+        :param request: The user request
+        :param call_type: The type of the call, selecting whether its response is cached
+        :return: The response from the model as JSON
+        """
+        result = await self.generate_async(system, request, call_type)
+        if result["status"] == "error":
+            raise Exception(result["reason"])
+        try:
+            return self.parse_json(result["result"], call_type)
+        except ResponseSchemas.SchemaError as exc:
+            logging.warning(f"Invalid {call_type} response, requesting it again: {exc}")
+            await self.forget_response(system, request, call_type)
+
+        # Only a response which couldn't be repaired takes a second call
+        self.parse_stats.count(call_type, "retried")
+        result = await self.generate_async(system, request, call_type)
+        if result["status"] == "error":
+            raise Exception(result["reason"])
+        try:
+            return self.parse_json(result["result"], call_type)
+        except ResponseSchemas.SchemaError:
+            await self.forget_response(system, request, call_type)
+            self.parse_stats.count(call_type, "failed")
+            raise
+
+    async def generate_stream_async(self, system: str, request: str, call_type: str = None) -> AsyncIterator[str]:
+        """
+        Generate a response from the model, yielding the response text chunks as they arrive.
+        The request is retried only if it fails before the first chunk was yielded.
+        If the call type's responses are cached, a cached response is yielded at once, and a complete streamed
+        response is cached.
+
+        :param system: The system message
+        :param request: The user request
+        :param call_type: The type of the call, selecting whether its response is cached
+        :return: An async iterator over the response text chunks
+        """
+        key = None
+        if self.response_cache.enabled(call_type):
+            key = response_key(self.model_name, system, request)
+            response = self.response_cache.get_memory(key) or await run_blocking(self.response_cache.get_disk, key)
+            if response is not None:
+                yield response
+                return
+
+        chunks = []
+        async for chunk in self.retries.stream_async(self.backend, call_type,
+                                                     lambda: self._governed_stream_async(system, request)):
+            chunks.append(chunk)
+            yield chunk
+        if key is not None:
+            await run_blocking(self.response_cache.put, key, "".join(chunks))
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import AsyncIterator
+from backend.GenAI.LLM.Retries import is_retryable
+from backend.GenAI.LLM.Tokens import count_tokens
+from backend.GenAI.LLM.models.ModelClass import Model
+
+# The members of the model pool (LLM_BACKEND=pool), comma separated, each as <name>=<backend>[@<base url>].
+# A member's name is its provider, selecting its limits (PROVIDER_<NAME>_*) and its API key (<NAME>_API_KEY)
+MODEL_POOL_MEMBERS = os.getenv('MODEL_POOL_MEMBERS', 'openai=chatgpt')
+# The number of consecutive failed requests after which a member is ejected from the pool, and for how long, in seconds
+MODEL_POOL_EJECT_FAILURES = int(os.getenv('MODEL_POOL_EJECT_FAILURES', 3))
+MODEL_POOL_EJECT_TIME = float(os.getenv('MODEL_POOL_EJECT_TIME', 30))
+
+
+def pool_members(members: str = MODEL_POOL_MEMBERS) -> list[tuple[str, str, str | None]]:
+    """
+    Parses the members of the model pool.
+
+    :param members: the members, as configured in MODEL_POOL_MEMBERS
+    :return: the name, the backend and the base URL (or None) of each member
+    """
+    parsed = []
+    for member in members.split(","):
+        if not member.strip():
+            continue
+        name, _, backend = member.strip().partition("=")
+        backend, _, base_url = backend.partition("@")
+        if not name or not backend:
+            raise ValueError(f"Invalid model pool member: {member}")
+        parsed.append((name.strip(), backend.strip(), base_url.strip().rstrip("/") or None))
+    if not parsed:
+        raise ValueError("The model pool has no members.")
+    return parsed
+
+
+class PoolMember:
+    """
+    A model of the pool, with its latency and health.
+    """
+
+    def __init__(self, name: str, model: Model):
+        self.name = name
+        self.model = model
+        # The moving average of the member's latency, None until its first response
+        self.latency: float | None = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.times_ejected = 0
+        self.counts = {"requests": 0, "succeeded": 0, "failed": 0}
+
+    def ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def stats(self, now: float) -> dict:
+        return {"model": self.model.model_name, "latency": self.latency, "in_flight": self.in_flight,
+                "ejected": self.ejected(now), "ejected_for": round(max(0.0, self.ejected_until - now), 1),
+                "times_ejected": self.times_ejected, "consecutive_failures": self.consecutive_failures,
+                **self.counts}
+
+
+class ModelPool(Model):
+    """
+    A model served by a pool of models, e.g. the same model through several API keys or endpoints, so the game's
+    throughput isn't capped by a single key's quota.
+    Each request goes to the member with the lowest expected latency among those whose provider has quota for it now
+    (see ProviderGovernor.has_capacity), or among all the members if none has. The expected latency is the moving
+    average of the member's latency scaled by its requests in flight, so the load spreads before a member slows down.
+    A member failing several requests in a row is ejected from the pool for a while, and a retried request goes to
+    another member. The retries, hedging and response cache apply to the pool as a whole, and each member's requests go
+    through its own provider's governor and request timeout.
+    """
+    # The weight of the latest latency in a member's moving average
+    latency_weight = 0.3
+
+    def __init__(self, members: dict[str, Model], eject_failures: int = MODEL_POOL_EJECT_FAILURES,
+                 eject_time: float = MODEL_POOL_EJECT_TIME):
+        """
+        :param members: the models of the pool, by name
+        :param eject_failures: the number of consecutive failed requests which eject a member
+        :param eject_time: the time an ejected member is left out, in seconds
+        """
+        first = next(iter(members.values()))
+        super().__init__(first.model_name, first.max_tokens, first.temperature, first.request_timeout)
+        self.members = [PoolMember(name, model) for name, model in members.items()]
+        self.eject_failures = eject_failures
+        self.eject_time = eject_time
+        self._lock = threading.Lock()
+
+    def sys_footer(self) -> str:
+        return self.members[0].model.sys_footer()
+
+    def pick(self, system: str, request: str) -> PoolMember:
+        """
+        Picks the member to send a request to, and counts the request as in flight on it.
+
+        :param system: The system message
+        :param request: The user request
+        :return: The member
+        """
+        prompt_tokens = count_tokens(system) + count_tokens(request)
+        now = time.monotonic()
+        with self._lock:
+            members = [member for member in self.members if not member.ejected(now)]
+            if not members:
+                # With every member ejected, the one back soonest is the best bet
+                members = [min(self.members, key=lambda member: member.ejected_until)]
+            ready = [member for member in members if member.model.governor.has_capacity(
+                member.model.governor.estimate(prompt_tokens, member.model.max_tokens))]
+            member = min(ready or members, key=lambda member: (self._usual_latency(member) * (member.in_flight + 1),
+                                                               member.counts["requests"]))
+            member.in_flight += 1
+            member.counts["requests"] += 1
+            return member
+
+    def _usual_latency(self, member: PoolMember) -> float:
+        # A member without a latency yet is expected to be as fast as the fastest, so it gets tried
+        if member.latency is not None:
+            return member.latency
+        latencies = [other.latency for other in self.members if other.latency is not None]
+        return min(latencies) if latencies else 1.0
+
+    def _finish(self, member: PoolMember, start: float, exc: BaseException | None = None) -> None:
+        # Records the outcome of a request on its member; a cancelled request only leaves the member's in flight count
+        latency = time.monotonic() - start
+        with self._lock:
+            member.in_flight -= 1
+            if isinstance(exc, (asyncio.CancelledError, GeneratorExit)):
+                return
+            if exc is not None:
+                member.counts["failed"] += 1
+                # A rejected request says nothing about the member's health
+                if not is_retryable(exc):
+                    return
+                # A failure counts as at least twice the usual latency, so a member failing fast doesn't look fast
+                latency = max(latency, 2 * self._usual_latency(member))
+                if member.ejected(time.monotonic()):
+                    # A request sent before the ejection
+                    return
+                member.consecutive_failures += 1
+                if member.consecutive_failures >= self.eject_failures:
+                    member.ejected_until = time.monotonic() + self.eject_time
+                    member.times_ejected += 1
+                    logging.warning(f"Ejected {member.name} from the model pool for {self.eject_time}s after "
+                                    f"{member.consecutive_failures} consecutive failures.")
+                    # Back from ejection, it's tried like a new member, and a single failure ejects it again
+                    member.consecutive_failures = self.eject_failures - 1
+                    member.latency = None
+                    return
+            else:
+                member.counts["succeeded"] += 1
+                member.consecutive_failures = 0
+            member.latency = latency if member.latency is None else \
+                (1 - self.latency_weight) * member.latency + self.latency_weight * latency
+
+    def _governed_request(self, system_message: str, request: str) -> str:
+        member = self.pick(system_message, request)
+        start = time.monotonic()
+        try:
+            response = member.model._governed_request(system_message, request)
+        except BaseException as exc:
+            self._finish(member, start, exc)
+            raise
+        self._finish(member, start)
+        return response
+
+    async def _governed_request_async(self, system: str, request: str) -> str:
+        member = self.pick(system, request)
+        start = time.monotonic()
+        try:
+            response = await member.model._governed_request_async(system, request)
+        except BaseException as exc:
+            self._finish(member, start, exc)
+            raise
+        self._finish(member, start)
+        return response
+
+    async def _governed_stream_async(self, system: str, request: str) -> AsyncIterator[str]:
+        member = self.pick(system, request)
+        start = time.monotonic()
+        try:
+            async for chunk in member.model._governed_stream_async(system, request):
+                yield chunk
+        except BaseException as exc:
+            self._finish(member, start, exc)
+            raise
+        self._finish(member, start)
+
+    def stats(self) -> dict:
+        """
+        Returns the pool's configuration and each member's latency, load, health and request counters.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {"eject_failures": self.eject_failures, "eject_time": self.eject_time,
+                    "members": {member.name: member.stats(now) for member in self.members}}
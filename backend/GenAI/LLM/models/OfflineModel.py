@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+import re
+import time
+from typing import AsyncIterator
+from backend.GenAI.LLM.models.ModelClass import Model
+from backend.GenAI.Offline import FaultInjector, content_rng
+
+# The latency distribution of the offline model's responses (see backend/GenAI/Offline.py), and their error rate
+OFFLINE_LLM_LATENCY = os.getenv('OFFLINE_LLM_LATENCY', 'lognormal:1:0.5')
+OFFLINE_LLM_ERROR_RATE = float(os.getenv('OFFLINE_LLM_ERROR_RATE', 0))
+# The number of chunks a streamed response is split into
+OFFLINE_LLM_STREAM_CHUNKS = 10
+
+PLACES = ["the old mill", "a misty crossroads", "the ruined watchtower", "a crowded market", "the sunken library",
+          "a quiet riverbank", "the abandoned mine", "a smoky tavern", "the city gates", "a forgotten shrine"]
+CHARACTERS = ["a wary merchant", "an old hermit", "a hooded stranger", "a nervous guard", "a wandering bard",
+              "a scarred veteran", "a curious child", "a silent monk"]
+EVENTS = ["A cold wind carries distant voices.", "Footprints lead away into the dark.",
+          "Something glints in the dust at your feet.", "A bell rings three times somewhere far off.",
+          "The ground trembles for a moment, then falls still.", "A torn note is pinned to the wall.",
+          "You hear hurried steps behind you.", "The air smells of smoke and rain."]
+ACTIONS = ["Follow the footprints", "Talk to the stranger", "Search the area", "Hide and wait", "Head for the gates",
+           "Climb to a better view", "Examine the note", "Rest for a while", "Ask about the rumors", "Leave quietly"]
+ITEMS = ["rusty dagger", "leather cap", "wool cloak", "worn boots", "silver amulet", "copper ring", "rope coil",
+         "iron sword", "healing herbs", "lantern"]
+
+
+def _between(text: str, start: str, end: str) -> str:
+    match = re.search(re.escape(start) + r"(.*?)" + re.escape(end), text)
+    return match.group(1) if match else ""
+
+
+def _listed(text: str, prefix: str) -> list[str]:
+    """
+    Returns the names listed in a prompt after the prefix, as a python list, e.g. "possible skills: ['STR', 'INT']".
+    """
+    return re.findall(r"'([^']*)'", _between(text, prefix + " [", "]"))
+
+
+class OfflineModel(Model):
+    """
+    A deterministic stand-in for the LLM, for running and load testing the game without network access.
+    Recognizes the game's prompts, and replies with responses that fit their schemas, made up from the request.
+    The same request always gets the same response, while the latency and the failures are drawn from
+    the configured distribution and error rate.
+    """
+    model_name = "offline"
+    provider = "offline_llm"
+    faults = FaultInjector("llm", OFFLINE_LLM_LATENCY, OFFLINE_LLM_ERROR_RATE)
+
+    def sys_footer(self) -> str:
+        return "Do not write explanations."
+
+    def respond(self, system_message: str, request: str) -> str:
+        """
+        Generate the response to a request.
+
+        :param system_message: The system message
+        :param request: The user request
+        :return: The response
+        """
+        rng = content_rng(system_message, request)
+        try:
+            data = json.loads(request)
+        except ValueError:
+            data = {}
+
+        if "generate the player's backstory" in system_message:
+            result = self.backstory(system_message, data, rng)
+        elif "check weather the player's desired action is valid" in system_message:
+            result = self.custom_action(system_message, rng)
+        elif "generate a main quest" in system_message:
+            result = self.quest(rng)
+        elif "check weather the player's quest or goals are achieved" in system_message:
+            result = self.quest_update(data.get("quest", {}), rng)
+        elif "run a shop" in system_message:
+            result = self.shop(system_message, data, rng)
+        elif "keep a running summary" in system_message:
+            result = {"summary": (data.get("summary", "") + " " + data.get("new_events", ""))[-600:].strip()}
+        elif "narrating a text-based" in system_message:
+            result = self.action_result(system_message, data, rng)
+        else:
+            return "ok"
+        return json.dumps(result)
+
+    @staticmethod
+    def scene(rng) -> str:
+        return f"You reach {rng.choice(PLACES)}, where {rng.choice(CHARACTERS)} watches you closely. " + \
+            " ".join(rng.sample(EVENTS, 3))
+
+    def backstory(self, system_message: str, data: dict, rng) -> dict:
+        inventory = data.get("inventory") or {"weapon": []}
+        inventory[next(iter(inventory))] = [rng.choice(ITEMS)]
+        extra_fields = _between(system_message, "name: the player's character name.", "backstory:")
+        result = {field.split(":")[0].strip(): f"The {rng.choice(['Crimson', 'Silent', 'Golden'])} Order"
+                  for field in extra_fields.split(", ") if ":" in field}
+        result.update({
+            "name": rng.choice(["Ayla", "Doran", "Mira", "Tobin", "Kessa", "Rune"]),
+            "backstory": f"Raised near {rng.choice(PLACES)}, looking for a way to settle an old debt.",
+            "traits": rng.sample(["Smart", "Sarcastic", "Honest", "Kind", "Arrogant", "Brave"], 3),
+            "starting_location": rng.choice(PLACES).capitalize(),
+            "inventory": inventory,
+            "character_prompt": "A pencil sketch of a determined traveler, detailed, realistic",
+            "scene_prompt": "A pencil sketch of a quiet village at dawn, detailed, realistic",
+        })
+        return result
+
+    def action_result(self, system_message: str, data: dict, rng) -> dict:
+        skills = _listed(system_message, "possible skills:") or ["STR"]
+        health = data.get("health", 5)
+        if data.get("result") == "Failure" and rng.random() < 0.5:
+            health -= 1
+        result = {
+            "scene": self.scene(rng),
+            "health": health,
+            "inventory": data.get("inventory", {}),
+            "coins": data.get("coins", 0),
+            "prompt": "A pencil sketch of " + rng.choice(PLACES) + ", detailed, realistic",
+        }
+        if health > 0:
+            result.update({
+                "options": rng.sample(ACTIONS, 3),
+                "rates": [round(rng.uniform(0.2, 0.9), 2) for _ in range(3)],
+                "advantages": [rng.choice(skills) for _ in range(3)],
+                "level": [rng.randint(2, 30) for _ in range(3)],
+                "experience": [rng.randint(0, 15) for _ in range(3)],
+            })
+        if rng.random() < 0.2:
+            result["new_location"] = rng.choice(PLACES).capitalize()
+        if "quest: the update of the player's quest" in system_message:
+            result["quest"] = self.quest_update(data.get("current_quest", {}), rng)
+        return result
+
+    def custom_action(self, system_message: str, rng) -> dict:
+        if rng.random() < 0.15:
+            return {"valid": "no"}
+        skills = _listed(system_message, "possible skills:") or ["STR"]
+        return {"valid": "yes", "rate": round(rng.uniform(0.2, 0.9), 2), "advantage": rng.choice(skills),
+                "level": rng.randint(2, 30), "experience": rng.randint(0, 15)}
+
+    @staticmethod
+    def quest(rng) -> dict:
+        place = rng.choice(PLACES)
+        return {
+            "quest_title": f"The Secret of {place.title()}",
+            "quest_description": f"Find out what is hidden in {place}.",
+            "quest_xp_reward": rng.randint(50, 200),
+            "quest_gold_reward": rng.randint(0, 500),
+            "goals": [{"title": title, "goal": f"{title} near {place}.", "xp_reward": rng.randint(10, 60)}
+                      for title in rng.sample(["Find a guide", "Gather supplies", "Learn the legend",
+                                               "Open the way", "Face the guardian"], 3)]
+        }
+
+    @staticmethod
+    def quest_update(quest: dict, rng) -> dict:
+        goals = [goal["title"] for goal in quest.get("goals", []) if "title" in goal]
+        if not goals and quest:
+            return {"quest_completed": "completed", "new_backstory": "A hero of " + rng.choice(PLACES) + "."}
+        update = {"completed": [], "failed": [], "new": []}
+        if goals and rng.random() < 0.1:
+            update["completed"].append(rng.choice(goals))
+        if rng.random() < 0.05:
+            title = "Help " + rng.choice(CHARACTERS)
+            update["new"].append({"title": title, "goal": f"{title} at {rng.choice(PLACES)}.",
+                                  "xp_reward": rng.randint(10, 60)})
+        return update
+
+    def shop(self, system_message: str, data: dict, rng) -> dict:
+        if rng.random() < 0.1:
+            return {"problem": "No Shop"}
+        categories = _listed(system_message, "Item categories must be from:") or ["weapon"]
+        inventory = data.get("inventory", {})
+        owned = [(item, category) for category, items in inventory.items() for item in items]
+        return {
+            "sold_items": {item: [rng.choice(categories), rng.randint(1, 500)] for item in rng.sample(ITEMS, 3)},
+            "buy_items": {item: [category, rng.randint(1, 300)] for item, category in owned[:2]},
+            "shopkeeper_description": rng.choice(CHARACTERS),
+            "shopkeeper_recommendation": "You look like you could use a better " + rng.choice(ITEMS) + ".",
+            "prompt": "A pencil sketch of a cluttered shop counter, detailed, realistic",
+        }
+
+    def _request(self, system_message: str, request: str) -> str:
+        latency, failed = self.faults.draw()
+        time.sleep(latency)
+        if failed:
+            raise self.faults.error()
+        return self.respond(system_message, request)
+
+    async def _request_async(self, system_message: str, request: str) -> str:
+        latency, failed = self.faults.draw()
+        await asyncio.sleep(latency)
+        if failed:
+            raise self.faults.error()
+        return self.respond(system_message, request)
+
+    async def _request_stream_async(self, system_message: str, request: str) -> AsyncIterator[str]:
+        # The first chunk takes a fifth of the latency, and the rest arrive evenly over the remaining time
+        latency, failed = self.faults.draw()
+        await asyncio.sleep(latency / 5)
+        if failed:
+            raise self.faults.error()
+        response = self.respond(system_message, request)
+        size = len(response) // OFFLINE_LLM_STREAM_CHUNKS + 1
+        for start in range(0, len(response), size):
+            if start:
+                await asyncio.sleep(latency * 4 / 5 / OFFLINE_LLM_STREAM_CHUNKS)
+            yield response[start:start + size]
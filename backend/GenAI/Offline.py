@@ -0,0 +1,90 @@
+import hashlib
+import os
+import random
+import threading
+
+# The seed of the offline backends' latencies and errors, so a load test can be repeated exactly
+OFFLINE_SEED = int(os.getenv('OFFLINE_SEED', 0))
+
+
+class OfflineError(Exception):
+    """
+    A simulated failure of an offline backend.
+    """
+
+
+class Latency:
+    """
+    A latency distribution, given as "<kind>:<parameters>" in seconds:
+    "fixed:<latency>", "uniform:<min>:<max>", "exponential:<mean>" or "lognormal:<median>:<sigma>".
+    """
+
+    def __init__(self, spec: str):
+        """
+        :param spec: the distribution, e.g. "lognormal:2:0.5"
+        """
+        kind, *params = spec.split(":")
+        self.spec = spec
+        self.kind = kind.strip().lower()
+        self.params = [float(param) for param in params]
+        expected = {"fixed": 1, "uniform": 2, "exponential": 1, "lognormal": 2}
+        if self.kind not in expected:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        if len(self.params) != expected[self.kind]:
+            raise ValueError(f"The {self.kind} latency distribution takes {expected[self.kind]} parameters: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        """
+        Draws a latency from the distribution.
+
+        :param rng: the random generator to draw with
+        :return: the latency, in seconds
+        """
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == "exponential":
+            return rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        return self.params[0] * rng.lognormvariate(0, self.params[1])
+
+    def __str__(self):
+        return self.spec
+
+
+class FaultInjector:
+    """
+    Draws the latency and the failure of each call to an offline backend, from a generator seeded by the backend's name,
+    so the same sequence of calls gets the same latencies and failures on every run.
+    """
+
+    def __init__(self, name: str, latency: str, error_rate: float):
+        """
+        :param name: the name of the backend
+        :param latency: the latency distribution of a call, see Latency
+        :param error_rate: the probability of a call to fail, from 0 to 1
+        """
+        self.name = name
+        self.latency = Latency(latency)
+        self.error_rate = error_rate
+        self._rng = random.Random(f"{OFFLINE_SEED}:{name}")
+        self._lock = threading.Lock()
+
+    def draw(self) -> tuple[float, bool]:
+        """
+        Draws the next call's latency, and whether it fails.
+
+        :return: the latency in seconds, and whether the call fails
+        """
+        with self._lock:
+            return self.latency.sample(self._rng), self._rng.random() < self.error_rate
+
+    def error(self) -> OfflineError:
+        return OfflineError(f"Simulated {self.name} failure.")
+
+
+def content_rng(*parts: str) -> random.Random:
+    """
+    Returns a random generator seeded by the content of a request, so the same request always gets the same response.
+    """
+    return random.Random(hashlib.sha256("\0".join(parts).encode()).hexdigest())
@@ -1,12 +1,24 @@
 import io
 import json
 import os
-from PIL import Image
+import time
+from PIL import Image, ImageDraw
 import requests
 from backend.Utility import *
+from backend.GenAI.Governor import get_governor
+from backend.GenAI.Offline import FaultInjector, content_rng
 
 # The URL for the image API
 IMAGE_API_URL = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"
+# The image generation backend: "huggingface", or "offline" for generated stand-in images without network access
+T2I_BACKEND = os.getenv('T2I_BACKEND', 'huggingface')
+# The latency distribution of the offline images (see backend/GenAI/Offline.py), their error rate and their size
+OFFLINE_T2I_LATENCY = os.getenv('OFFLINE_T2I_LATENCY', 'uniform:2:4')
+OFFLINE_T2I_ERROR_RATE = float(os.getenv('OFFLINE_T2I_ERROR_RATE', 0))
+OFFLINE_IMAGE_SIZE = int(os.getenv('OFFLINE_IMAGE_SIZE', 512))
+offline_faults = FaultInjector("t2i", OFFLINE_T2I_LATENCY, OFFLINE_T2I_ERROR_RATE)
+# The provider of the images, whose limits the image requests share (see backend/GenAI/Governor.py)
+T2I_PROVIDER = "offline_t2i" if T2I_BACKEND == "offline" else "huggingface"
 
 
 # ---------------- Utilities ---------------- #
@@ -26,6 +38,33 @@ def is_valid_image(image_bytes):
         return False
     
     
+def generate_offline(prompt) -> bytes:
+    """
+    Generate a stand-in image for the prompt, a deterministic sketch of shapes, with the offline latency and errors
+
+    :param prompt: The prompt to generate the image from
+    :return: The generated JPEG image bytes
+    """
+    latency, failed = offline_faults.draw()
+    time.sleep(latency)
+    if failed:
+        raise offline_faults.error()
+
+    rng = content_rng(prompt)
+    size = OFFLINE_IMAGE_SIZE
+    image = Image.new("RGB", (size, size), tuple(rng.randint(200, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randint(0, size), rng.randint(0, size)
+        radius = rng.randint(size // 20, size // 4)
+        shade = rng.randint(40, 160)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), outline=(shade, shade, shade),
+                     width=rng.randint(1, 4))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
 # ---------------- API ---------------- #
 
 
@@ -38,6 +77,8 @@ def generate(prompt) -> bytes:
     :return: The generated image bytes
     """
     logging.info(f"Generating image for prompt: {prompt}")
+    if T2I_BACKEND == "offline":
+        return generate_offline(prompt)
     id = os.getenv('HUGGINGFACE_BEARER')
     headers = {"Authorization": id}
     if id is None:
@@ -55,3 +96,20 @@ def generate(prompt) -> bytes:
             logging.error(image_bytes['error'])
             raise Exception(image_bytes['error'])
         raise Exception("Invalid image: " + str(image_bytes))
+
+
+@error_wrapper
+async def generate_async(prompt) -> bytes:
+    """
+    Generate an image from the prompt, without blocking the event loop
+    The request waits for the image provider's governor first, by the priority of the current work context,
+    so it doesn't hold an image worker while it waits.
+
+    :param prompt: The prompt to generate the image from
+    :return: The generated image bytes
+    """
+    async with get_governor(T2I_PROVIDER).lease_async():
+        result = await run_blocking(generate, prompt, pool="image")
+    if result["status"] == "error":
+        raise CustomException(result["reason"])
+    return result["result"]
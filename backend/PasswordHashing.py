@@ -0,0 +1,104 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import bcrypt
+
+# The bcrypt work factor for new password hashes (existing hashes keep the factor they were created with)
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+# The number of processes hashing passwords, and the number of requests allowed to wait for them
+PASSWORD_HASHING_WORKERS = int(os.getenv('PASSWORD_HASHING_WORKERS', min(4, os.cpu_count() or 1)))
+PASSWORD_HASHING_QUEUE_SIZE = int(os.getenv('PASSWORD_HASHING_QUEUE_SIZE', 64))
+
+
+class HashingQueueFull(Exception):
+    """
+    Raised when the password hashing queue is full, and the request should be retried later.
+    """
+
+
+def hash_password(password: str, rounds: int) -> str:
+    """
+    Hash a password with bcrypt.
+
+    :param password: The password to be hashed.
+    :param rounds: The bcrypt work factor.
+    :return: The password hash.
+    """
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def check_password(password: str, password_hash: str) -> bool:
+    """
+    Check a password against its bcrypt hash.
+
+    :param password: The password to be checked.
+    :param password_hash: The password hash.
+    :return: Whether the password matches the hash.
+    """
+    return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+
+
+class PasswordHasher:
+    """
+    Runs the bcrypt hashing in a dedicated process pool, so it never blocks the event loop or holds the GIL.
+    The number of requests in the pool (running or waiting) is bounded, and requests over the bound are rejected.
+    This module is kept free of the app's imports, since every worker process imports it.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASHING_WORKERS, queue_size: int = PASSWORD_HASHING_QUEUE_SIZE,
+                 rounds: int = BCRYPT_ROUNDS):
+        """
+        :param workers: The number of hashing processes.
+        :param queue_size: The number of requests allowed to wait for a free process.
+        :param rounds: The bcrypt work factor for new hashes.
+        """
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.rounds = rounds
+        self.in_flight = 0
+        self._pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+    @property
+    def pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Created on first use, with "spawn" so the workers don't inherit the server's threads and locks
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                                mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def _submit(self, function: callable, *args):
+        if self.in_flight >= self.capacity:
+            raise HashingQueueFull("Too many password requests, try again later.")
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, function, *args)
+        finally:
+            self.in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        """
+        Hash a password with the configured work factor.
+
+        :param password: The password to be hashed.
+        :return: The password hash.
+        """
+        return await self._submit(hash_password, password, self.rounds)
+
+    async def check(self, password: str, password_hash: str) -> bool:
+        """
+        Check a password against its hash.
+
+        :param password: The password to be checked.
+        :param password_hash: The password hash.
+        :return: Whether the password matches the hash.
+        """
+        return await self._submit(check_password, password, password_hash)
+
+    def shutdown(self) -> None:
+        """
+        Shut the hashing processes down.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
@@ -392,6 +392,40 @@ class SaveData:
         self.shop.close()
         self.update_quest(result["quest"])
 
+    def get_summary(self) -> dict:
+        """
+        Returns the rolling summary of the story's history.
+        The summary is in the following format:
+        {
+            "text": "The summary of the history's first entries",
+            "upto": 10  # the number of history entries the summary covers
+        }
+
+        :return: the summary of the history
+        """
+        return self.story.get("summary") or {"text": "", "upto": 0}
+
+    def set_summary(self, text: str, upto: int):
+        """
+        Sets the rolling summary of the story's history.
+
+        :param text: the summary of the history's first entries
+        :param upto: the number of history entries the summary covers
+        """
+        self.story["summary"] = {"text": text, "upto": upto}
+
+    def merge_summary(self, other: 'SaveData'):
+        """
+        Takes the other save data's history summary if it covers more of the same story.
+        Used when committing save data loaded before the summary was updated in the background.
+
+        :param other: the save data to take the summary from
+        """
+        summary = other.get_summary()
+        if summary["upto"] > self.get_summary()["upto"] and \
+                self.story.get("history", [])[:summary["upto"]] == other.story["history"][:summary["upto"]]:
+            self.set_summary(summary["text"], summary["upto"])
+
     def add_xp(self, xp: int):
         """
         Updates the experience points of the player based on the added experience points.
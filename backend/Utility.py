@@ -1,5 +1,12 @@
+import asyncio
 import concurrent.futures
+import contextvars
+import inspect
+import threading
+import time
+from collections import OrderedDict
 from backend import DEBUG
+from backend.Executors import PRIORITIES, get_executor
 import logging
 import logging.config
 
@@ -38,7 +45,9 @@ LOGGING_CONFIG = {
     },
 }
 
-async_context = concurrent.futures.ThreadPoolExecutor()
+background_tasks: set[asyncio.Task] = set()
+# The kind of work the current task does, selecting the executor and priority of its blocking calls
+work_context: contextvars.ContextVar[str] = contextvars.ContextVar("work_context", default="foreground")
 logging.config.dictConfig(LOGGING_CONFIG)
 
 
@@ -60,6 +69,18 @@ def error_wrapper(func: callable) -> callable:
     :param func: the function to be wrapped
     :return: the wrapped function
     """
+    if inspect.iscoroutinefunction(func):
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return {"status": "success", "result": await func(*args, **kwargs)}
+            except CustomException as exc:
+                logging.warning(f"Custom exception found in: {func.__name__}: {str(exc)}")
+                return {"status": "error", "reason": str(exc)}
+            except Exception as exc:
+                logging.exception(f"exception found in: {func.__name__}:")
+                return {"status": "error", "reason": "The server encountered an error while processing the request."}
+        return async_wrapper
+
     def wrapper(*args, **kwargs):
         try:
             return {"status": "success", "result": func(*args, **kwargs)}
@@ -80,24 +101,36 @@ def APIEndpoint(func: callable) -> callable:
     :param func: the function to be wrapped
     :return: the wrapped function
     """
+    if inspect.iscoroutinefunction(func):
+        async def async_wrapper(*args, **kwargs):
+            logging.info(f"--------- API call: {func.__name__} started!")
+            logging.debug(f"Arguments: {args}, {kwargs}")
+            result = await func(*args, **kwargs)
+            logging.info(f"--------- API call: {func.__name__} finished!")
+            if func.__name__ not in ["get_image", "get_image_file", "get_saves_list"]:
+                logging.debug(f"--------- {func.__name__} result: {result}")
+            return result
+        return async_wrapper
+
     def wrapper(*args, **kwargs):
         logging.info(f"--------- API call: {func.__name__} started!")
         logging.debug(f"Arguments: {args}, {kwargs}")
         result = func(*args, **kwargs)
         logging.info(f"--------- API call: {func.__name__} finished!")
-        if func.__name__ not in ["get_image", "get_saves_list"]:
+        if func.__name__ not in ["get_image", "get_image_file", "get_saves_list"]:
             logging.debug(f"--------- {func.__name__} result: {result}")
         return result
     return wrapper
 
 
-def start_promise(function: callable, *args, **kwargs) -> concurrent.futures.Future:
+def start_promise(function: callable, *args, pool: str = None, **kwargs) -> concurrent.futures.Future:
     """
     Starts a promise with the given function and arguments.
-    The promise is submitted to the async context.
+    The promise is submitted to the given executor, or to the executor of the current work context.
 
     :param function: the function to be executed
     :param args: the arguments to be passed to the function
+    :param pool: the name of the executor
     :param kwargs: the keyword arguments to be passed to the function
     """
     def handle_exception(promise_obj):
@@ -107,7 +140,8 @@ def start_promise(function: callable, *args, **kwargs) -> concurrent.futures.Fut
             logging.warning(f"An error occurred while executing the promise: {function.__name__}, {str(e)}")
             pass
 
-    promise = async_context.submit(function, *args, **kwargs)
+    context = work_context.get()
+    promise = get_executor(pool or context).submit(function, *args, priority=PRIORITIES[context], **kwargs)
     promise.add_done_callback(handle_exception)
     logging.debug(f"Promise started: {str(function.__name__)}")
     return promise
@@ -130,3 +164,180 @@ def await_promise(promise: concurrent.futures.Future) -> dict:
     except Exception as e:
         logging.warning(f"An error occurred while awaiting a promise: {str(e)}")
         return {"status": "error", "reason": str(e)}
+
+
+async def run_blocking(function: callable, *args, pool: str = None, **kwargs):
+    """
+    Runs a blocking function in an executor without blocking the event loop.
+    The function runs in the given executor, or in the executor of the current work context,
+    with the priority of the current work context.
+
+    :param function: the blocking function to be executed
+    :param args: the arguments to be passed to the function
+    :param pool: the name of the executor
+    :param kwargs: the keyword arguments to be passed to the function
+    :return: the result of the function
+    :raises ExecutorRejected: if the executor is full
+    """
+    context = work_context.get()
+    promise = get_executor(pool or context).submit(function, *args, priority=PRIORITIES[context], **kwargs)
+    return await asyncio.wrap_future(promise)
+
+
+def start_task(coroutine, context: str = None) -> asyncio.Task:
+    """
+    Starts a background task on the running event loop, the async equivalent of start_promise.
+    A reference to the task is kept until it is done, so it won't be garbage collected mid-run.
+
+    :param coroutine: the coroutine to be executed
+    :param context: the kind of work the task does (e.g. "speculative"), defaults to the current work context
+    :return: the started task
+    """
+    def handle_exception(task_obj: asyncio.Task):
+        background_tasks.discard(task_obj)
+        if task_obj.cancelled():
+            coroutine.close()  # In case it was cancelled before it started
+            return
+        if task_obj.exception() is not None:
+            logging.warning(f"An error occurred while executing the task: {coroutine.__name__}, {str(task_obj.exception())}")
+
+    async def run_in_context():
+        # Each task runs in a copy of the current context, so this doesn't leak to the caller
+        if context is not None:
+            work_context.set(context)
+        return await coroutine
+
+    task = asyncio.get_running_loop().create_task(run_in_context())
+    background_tasks.add(task)
+    task.add_done_callback(handle_exception)
+    logging.debug(f"Task started: {str(coroutine.__name__)}")
+    return task
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single in-flight task.
+    The first caller for a key starts the task, and every caller until it is done awaits the same result.
+    The task runs in the work context of the caller that started it, so a caller of a higher priority (e.g. a player
+    joining a speculative prefetch) runs the call again in its own context if the task fails, e.g. dropped from its
+    executor, rather than failing for work it didn't choose to deprioritize.
+    """
+
+    def __init__(self):
+        self._in_flight: dict[any, tuple[asyncio.Task, str]] = {}
+
+    def in_flight(self, key) -> bool:
+        """
+        Checks whether a task is currently in flight for the given key.
+
+        :param key: the key of the task
+        :return: True if a task is in flight, False otherwise
+        """
+        return key in self._in_flight
+
+    async def run(self, key, function: callable, *args, **kwargs):
+        """
+        Runs the coroutine function for the given key, or joins the task already in flight for it.
+        Waiters are shielded, so a cancelled caller does not cancel the task for the others.
+
+        :param key: the key of the task
+        :param function: the coroutine function to be executed
+        :param args: the arguments to be passed to the function
+        :param kwargs: the keyword arguments to be passed to the function
+        :return: the result of the task
+        """
+        flight = self._in_flight.get(key)
+        if flight is None:
+            context = work_context.get()
+            task = start_task(function(*args, **kwargs))
+            self._in_flight[key] = (task, context)
+
+            def forget(done_task: asyncio.Task):
+                if self._in_flight.get(key, (None,))[0] is done_task:
+                    del self._in_flight[key]
+            task.add_done_callback(forget)
+            return await asyncio.shield(task)
+
+        task, context = flight
+        logging.debug(f"Joined in-flight task: {function.__name__}")
+        if PRIORITIES[work_context.get()] >= PRIORITIES[context]:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+        except Exception as exc:
+            logging.info(f"Running {function.__name__} again after its lower priority task failed: {exc!r}")
+        return await self.run(key, function, *args, **kwargs)
+
+
+class TTLCache:
+    """
+    A thread-safe, bounded, in-memory cache with least-recently-used eviction and per-entry expiration.
+    Keeps hit and miss counters for monitoring.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        :param max_size: the maximum number of entries kept in the cache
+        :param ttl: the default time to live of an entry, in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[any, tuple[any, float]] = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for the key, or the default if it's missing or expired.
+
+        :param key: the key of the entry
+        :param default: the value to return on a miss
+        :return: the cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl: float = None) -> None:
+        """
+        Caches the value for the key, evicting the least recently used entry if the cache is full.
+
+        :param key: the key of the entry
+        :param value: the value to be cached
+        :param ttl: the time to live of the entry in seconds, defaults to the cache's ttl
+        """
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key) -> None:
+        """
+        Removes the entry of the key from the cache, if it exists.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> dict:
+        """
+        Returns the cache's size and hit/miss counters.
+        """
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,125 @@
+"""
+Fused quest update benchmark.
+
+Generates the results of a turn's options the way the story cache does, all at once, and compares the two-call path
+(the storyteller, then the quest updater) with the fused path (the storyteller updating the quest in the same response).
+Reports the latency of a complete option result, the number of LLM calls and the estimated tokens sent and received.
+Runs against the configured LLM model, with the response cache disabled, so it needs the model's API key.
+
+Run from the repository root:
+    python -m benchmarks.fused_quest_benchmark --turns 3 --options 3
+"""
+import argparse
+import asyncio
+import copy
+import statistics
+import time
+from backend.GenAI.LLM.LLM import LLM, count_tokens
+from backend.Types.SaveData import SaveData
+from backend.Types.Themes import Available_Themes
+
+QUEST = {
+    "quest_title": "The Lost Crown",
+    "quest_description": "Recover the crown stolen from the old king's tomb before the new moon.",
+    "quest_xp_reward": 100,
+    "quest_gold_reward": 200,
+    "goals": [
+        {"title": "Find the thieves", "goal": "Learn who robbed the tomb.", "xp_reward": 30},
+        {"title": "Reach the hideout", "goal": "Find the thieves' hideout in the marshes.", "xp_reward": 40},
+    ]
+}
+
+
+class CallRecorder:
+    """
+    Wraps a model's requests, recording the number of calls and their estimated input and output tokens.
+    """
+
+    def __init__(self, llm: LLM):
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        for model in {id(model): model for model in [llm.model, *llm.models.values()]}.values():
+            model._request_async = self.recorded(model._request_async)
+
+    def recorded(self, request: callable) -> callable:
+        async def recorded_request(system_message: str, user_request: str) -> str:
+            response = await request(system_message, user_request)
+            self.calls += 1
+            self.input_tokens += count_tokens(system_message) + count_tokens(user_request)
+            self.output_tokens += count_tokens(response)
+            return response
+
+        return recorded_request
+
+
+def make_save() -> SaveData:
+    """
+    Creates a save in the middle of a story, with an active quest.
+    """
+    theme = Available_Themes[0]
+    background = {field: options[0] if isinstance(options, list) else "" for field, options in theme.fields.items()}
+    background.pop("details", None)
+    background.update({"name": "Ayla", "backstory": "A disgraced royal guard, looking to clear her name.",
+                       "traits": ["Brave", "Stubborn", "Honest"], "location": "The marsh road"})
+    data = SaveData(theme=theme.name, background=background)
+    data.init_story()
+    data.story["history"] = ["Wake up.", "You wake up by a dying campfire on the marsh road, a torn map in your hand.",
+                             "Look at the map.", "The map marks a hut deep in the marshes, circled in fresh ink."]
+    data.story["scene"] = data.story["history"][-1]
+    data.story["options"] = ["Follow the map into the marshes", "Ask the ferryman about the hut", "Burn the map"]
+    data.set_quest(QUEST)
+    return data
+
+
+async def run_mode(name: str, fused: bool, turns: int, options: int) -> None:
+    llm = LLM()
+    llm.model = copy.copy(LLM.model)
+    llm.models = {call_type: copy.copy(model) for call_type, model in LLM.models.items()}
+    llm.model.response_cache.call_types = set()
+    llm.fused_quest_update = fused
+    recorder = CallRecorder(llm)
+    data = make_save()
+
+    async def option_result(action: str) -> float:
+        start = time.perf_counter()
+        result = await llm.generate_action_result(data, action, "Success")
+        if result["status"] == "error":
+            raise Exception(result["reason"])
+        # The quest updater is called like Game.add_quest_update does, only if the fused update is missing
+        if not (fused and llm.has_valid_quest_update(result["result"])):
+            quest_result = await llm.update_quest(data, action, result["result"]["scene"], result["result"]["inventory"])
+            if quest_result["status"] == "error":
+                raise Exception(quest_result["reason"])
+        return time.perf_counter() - start
+
+    latencies = []
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(turns):
+        results = await asyncio.gather(*[option_result(action) for action in data.story["options"][:options]],
+                                       return_exceptions=True)
+        latencies += [result for result in results if isinstance(result, float)]
+        failures += sum(1 for result in results if not isinstance(result, float))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latencies) or [0]
+    results_count = max(turns * options - failures, 1)
+    print(f"{name:>8}: {turns} turns in {elapsed:.1f}s, failures: {failures}, "
+          f"option latency p50: {statistics.median(latencies):.2f}s, max: {latencies[-1]:.2f}s, "
+          f"calls: {recorder.calls} ({recorder.calls / results_count:.1f}/option), "
+          f"tokens in: {recorder.input_tokens / results_count:.0f}/option, "
+          f"out: {recorder.output_tokens / results_count:.0f}/option")
+
+
+async def main(turns: int, options: int) -> None:
+    await run_mode("two-call", False, turns, options)
+    await run_mode("fused", True, turns, options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fused quest update with the separate quest updater.")
+    parser.add_argument("--turns", type=int, default=3, help="number of turns to generate")
+    parser.add_argument("--options", type=int, default=3, help="number of options generated at once per turn")
+    args = parser.parse_args()
+    asyncio.run(main(args.turns, args.options))
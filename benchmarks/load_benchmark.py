@@ -0,0 +1,120 @@
+"""
+Game load benchmark.
+
+Plays many concurrent games through the whole Game pipeline (save creation, story cache speculation, story advances,
+shops, history summaries and images) against the offline LLM and image backends and the local database,
+so it runs on any machine, without network access or credentials.
+Reports the latency of the story advances and save creations, the throughput, the errors, and the executors'
+and the model's statistics.
+The offline backends' latencies and error rates are set by their environment variables (see the README).
+
+Run from the repository root:
+    python -m benchmarks.load_benchmark --users 50 --turns 5 --think 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+# The backends are selected when the game is imported, so they are set up first
+os.environ.setdefault("LLM_BACKEND", "offline")
+os.environ.setdefault("T2I_BACKEND", "offline")
+os.environ.setdefault("DATABASE_BACKEND", "local")
+os.environ.setdefault("LOCAL_DB_PATH", tempfile.mkdtemp(prefix="load_benchmark_"))
+
+from backend.Executors import executors_stats
+from backend.Game.Game import Game
+from backend.GenAI.Governor import governors_stats
+from backend.Types.Themes import Available_Themes
+
+
+def percentiles(latencies: list[float]) -> str:
+    if not latencies:
+        return "no samples"
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return f"p50: {statistics.median(latencies):.2f}s, p95: {p95:.2f}s, p99: {p99:.2f}s, max: {latencies[-1]:.2f}s"
+
+
+async def play(game: Game, user: int, turns: int, think: float, images: bool, shop_every: int,
+               results: dict[str, list]) -> None:
+    """
+    Plays a game like a client would: creates a save, loads it, then advances the story after thinking on each scene.
+    """
+    username = f"load_user_{user}"
+    theme = Available_Themes[user % len(Available_Themes)]
+    background = {field: options[user % len(options)] if isinstance(options, list) else "A curious traveler."
+                  for field, options in theme.fields.items()}
+    try:
+        start = time.perf_counter()
+        save_name = await game.new_save(username, theme.name, background, images)
+        results["new_save"].append(time.perf_counter() - start)
+        await game.load_save(username, save_name, images)
+    except Exception as e:
+        results["errors"].append(f"new_save: {e}")
+        return
+
+    for turn in range(turns):
+        await asyncio.sleep(think)
+        data = await game.DB.get_save_data_async(username, save_name)
+        if not data.story["options"]:
+            break
+        start = time.perf_counter()
+        status = await game.advance_story(username, save_name, data.story["options"][turn % len(data.story["options"])],
+                                          images)
+        results["advance"].append(time.perf_counter() - start)
+        if status is None:
+            data = await game.DB.get_save_data_async(username, save_name)
+            results["errors"].append(f"advance: {data.story['status']}")
+        if shop_every and (turn + 1) % shop_every == 0:
+            start = time.perf_counter()
+            await game.get_shop(username, save_name, images)
+            results["shop"].append(time.perf_counter() - start)
+
+
+async def main(users: int, turns: int, think: float, images: bool, shop_every: int, ramp: float) -> None:
+    game = Game()
+    results = {"new_save": [], "advance": [], "shop": [], "errors": []}
+
+    async def start_player(user: int) -> None:
+        await asyncio.sleep(ramp * user / max(users, 1))
+        await play(game, user, turns, think, images, shop_every, results)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[start_player(user) for user in range(users)])
+    elapsed = time.perf_counter() - start
+
+    print(f"{users} users, {turns} turns each, in {elapsed:.1f}s "
+          f"({len(results['advance']) / elapsed:.1f} advances/s), errors: {len(results['errors'])}")
+    print(f"  new save: {percentiles(results['new_save'])}")
+    print(f"  advance:  {percentiles(results['advance'])}")
+    if shop_every:
+        print(f"  shop:     {percentiles(results['shop'])}")
+    for error in sorted(set(results["errors"]))[:10]:
+        print(f"  error: {error}")
+    print("executors: " + json.dumps({name: {key: stats[key] for key in ["submitted", "rejected", "dropped",
+                                                                           "max_depth", "avg_wait"]}
+                                       for name, stats in executors_stats().items()}))
+    print("llm json: " + json.dumps(game.LLM.model.parse_stats.stats()))
+    print("governors: " + json.dumps({name: {key: stats[key] for key in ["max_in_flight", "granted", "waited", "avg_wait",
+                                                                         "avg_wait_by_context"]}
+                                       for name, stats in governors_stats().items()}))
+    if game.LLM.pool_stats():
+        print("llm pools: " + json.dumps(game.LLM.pool_stats()))
+    print("speculation: " + json.dumps(game.speculation.stats()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the game pipeline with the offline backends.")
+    parser.add_argument("--users", type=int, default=20, help="number of concurrent players")
+    parser.add_argument("--turns", type=int, default=5, help="number of story advances per player")
+    parser.add_argument("--think", type=float, default=2, help="seconds a player thinks before each advance")
+    parser.add_argument("--images", action="store_true", help="generate the images too")
+    parser.add_argument("--shop-every", type=int, default=0, help="open the shop every this many turns (0 for never)")
+    parser.add_argument("--ramp", type=float, default=1, help="seconds over which the players start")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.turns, args.think, args.images, args.shop_every, args.ramp))
@@ -0,0 +1,73 @@
+"""
+Login storm benchmark.
+
+Fires a burst of concurrent password checks, the way /login/ runs them, and measures how responsive the event loop
+stays meanwhile, by timing a ticker task that should wake up every few milliseconds.
+Compares checking the passwords on the event loop (the old behavior) with the PasswordHasher process pool.
+
+Run from the repository root:
+    python -m benchmarks.login_benchmark --logins 64 --rounds 12
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from backend.PasswordHashing import PasswordHasher, hash_password, check_password
+
+TICK = 0.005
+
+
+async def ticker(lags: list[float], stop: asyncio.Event) -> None:
+    """
+    Sleeps for TICK seconds in a loop, recording how late each wake-up was.
+    """
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def run_storm(name: str, check: callable, logins: int, password: str, password_hash: str) -> None:
+    lags = []
+    stop = asyncio.Event()
+    ticker_task = asyncio.create_task(ticker(lags, stop))
+    await asyncio.sleep(TICK * 2)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[check(password, password_hash) for _ in range(logins)], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker_task
+
+    failures = sum(1 for result in results if result is not True)
+    lags = sorted(lags) or [0]
+    print(f"{name:>12}: {logins} logins in {elapsed:.2f}s ({logins / elapsed:.1f}/s), failures: {failures}, "
+          f"loop lag p50: {statistics.median(lags) * 1000:.1f}ms, "
+          f"p99: {lags[int(len(lags) * 0.99) - 1 if len(lags) > 1 else 0] * 1000:.1f}ms, "
+          f"max: {lags[-1] * 1000:.1f}ms, ticks: {len(lags)}")
+
+
+async def main(logins: int, rounds: int, workers: int, queue_size: int) -> None:
+    password = "Passw0rd!"
+    password_hash = hash_password(password, rounds)
+
+    async def inline_check(password: str, password_hash: str) -> bool:
+        return check_password(password, password_hash)
+
+    hasher = PasswordHasher(workers=workers, queue_size=queue_size, rounds=rounds)
+    await hasher.check(password, password_hash)  # Warm the worker processes up
+    try:
+        await run_storm("event loop", inline_check, logins, password, password_hash)
+        await run_storm("process pool", hasher.check, logins, password, password_hash)
+    finally:
+        hasher.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure event loop responsiveness during a login storm.")
+    parser.add_argument("--logins", type=int, default=32, help="number of concurrent logins")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt work factor")
+    parser.add_argument("--workers", type=int, default=4, help="hashing processes")
+    parser.add_argument("--queue-size", type=int, default=64, help="hashing requests allowed to wait")
+    args = parser.parse_args()
+    asyncio.run(main(args.logins, args.rounds, args.workers, args.queue_size))
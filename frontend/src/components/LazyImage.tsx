@@ -0,0 +1,26 @@
+import React, {useEffect, useState} from 'react';
+import AUTH from "../services/auth";
+import API from "../services/API";
+
+export default function LazyImage({save, category, version, alt, className}: { save: string, category: string, version: string, alt: string, className: string }) {
+    const [src, setSrc] = useState<string>("");
+
+    // Fetched after rendering, and again only when the image's version changes
+    useEffect(() => {
+        let objectURL = "";
+        let cancelled = false;
+        API.getImageFile(AUTH.getToken(), save, category).then((url) => {
+            objectURL = url;
+            if (!cancelled) setSrc(url);
+            else URL.revokeObjectURL(url);
+        }).catch((error) => {
+            console.warn("Error loading image: " + error.message);
+        });
+        return () => {
+            cancelled = true;
+            if (objectURL) URL.revokeObjectURL(objectURL);
+        };
+    }, [save, category, version]);
+
+    return <img src={src || "./default.jpg"} alt={alt} className={className} />;
+}
@@ -3,7 +3,7 @@ import './SavesList.css';
 import Button from "../components/Button";
 import { motion } from "framer-motion";
 import { FaTrashAlt } from "react-icons/fa";
-import ImageLoader from "../components/ImageLoader";
+import LazyImage from "../components/LazyImage";
 
 const container = {
     hidden: { opacity: 1, scale: 0 },
@@ -34,7 +34,7 @@ function SavesList({saves, loadSave, newSave, deleteSave} : {saves: any, loadSav
         return Object.keys(saves).slice(0, 4).map((save) => (
             <motion.li key={saves[save].id} className="item" variants={item}>
                 <Card func={() => loadSave(saves[save].id)}>
-                    <ImageLoader bytes={saves[save].image} alt={"character"} className={"cardImg"} />
+                    <LazyImage save={saves[save].id} category={"character_thumb"} version={saves[save].thumbnail} alt={"character"} className={"cardImg"} />
                     <div className="cardText">{saves[save].name}</div>
                 </Card>
                 <div className="space"/>
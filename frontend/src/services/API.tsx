@@ -1,4 +1,4 @@
-import {req} from './Requests';
+import {req, reqImage} from './Requests';
 
 class API {
     static async login(username: string, password: string) {
@@ -109,6 +109,13 @@ class API {
             category: category
         }, {});
     }
+
+    static async getImageFile(auth: string, save: string, category: string) {
+        return await reqImage('image_file', auth, {
+            save_name: save,
+            category: category
+        });
+    }
 }
 
 export default API;
\ No newline at end of file
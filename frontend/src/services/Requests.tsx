@@ -55,4 +55,19 @@ export async function req(endpoint: string, auth: string = '', params: any = {},
         throw new Error(response.message);
     }
     return response.result;
-}
\ No newline at end of file
+}
+
+export async function reqImage(endpoint: string, auth: string, params: any = {}) {
+    let url = new URL(`${process.env.REACT_APP_BACKEND_URL}/${endpoint}`);
+    Object.keys(params).forEach(key => url.searchParams.append(key, params[key]));
+
+    // The browser's cache revalidates the image by its ETag, so an unchanged image isn't downloaded again
+    const response = await fetch(url, {
+        method: 'GET',
+        headers: {"Authorization": "Bearer " + auth}
+    });
+    if (response.status !== 200) {
+        throw new Error("Failed to load image: " + response.status);
+    }
+    return URL.createObjectURL(await response.blob());
+}
@@ -1,4 +1,3 @@
-from backend.Endpoint import run_app
 from threading import Thread
 from colorama import init, Fore, Style
 import subprocess
@@ -13,6 +12,9 @@ def run_frontend_command(command):
 
 
 if __name__ == "__main__":
+    # Imported here, so processes spawned by the server (e.g. for password hashing) don't load the whole app
+    from backend.Endpoint import run_app, BACKEND_WORKERS
+
     print(Style.BRIGHT + Fore.BLUE + """
             .______      .______     _______ .______   .___________.
             |   _  \     |   _  \   /  _____||   _  \  |           |
@@ -27,6 +29,7 @@ if __name__ == "__main__":
     print("2. Run both servers (dev)")
     print("3. Run the frontend app (dev)")
     print("4. Build the frontend app (for prod)")
+    print("5. Run the backend server (prod)")
 
     choice1 = input(Style.BRIGHT + "Enter your choice: " + Style.RESET_ALL)
 
@@ -41,5 +44,7 @@ if __name__ == "__main__":
         run_frontend_command('electron .')
     elif choice1 == "4":
         run_frontend_command('npm run electron:build && open dist')
-
-
+    elif choice1 == "5":
+        print(f"\nRunning the backend server with {BACKEND_WORKERS} workers...\n" +
+              Fore.LIGHTBLACK_EX + "Closing this window will stop the server." + Style.RESET_ALL)
+        run_app(BACKEND_WORKERS)
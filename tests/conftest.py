@@ -0,0 +1,20 @@
+import os
+import tempfile
+import pytest
+
+# The backends are selected when the game is imported, so the tests run offline against a temporary local database
+os.environ.setdefault("LLM_BACKEND", "offline")
+os.environ.setdefault("T2I_BACKEND", "offline")
+os.environ.setdefault("DATABASE_BACKEND", "local")
+os.environ.setdefault("LOCAL_DB_PATH", tempfile.mkdtemp(prefix="tests_"))
+os.environ.setdefault("OFFLINE_LLM_LATENCY", "fixed:0.01")
+os.environ.setdefault("OFFLINE_T2I_LATENCY", "fixed:0.01")
+from benchmarks.fused_quest_benchmark import make_save
+
+
+@pytest.fixture
+def save():
+    """
+    A save in the middle of a story, with an active quest, the same as the fused quest benchmark's.
+    """
+    return make_save()
@@ -0,0 +1,26 @@
+import asyncio
+import pytest
+from backend.Admission import UserRateLimit
+
+
+async def authenticate(request) -> str:
+    return "player"
+
+
+def test_zero_per_minute_is_unlimited(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_TEST_PER_MINUTE", "0")
+    limit = UserRateLimit("test", authenticate, per_minute=6, burst=1, max_wait=0)
+
+    async def scenario():
+        return [await limit(None) for _ in range(10)]
+
+    assert asyncio.run(scenario()) == ["player"] * 10
+    assert limit.stats()["admitted"] == 10
+
+
+@pytest.mark.parametrize("per_minute, burst", [("-1", "3"), ("6", "0")])
+def test_invalid_limits_are_refused(monkeypatch, per_minute, burst):
+    monkeypatch.setenv("RATE_LIMIT_TEST_PER_MINUTE", per_minute)
+    monkeypatch.setenv("RATE_LIMIT_TEST_BURST", burst)
+    with pytest.raises(ValueError):
+        UserRateLimit("test", authenticate, per_minute=6, burst=3, max_wait=0)
@@ -0,0 +1,33 @@
+from backend.GenAI.LLM.LLM import LLM, HISTORY_TOKEN_BUDGET, count_tokens, verbatim_start
+
+SUMMARY = "Ayla left the city to find the stolen crown."
+
+
+def long_turns(count: int) -> list[str]:
+    return [entry for turn in range(count) for entry in
+            (f"Walk on, turn {turn}.", f"The marsh road goes on and on through the reeds at turn {turn}. " * 4)]
+
+
+def test_summary_a_turn_behind_is_kept(save):
+    history = save.story["history"]
+    save.story["history"] = history + long_turns(25)
+    save.set_summary(SUMMARY, len(history))
+    start = verbatim_start(save.story["history"], len(history), HISTORY_TOKEN_BUDGET - count_tokens(SUMMARY))
+    assert start > len(history)
+
+    written = LLM().write_history(save)
+    assert written.startswith(f"(summary of the story so far: {SUMMARY})")
+    assert save.story["history"][start] in written
+
+
+def test_summary_far_behind_falls_back_to_the_recent_turns(save):
+    history = save.story["history"]
+    save.story["history"] = history + long_turns(40)
+    save.set_summary(SUMMARY, len(history))
+
+    written = LLM().write_history(save)
+    assert SUMMARY not in written
+    start = verbatim_start(save.story["history"], 0, HISTORY_TOKEN_BUDGET)
+    assert save.story["history"][start] in written
+    assert save.story["history"][start - 2] not in written
+    assert save.story["history"][-1] in written
@@ -0,0 +1,23 @@
+from backend.Database.conn.ConnClass import THUMBNAIL_SUFFIX, default_image, default_image_hash, image_hash
+from backend.Database.conn.LocalConn import LocalConn
+
+USERNAME = "images_user"
+SAVE_NAME = "images_save"
+
+
+def test_missing_thumbnail_is_made_from_the_full_image():
+    conn = LocalConn()
+    conn.save_image(USERNAME, SAVE_NAME, "character", default_image("scene"))
+    category = "character" + THUMBNAIL_SUFFIX
+
+    thumbnail_hash = conn.return_image_hash(USERNAME, SAVE_NAME, category)
+    assert thumbnail_hash != default_image_hash(category)
+    assert conn.has_image(USERNAME, SAVE_NAME, category)
+    assert image_hash(conn.return_image_bytes(USERNAME, SAVE_NAME, category)) == thumbnail_hash
+
+
+def test_missing_thumbnail_without_full_image_is_the_default():
+    conn = LocalConn()
+    category = "scene" + THUMBNAIL_SUFFIX
+    assert conn.return_image_hash(USERNAME, "no_images", category) == default_image_hash(category)
+    assert not conn.has_image(USERNAME, "no_images", category)
@@ -0,0 +1,48 @@
+import asyncio
+import httpx
+import pytest
+from backend.GenAI.LLM.Retries import CircuitOpenError, RetryPolicy, is_retryable
+from backend.GenAI.Offline import OfflineError
+
+
+def status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://api.example.com/chat/completions")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+
+@pytest.mark.parametrize("exc", [httpx.ConnectError("refused"), httpx.ReadTimeout("timed out"),
+                                 asyncio.TimeoutError(), OfflineError("failure"),
+                                 status_error(429), status_error(503)])
+def test_transient_failures_are_retryable(exc):
+    assert is_retryable(exc)
+
+
+@pytest.mark.parametrize("exc", [TypeError("bug"), KeyError("choices"), ValueError("invalid JSON"),
+                                 CircuitOpenError("open"), status_error(400), status_error(401)])
+def test_other_failures_are_not_retryable(exc):
+    assert not is_retryable(exc)
+
+
+def test_local_failure_of_a_half_open_probe_leaves_the_breaker_open():
+    policy = RetryPolicy(attempts=1)
+    breaker = policy.breaker("backend")
+    breaker.cooldown = 0
+    for _ in range(breaker.failures):
+        breaker.record_failure()
+    assert breaker.state == "half_open"
+
+    def bug():
+        raise KeyError("choices")
+
+    def bad_request():
+        raise status_error(400)
+
+    with pytest.raises(KeyError):
+        policy.run("backend", None, bug)
+    assert breaker.opened_at is not None
+    assert breaker.consecutive_failures == breaker.failures
+    assert not breaker.probing
+
+    with pytest.raises(httpx.HTTPStatusError):
+        policy.run("backend", None, bad_request)
+    assert breaker.state == "closed"
@@ -0,0 +1,28 @@
+import asyncio
+from backend.Database.SaveEvents import SaveEventBus
+
+
+def test_deleted_save_is_forgotten_after_waking_its_waiters():
+    bus = SaveEventBus()
+
+    async def scenario():
+        bus.publish("player", "save", "save")
+        waiting = asyncio.ensure_future(bus.wait("player", "save", 1, timeout=5))
+        await asyncio.sleep(0.01)
+        bus.publish("player", "save", "deleted")
+        bus.forget("player", "save")
+        return await waiting
+
+    events = asyncio.run(scenario())
+    assert [(event["seq"], event["event"]) for event in events] == [(2, "deleted")]
+    assert bus.last_sequence("player", "save") == 0
+    assert bus.events_since("player", "save", 0) == []
+    assert not bus._waiters
+
+
+def test_saves_are_bounded():
+    bus = SaveEventBus(max_saves=2)
+    for save_name in ["first", "second", "third"]:
+        bus.publish("player", save_name, "save")
+    assert bus.last_sequence("player", "first") == 0
+    assert bus.last_sequence("player", "third") == 1
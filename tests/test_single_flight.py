@@ -0,0 +1,30 @@
+import asyncio
+import pytest
+from backend.Executors import ExecutorRejected
+from backend.Utility import SingleFlight, start_task, work_context
+
+
+def test_foreground_caller_reruns_a_failed_speculative_flight():
+    flights = SingleFlight()
+    calls = []
+
+    async def generate() -> str:
+        calls.append(work_context.get())
+        await asyncio.sleep(0.01)
+        if work_context.get() == "speculative":
+            raise ExecutorRejected("Dropped from the full speculative executor.")
+        return "shop"
+
+    async def scenario():
+        prefetch = start_task(flights.run("save", generate), "speculative")
+        await asyncio.sleep(0)
+        speculative_joiner = start_task(flights.run("save", generate), "speculative")
+        result = await flights.run("save", generate)
+        assert result == "shop"
+        assert calls == ["speculative", "foreground"]
+        for task in [prefetch, speculative_joiner]:
+            with pytest.raises(ExecutorRejected):
+                await task
+        assert not flights.in_flight("save")
+
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+import asyncio
+import pytest
+from backend.Game.Game import Game
+from backend.Game.Speculation import node_key, state_prefix
+from backend.Types.SaveData import SaveData
+
+USERNAME = "speculation_user"
+SAVE_NAME = "speculation_save"
+
+
+def test_cancelled_speculation_is_speculated_again(monkeypatch, save):
+    game = Game()
+    data = save
+    action = data.story["options"][0]
+    key = node_key(data, action)
+    lineage = [state_prefix(data)]
+
+    async def scenario():
+        game.speculation.start(USERNAME, SAVE_NAME, data)
+        generating = asyncio.Event()
+
+        async def never_finishes(state: SaveData, chosen_action: str) -> dict:
+            generating.set()
+            await asyncio.Event().wait()
+
+        with monkeypatch.context() as patch:
+            patch.setattr(game, "action_result_for", never_finishes)
+            task = asyncio.create_task(game.speculate_result(USERNAME, SAVE_NAME, data, action, 1, lineage, 1.0))
+            await generating.wait()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        assert await game.DB.get_cache_async(USERNAME, SAVE_NAME, key) is None
+        assert game.pending_results.get(USERNAME, SAVE_NAME, key) is None
+
+        await game.speculate_result(USERNAME, SAVE_NAME, data, action, 1, lineage, 1.0)
+        result = await game.DB.get_cache_async(USERNAME, SAVE_NAME, key)
+        assert isinstance(result, dict) and result["scene"]
+
+    asyncio.run(scenario())